@@ -404,6 +404,9 @@ if (Test-Path -Path $vhdLocalPath -ErrorAction SilentlyContinue) {
           'task' = @{
             'id' = $env:TASK_ID;
             'run' = $env:RUN_ID;
+          };
+          'digest' = @{
+            'disk' = $env:DISK_IMAGE_DIGEST;
           }
         };
         'image' = @{
@@ -413,7 +416,7 @@ if (Test-Path -Path $vhdLocalPath -ErrorAction SilentlyContinue) {
         }
       };
       $imageArtifactDescriptorLocalPath = ('{0}{1}image-bucket-resource.json' -f $workFolder, ([IO.Path]::DirectorySeparatorChar));
-      Out-File -FilePath $imageArtifactDescriptorLocalPath -Encoding 'utf8' -InputObject (ConvertTo-Json -InputObject $imageArtifactDescriptor);
+      Out-File -FilePath $imageArtifactDescriptorLocalPath -Encoding 'utf8' -InputObject (ConvertTo-Json -InputObject $imageArtifactDescriptor -Depth 4);
       if (Test-Path -Path $imageArtifactDescriptorLocalPath -ErrorAction SilentlyContinue) {
         Write-Output -InputObject ('image artifact descriptor written to: {0}' -f $imageArtifactDescriptorLocalPath);
       }
@@ -1443,6 +1443,26 @@ if ($config) {
   exit 1
 }
 $imageArtifactDescriptor = (Get-ImageArtifactDescriptor -platform $platform -imageKey $imageKey);
+
+# the digest of the machine image inputs (computed by the decision task) is published so that subsequent decision tasks
+# can detect changes. it is only written once the machine image has been captured (or found to exist already), so that a
+# failed build is not recorded as having built these inputs.
+$machineImageArtifactDescriptor = @{
+  'build' = @{
+    'date' = (Get-Date -UFormat '+%Y-%m-%d');
+    'time' = (Get-Date -UFormat '+%Y-%m-%dT%H:%M:%S%Z');
+    'revision' = $revision;
+    'task' = @{
+      'id' = $env:TASK_ID;
+      'run' = $env:RUN_ID;
+    };
+    'digest' = @{
+      'disk' = $(if ($imageArtifactDescriptor.build.digest) { $imageArtifactDescriptor.build.digest.disk } else { $null });
+      'machine' = $env:MACHINE_IMAGE_DIGEST;
+    }
+  };
+  'image' = $imageArtifactDescriptor.image
+};
 $exportImageName = [System.IO.Path]::GetFileName($imageArtifactDescriptor.image.key);
 $vhdLocalPath = ('{0}{1}{2}' -f $workFolder, ([IO.Path]::DirectorySeparatorChar), $exportImageName);
 
@@ -1464,6 +1484,7 @@ foreach ($target in @($config.target | ? { (($_.platform -eq $platform) -and $_.
           Remove-Image -image $existingImage
         } else {
           Write-Output -InputObject ('skipped machine image creation for: {0}, in group: {1}, in cloud platform: {2}. machine image exists' -f $targetImageName, $target.group, $target.platform);
+          Out-File -FilePath ('{0}{1}image-bucket-resource.json' -f $workFolder, ([IO.Path]::DirectorySeparatorChar)) -Encoding 'utf8' -InputObject (ConvertTo-Json -InputObject $machineImageArtifactDescriptor -Depth 4);
           # prevent generic-worker from clasifying the task as failed due to missing artifacts
           New-Item -ItemType 'Directory' -Force -Path @(('{0}{1}screenshot{1}full' -f $workFolder, ([IO.Path]::DirectorySeparatorChar)), ('{0}{1}screenshot{1}thumbnail' -f $workFolder, ([IO.Path]::DirectorySeparatorChar)));
           New-Item -ItemType 'File' -Path @(('{0}{1}screenshot{1}full{1}intentionally-empty.txt' -f $workFolder, ([IO.Path]::DirectorySeparatorChar)), ('{0}{1}screenshot{1}thumbnail{1}intentionally-empty.txt' -f $workFolder, ([IO.Path]::DirectorySeparatorChar)));
@@ -1569,6 +1590,7 @@ foreach ($target in @($config.target | ? { (($_.platform -eq $platform) -and $_.
                 Remove-Image -image $existingImage
               } else {
                 Write-Output -InputObject ('skipped machine image creation for: {0}, in group: {1}, in cloud platform: {2}. machine image exists' -f $targetImageName, $target.group, $target.platform);
+                Out-File -FilePath ('{0}{1}image-bucket-resource.json' -f $workFolder, ([IO.Path]::DirectorySeparatorChar)) -Encoding 'utf8' -InputObject (ConvertTo-Json -InputObject $machineImageArtifactDescriptor -Depth 4);
                 exit;
               }
             }
@@ -1678,6 +1700,7 @@ foreach ($target in @($config.target | ? { (($_.platform -eq $platform) -and $_.
                   Remove-Image -image $existingImage
                 } else {
                   Write-Output -InputObject ('skipped machine image creation for: {0}, in group: {1}, in cloud platform: {2}. machine image exists' -f $targetImageName, $target.group, $target.platform);
+                  Out-File -FilePath ('{0}{1}image-bucket-resource.json' -f $workFolder, ([IO.Path]::DirectorySeparatorChar)) -Encoding 'utf8' -InputObject (ConvertTo-Json -InputObject $machineImageArtifactDescriptor -Depth 4);
                   exit;
                 }
               }
@@ -1793,6 +1816,7 @@ foreach ($target in @($config.target | ? { (($_.platform -eq $platform) -and $_.
                   -ErrorAction SilentlyContinue);
                 if ($azImage) {
                   Write-Output -InputObject ('image: {0}, creation appears successful in region: {1}, cloud platform: {2}' -f $targetImageName, $target.region, $target.platform);
+                  Out-File -FilePath ('{0}{1}image-bucket-resource.json' -f $workFolder, ([IO.Path]::DirectorySeparatorChar)) -Encoding 'utf8' -InputObject (ConvertTo-Json -InputObject $machineImageArtifactDescriptor -Depth 4);
                 } else {
                   Write-Output -InputObject ('image: {0}, creation appears unsuccessful in region: {1}, cloud platform: {2}' -f $targetImageName, $target.region, $target.platform);
                   if (-not $disableCleanup) {
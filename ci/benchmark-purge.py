@@ -0,0 +1,130 @@
+import json
+import os
+import random
+import statistics
+import tempfile
+from benchmark import benchmarkRevisions, getArgumentParser
+from datetime import datetime, timedelta, timezone
+
+
+# runs purge-azure-resources.py against a synthetic subscription, held by its fixture azure clients, and reports wall
+# time, peak memory, outbound call counts and deletion throughput. see benchmark.py for the harness.
+parser = getArgumentParser('measure purge throughput, memory and api calls against a synthetic azure subscription', repeats = 3)
+parser.add_argument('--groups', type = int, default = 20, help = 'resource groups in the synthetic subscription (default: 20)')
+parser.add_argument('--vms-per-group', type = int, default = 250, help = 'virtual machines per group, each with a nic, public ip and os disk (default: 250)')
+parser.add_argument('--orphan-ratio', type = float, default = 0.2, help = 'leftover nic, public ip and disk sets per virtual machine (default: 0.2)')
+parser.add_argument('--deallocated-ratio', type = float, default = 0.05, help = 'share of virtual machines that are deallocated (default: 0.05)')
+parser.add_argument('--images-per-key', type = int, default = 10, help = 'machine images (and snapshots) per key in each group (default: 10)')
+parser.add_argument('--seed', type = int, default = 1, help = 'random seed for the synthetic subscription (default: 1)')
+args = parser.parse_args()
+
+subscription = '/subscriptions/00000000-0000-0000-0000-000000000000'
+keys = ['win10-64', 'win10-64-gpu', 'win7-32']
+
+
+def getResourceId(group, provider, name):
+    return '{}/resourceGroups/{}/providers/{}/{}'.format(subscription, group, provider, name)
+
+
+def generateSubscription(rng):
+    azure = { key: [] for key in ['resourceGroups', 'virtualMachines', 'networkInterfaces', 'publicIPAddresses', 'networkSecurityGroups', 'virtualNetworks', 'disks', 'images', 'snapshots', 'workerPoolImageIds'] }
+    now = datetime.now(timezone.utc)
+    for g in range(args.groups):
+        group = 'rg-bench-{:02d}-us-gecko-t'.format(g)
+        azure['resourceGroups'].append(group)
+        nsgId = getResourceId(group, 'Microsoft.Network/networkSecurityGroups', 'nsg-bench')
+        vnetId = getResourceId(group, 'Microsoft.Network/virtualNetworks', 'vn-bench')
+        azure['networkSecurityGroups'].append({ 'id': nsgId, 'name': 'nsg-bench' })
+        azure['virtualNetworks'].append({ 'id': vnetId, 'name': 'vn-bench', 'subnets': [ { 'network_security_group': { 'id': nsgId } } ] })
+        # redundant network resources left behind by old deployments
+        for i in range(3):
+            azure['networkSecurityGroups'].append({ 'id': getResourceId(group, 'Microsoft.Network/networkSecurityGroups', 'legacy-nsg-{}'.format(i)), 'name': 'legacy-nsg-{}'.format(i) })
+            azure['virtualNetworks'].append({ 'id': getResourceId(group, 'Microsoft.Network/virtualNetworks', 'legacy-vnet-{}'.format(i)), 'name': 'legacy-vnet-{}'.format(i), 'subnets': [] })
+        leftovers = int(args.vms_per_group * args.orphan_ratio)
+        for v in range(args.vms_per_group + leftovers):
+            name = 'vm-{:05d}'.format(v)
+            vmId = getResourceId(group, 'Microsoft.Compute/virtualMachines', name) if v < args.vms_per_group else None
+            nicId = getResourceId(group, 'Microsoft.Network/networkInterfaces', 'nic-{}'.format(name))
+            pipId = getResourceId(group, 'Microsoft.Network/publicIPAddresses', 'pip-{}'.format(name))
+            diskId = getResourceId(group, 'Microsoft.Compute/disks', 'disk-{}'.format(name))
+            deallocated = vmId is not None and rng.random() < args.deallocated_ratio
+            if vmId is not None:
+                azure['virtualMachines'].append({
+                    'id': vmId,
+                    'name': name,
+                    'provisioning_state': 'Succeeded',
+                    'power_state': 'deallocated' if deallocated else 'running',
+                    'network_profile': { 'network_interfaces': [ { 'id': nicId } ] },
+                    'storage_profile': { 'os_disk': { 'managed_disk': { 'id': diskId } }, 'data_disks': [] }
+                })
+            azure['networkInterfaces'].append({
+                'id': nicId,
+                'name': 'nic-{}'.format(name),
+                'virtual_machine': { 'id': vmId } if vmId is not None else None,
+                'network_security_group': { 'id': nsgId },
+                'ip_configurations': [ { 'public_ip_address': { 'id': pipId }, 'subnet': { 'id': '{}/subnets/sn-bench'.format(vnetId) } } ]
+            })
+            # dynamic addresses are released when their virtual machine is deallocated or deleted
+            azure['publicIPAddresses'].append({ 'id': pipId, 'name': 'pip-{}'.format(name), 'ip_address': '10.{}.{}.{}'.format(g, v // 256, v % 256) if vmId is not None and not deallocated else None, 'ip_configuration': { 'id': '{}/ipConfigurations/ipconfig1'.format(nicId) } })
+            azure['disks'].append({ 'id': diskId, 'name': 'disk-{}'.format(name), 'managed_by': vmId, 'disk_state': 'Attached' if vmId is not None else 'Unattached', 'time_created': (now - timedelta(days = 1)).isoformat() })
+        for key in keys:
+            for i in range(args.images_per_key):
+                diskSha = '{:07x}'.format(rng.getrandbits(28))
+                commitTime = (now - timedelta(days = args.images_per_key - i)).isoformat()
+                imageName = '{}-{}-{}-{:07x}'.format(group.replace('rg-', ''), key, diskSha, rng.getrandbits(28))
+                snapshotName = '{}-{}-{}'.format(group.replace('rg-', ''), key, diskSha)
+                azure['images'].append({ 'id': getResourceId(group, 'Microsoft.Compute/images', imageName), 'name': imageName, 'tags': { 'machineImageCommitTime': commitTime } })
+                azure['snapshots'].append({ 'id': getResourceId(group, 'Microsoft.Compute/snapshots', snapshotName), 'name': snapshotName, 'tags': None, 'time_created': commitTime })
+            # an older image still in use by a worker pool
+            azure['workerPoolImageIds'].append(azure['images'][-args.images_per_key]['id'])
+    return { 'azure': azure }
+
+
+def getScenarios(fixturesPath, workspace):
+    return [
+        {
+            'name': 'plan',
+            'command': [ 'ci/purge-azure-resources.py', '--fixtures', fixturesPath, '--plan', os.path.join(workspace, 'plan.json') ],
+            'measure': lambda: getCallCounts(os.path.join(workspace, 'metrics.json'))
+        },
+        {
+            'name': 'purge',
+            'command': [ 'ci/purge-azure-resources.py', '--fixtures', fixturesPath ],
+            'measure': lambda: getCallCounts(os.path.join(workspace, 'metrics.json'))
+        }
+    ]
+
+
+def getCallCounts(metricsPath):
+    with open(metricsPath, 'r') as metricsFile:
+        calls = json.load(metricsFile)['calls']
+    return {
+        'calls': sum(service['count'] for service in calls.values()),
+        'deletions': sum(operation['count'] for service in calls.values() for name, operation in service['operations'].items() if name.endswith('begin_delete'))
+    }
+
+
+def report(scenario, runs):
+    timings = [run['seconds'] for run in runs]
+    return '{:<6} median: {:.2f}s, min: {:.2f}s, max: {:.2f}s, peak rss: {:.0f}MB, api calls: {}, deletions: {} ({:.0f}/s) ({} runs)'.format(
+        scenario['name'],
+        statistics.median(timings),
+        min(timings),
+        max(timings),
+        max(run['maxRssMegabytes'] for run in runs),
+        runs[-1]['calls'],
+        runs[-1]['deletions'],
+        runs[-1]['deletions'] / statistics.median(timings),
+        len(runs))
+
+
+with tempfile.TemporaryDirectory() as workspace:
+    fixtures = generateSubscription(random.Random(args.seed))
+    fixturesPath = os.path.join(workspace, 'subscription.json')
+    with open(fixturesPath, 'w') as fixturesFile:
+        json.dump(fixtures, fixturesFile)
+    print('synthetic subscription: {} resources in {} groups'.format(sum(len(resources) for section, resources in fixtures['azure'].items() if section not in ['resourceGroups', 'workerPoolImageIds']), args.groups))
+
+    env = { k: v for k, v in os.environ.items() if k not in ['TASKCLUSTER_PROXY_URL', 'TASKCLUSTER_ROOT_URL'] }
+    env.update({ 'CIB_METRICS_PATH': os.path.join(workspace, 'metrics.json'), 'CIB_CACHE_DIR': os.path.join(workspace, 'cache') })
+    benchmarkRevisions(args.revision, workspace, getScenarios(fixturesPath, workspace), args.repeats, env, report)
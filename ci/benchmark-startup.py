@@ -0,0 +1,57 @@
+import os
+import statistics
+import tempfile
+import yaml
+from benchmark import benchmarkRevisions, getArgumentParser, repositoryPath
+
+
+# times the paths where the ci entry points decide there is nothing to do and exit. see benchmark.py for the harness.
+parser = getArgumentParser('measure wall time of the ci entry point skip paths', repeats = 10)
+parser.add_argument('--fixtures', default = 'ci/fixtures/decision.yaml', help = 'the dry run fixture used as the basis for the no-ci scenario')
+args = parser.parse_args()
+
+offlineEnv = {
+    'TASKCLUSTER_PROXY_URL': 'http://127.0.0.1:9',
+    'CIB_METRICS_PATH': os.devnull,
+    # the dry run scenarios would otherwise write commit-directives.json into the tree being measured
+    'CIB_COMMIT_DIRECTIVES_PATH': os.devnull
+}
+
+
+def getScenarios(fixturesPath):
+    return [
+        {
+            'name': 'decision: production environment skip',
+            'command': [ 'ci/create-image-build-tasks.py' ],
+            'env': { 'TASKCLUSTER_ROOT_URL': 'https://firefox-ci-tc.services.mozilla.com' }
+        },
+        {
+            'name': 'decision: no-ci commit (dry run)',
+            'command': [ 'ci/create-image-build-tasks.py', '--dry-run', fixturesPath, '--output', os.devnull ],
+            'env': {}
+        },
+        {
+            'name': 'pool-deploy: no run environment',
+            'command': [ 'ci/pool-deploy.py' ],
+            'env': { 'TASKCLUSTER_ROOT_URL': 'https://stage.taskcluster.nonprod.cloudops.mozgcp.net' }
+        }
+    ]
+
+
+def report(scenario, runs):
+    timings = [run['seconds'] for run in runs]
+    return '{:<40} median: {:.3f}s, min: {:.3f}s, max: {:.3f}s ({} runs)'.format(scenario['name'], statistics.median(timings), min(timings), max(timings), len(timings))
+
+
+with tempfile.TemporaryDirectory() as workspace:
+    # the no-ci scenario reuses the dry run fixture with a commit message that disables ci
+    with open(os.path.join(repositoryPath, args.fixtures), 'r') as fixturesFile:
+        fixtures = yaml.safe_load(fixturesFile)
+    fixtures['commitMessage'] = 'benchmark startup\n\nno-ci\n'
+    fixturesPath = os.path.join(workspace, 'no-ci.yaml')
+    with open(fixturesPath, 'w') as fixturesFile:
+        yaml.safe_dump(fixtures, fixturesFile)
+
+    env = { k: v for k, v in os.environ.items() if k not in ['TASK_ID', 'TRAVIS_COMMIT'] }
+    env.update(offlineEnv)
+    benchmarkRevisions(args.revision, workspace, getScenarios(fixturesPath), args.repeats, env, report)
@@ -0,0 +1,61 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+# the harness shared by the benchmark scripts. each scenario is a dict with a name, a command (run with the current
+# interpreter, from the root of the tree being measured), an optional env and an optional measure function, which is
+# called after each successful run and returns extra fields for that run. each run is a fresh interpreter, so module
+# imports and client construction are included in the measurement. the working tree is always measured, along with any
+# --revision (checked out into a temporary worktree).
+repositoryPath = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+
+
+def getArgumentParser(description, repeats):
+    parser = argparse.ArgumentParser(description = description)
+    parser.add_argument('--repeats', type = int, default = repeats, help = 'runs per scenario (default: {})'.format(repeats))
+    parser.add_argument('--revision', action = 'append', default = [], help = 'a git revision to benchmark in addition to the working tree (may be repeated)')
+    return parser
+
+
+# returns the successful runs of a scenario, each with its wall time and the peak resident set of the child process
+def runScenario(path, scenario, repeats, env):
+    scenarioEnv = dict(env, **scenario.get('env', {}))
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable] + scenario['command'], cwd = path, env = scenarioEnv, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+        stderr = process.stderr.read()
+        # wait4 reports the peak resident set of this child alone (in kilobytes on linux)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        if os.waitstatus_to_exitcode(status) != 0:
+            print('warn: {} exited {} at {}: {}'.format(scenario['name'], os.waitstatus_to_exitcode(status), path, stderr.decode().strip().splitlines()[-1:]))
+            break
+        run = { 'seconds': elapsed, 'maxRssMegabytes': usage.ru_maxrss / 1024 }
+        if 'measure' in scenario:
+            run.update(scenario['measure']())
+        runs.append(run)
+    return runs
+
+
+# report is called with a scenario and its runs, and returns the line printed for the scenario
+def benchmark(label, path, scenarios, repeats, env, report):
+    print('{}:'.format(label))
+    for scenario in scenarios:
+        runs = runScenario(path, scenario, repeats, env)
+        if runs:
+            print('  {}'.format(report(scenario, runs)))
+
+
+def benchmarkRevisions(revisions, workspace, scenarios, repeats, env, report):
+    benchmark('working tree', repositoryPath, scenarios, repeats, env, report)
+    for revision in revisions:
+        worktreePath = os.path.join(workspace, revision.replace('/', '-'))
+        subprocess.run(['git', 'worktree', 'add', '--detach', worktreePath, revision], cwd = repositoryPath, check = True, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        try:
+            benchmark(revision, worktreePath, scenarios, repeats, env, report)
+        finally:
+            subprocess.run(['git', 'worktree', 'remove', '--force', worktreePath], cwd = repositoryPath, check = True)
@@ -1,66 +1,766 @@
+import atexit
+import collections
+import contextlib
+import copy
+import functools
+import glob
 import gzip
+import hashlib
+import importlib
+import io
 import json
 import os
+import pickle
+import re
+import subprocess
+import sys
+import threading
+import time
+import types
+import urllib.error
 import urllib.request
 import yaml
 import taskcluster.exceptions
 from datetime import datetime, timedelta
 
 from cachetools import cached, TTLCache
+from concurrent.futures import ThreadPoolExecutor
 cache = TTLCache(maxsize=100, ttl=300)
+cacheLock = threading.Lock()
 
+repositoryPath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+cachePath = os.getenv('CIB_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'cloud-image-builder'))
+sharedConfigKeys = ['disable-windows-service', 'drivers', 'packages', 'unattend-commands']
+# the target properties that build-disk-image.ps1 matches shared config entries on, mapped to the image config (or build platform) value they are matched against
+sharedConfigTargetKeys = {
+    'disable-windows-service': ['cloud', 'os', 'architecture'],
+    'drivers': ['cloud', 'os', 'architecture', 'gpu'],
+    'packages': ['cloud', 'os', 'architecture', 'gpu'],
+    'unattend-commands': ['cloud', 'os', 'architecture', 'gpu']
+}
+# the libyaml backed loader is an order of magnitude faster than the pure python loader, when available
+yamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+configIndexVersion = 1
+# recorded remote responses used instead of network calls when the decision runs offline (see dryrun.loadFixtures)
+fixtures = None
+# distinguishes an artifact that was not prefetched (and should be fetched on demand) from one that failed to fetch
+unfetched = object()
+machineImageTagKeys = ['workerType', 'sourceOrganisation', 'sourceRepository', 'sourceRevision', 'sourceScript', 'deploymentId']
 
-@cached(cache)
+
+def git(*args):
+    try:
+        return subprocess.run(['git'] + list(args), cwd=repositoryPath, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def readCacheFile(*pathParts):
+    try:
+        with open(os.path.join(cachePath, *pathParts), 'rb') as stream:
+            return stream.read()
+    except OSError:
+        return None
+
+
+def writeCacheFile(contents, *pathParts):
+    # write to a temporary file and rename so that concurrent readers never observe a partial write
+    path = os.path.join(cachePath, *pathParts)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporaryPath = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(temporaryPath, 'wb') as stream:
+            stream.write(contents)
+        os.replace(temporaryPath, path)
+    except OSError as e:
+        print('warn: failed to write cache file: {}. {}'.format(path, e))
+
+
+# blob ids are git object ids (sha1 of 'blob <size>\0<contents>') so that files fetched over http are
+# addressed identically to files read from the local object store
+def getBlobId(revision, path):
+    output = git('rev-parse', '--verify', '--quiet', '{}:{}'.format(revision, path))
+    if output:
+        return output.decode().strip()
+
+    # a full commit sha is immutable, so its path to blob mapping can be cached indefinitely
+    isFullSha = len(revision) == 40
+    if isFullSha:
+        cachedBlobId = readCacheFile('ref', revision, path)
+        if cachedBlobId:
+            return cachedBlobId.decode().strip()
+
+    url = 'https://raw.githubusercontent.com/mozilla-platform-ops/cloud-image-builder/{}/{}'.format(revision, path)
+    print('debug: {} at revision: {} is not in the local object store, fetching: {}'.format(path, revision[0:7], url))
+    with outboundCall('github-raw', 'config'):
+        contents = urllib.request.urlopen(url).read()
+    blobId = hashlib.sha1(b'blob ' + str(len(contents)).encode() + b'\0' + contents).hexdigest()
+    writeCacheFile(contents, 'blob', blobId)
+    if isFullSha:
+        writeCacheFile(blobId.encode(), 'ref', revision, path)
+    return blobId
+
+
+def getBlobContents(blobId):
+    contents = readCacheFile('blob', blobId)
+    if contents is None:
+        contents = git('cat-file', 'blob', blobId)
+    if contents is None:
+        raise LookupError('blob {} not found in cache or local object store'.format(blobId))
+    return contents.decode()
+
+
+def getBlobYaml(blobId):
+    cachedDocument = readCacheFile('yaml', blobId[0:2], '{}.pickle'.format(blobId))
+    if cachedDocument is not None:
+        try:
+            return pickle.loads(cachedDocument)
+        except Exception:
+            print('warn: discarding unreadable cached document for blob: {}'.format(blobId))
+    document = loadYaml(getBlobContents(blobId))
+    writeCacheFile(pickle.dumps(document), 'yaml', blobId[0:2], '{}.pickle'.format(blobId))
+    return document
+
+
+@cached(cache, lock=cacheLock)
 def getConfig(revision, key):
-    url = 'https://raw.githubusercontent.com/mozilla-platform-ops/cloud-image-builder/{}/config/{}.yaml'.format(revision, key)  # noqa: E501
-    return yaml.safe_load(urllib.request.urlopen(url).read().decode())
+    return getBlobYaml(getBlobId(revision, 'config/{}.yaml'.format(key)))
 
 
-def updateRole(auth, configPath, roleId):
-    print('TASKCLUSTER_ROOT_URL:', os.environ['TASKCLUSTER_ROOT_URL'])
-    with open(configPath, 'r') as stream:
-        payload = yaml.safe_load(stream)
-        role = None
+ConfigVersion = collections.namedtuple('ConfigVersion', ['sha', 'time', 'config'])
+# a run of consecutive versions of a key config in which a target group declared the same deploymentId and sourceRevision.
+# versions are oldest first. supersededTime is the commit time of the version that changed the tags (None while current).
+ConfigRevisionRange = collections.namedtuple('ConfigRevisionRange', ['group', 'deploymentId', 'sourceRevision', 'versions', 'supersededTime'])
+
+
+# the full sha and commit time (as a unix timestamp) of a revision in the local history, or None
+@functools.lru_cache(maxsize=None)
+def getCommitTime(revision):
+    output = git('log', '-1', '--format=%H %ct', revision, '--')
+    if not output:
+        return None
+    sha, time = output.decode().split()
+    return sha, int(time)
+
+
+# every version of config/{key}.yaml in the local history of HEAD, newest first. only the commits that touched the
+# file are visited, and their contents are read through a single git cat-file process.
+def getConfigHistory(key):
+    path = 'config/{}.yaml'.format(key)
+    log = git('log', '--format=%H %ct', 'HEAD', '--', path)
+    if not log:
+        return []
+    commits = [(sha, int(time)) for sha, time in (line.split() for line in log.decode().splitlines())]
+    try:
+        output = subprocess.run(['git', 'cat-file', '--batch'], cwd=repositoryPath, input=''.join('{}:{}\n'.format(sha, path) for sha, _ in commits).encode(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    versions = []
+    offset = 0
+    for sha, time in commits:
+        end = output.index(b'\n', offset)
+        header = output[offset:end].decode().split()
+        offset = end + 1
+        # the commit that deleted the file has no blob
+        if header[-1] == 'missing':
+            continue
+        size = int(header[2])
+        contents = output[offset:offset + size]
+        offset += size + 1
         try:
-            role = auth.role(roleId=roleId)
-            print('info: role {} existence detected'.format(roleId))
-        except taskcluster.exceptions.TaskclusterRestFailure as tcRestFailure:
-            if tcRestFailure.status_code == 404:
-                role = None
-                print('info: role {} absence detected'.format(roleId))
-            else:
-                raise
+            versions.append(ConfigVersion(sha, time, loadYaml(contents)))
+        except yaml.YAMLError:
+            print('warn: failed to parse {} at revision: {}'.format(path, sha))
+    return versions
 
-        if role:
-            auth.updateRole(roleId, payload)
-            print('info: role {} updated'.format(roleId))
-        else:
-            auth.createRole(roleId, payload)
-            print('info: role {} created'.format(roleId))
+
+# maps the deploymentId and sourceRevision declared for each target group in the history of a key config to the range of
+# config versions that declared them. built once per key from local git history, so that the config a machine image was
+# built from can be looked up without fetching configs from github.
+class ConfigRevisionIndex:
+    def __init__(self, key):
+        self.key = key
+        self.ranges = collections.defaultdict(list)
+        openRanges = {}
+        for version in reversed(getConfigHistory(key)):
+            targets = { target['group']: target for target in (version.config or {}).get('target', []) if 'group' in target }
+            for group in set(openRanges) - set(targets):
+                self.closeRange(openRanges.pop(group), version.time)
+            for group, target in targets.items():
+                tags = { tag['name']: tag['value'] for tag in target.get('tag', []) if 'name' in tag }
+                deploymentId, sourceRevision = tags.get('deploymentId'), tags.get('sourceRevision')
+                openRange = openRanges.get(group)
+                if openRange is not None and (openRange.deploymentId, openRange.sourceRevision) == (deploymentId, sourceRevision):
+                    openRange.versions.append(version)
+                else:
+                    if openRange is not None:
+                        self.closeRange(openRange, version.time)
+                    openRanges[group] = ConfigRevisionRange(group, deploymentId, sourceRevision, [version], None)
+        for openRange in openRanges.values():
+            self.closeRange(openRange, None)
+
+    def closeRange(self, revisionRange, supersededTime):
+        revisionRange = revisionRange._replace(supersededTime=supersededTime)
+        for value in set([revisionRange.deploymentId, revisionRange.sourceRevision]) - set([None]):
+            self.ranges[(revisionRange.group, value)].append(revisionRange)
+
+    # the newest range in which the group declared the revision (as its deploymentId or sourceRevision) and which was
+    # still current at notBefore (a commit time), or None
+    def findRange(self, group, revision, notBefore=None):
+        candidates = [r for r in self.ranges.get((group, revision), []) if notBefore is None or r.supersededTime is None or r.supersededTime > notBefore]
+        return max(candidates, key=lambda r: r.versions[0].time) if candidates else None
+
+
+@functools.lru_cache(maxsize=None)
+def getConfigRevisionIndex(key):
+    return ConfigRevisionIndex(key)
+
+
+def loadYaml(contents):
+    return yaml.load(contents, Loader=yamlLoader)
+
+
+def normaliseRegion(region):
+    return region.replace(' ', '').lower()
+
+
+def buildConfigIndex(configs):
+    index = { 'keys': {}, 'pools': {}, 'regions': [] }
+    for key, config in configs.items():
+        keyIndex = {
+            'config': config,
+            'pools': {},
+            'regions': sorted(set(normaliseRegion(target['region']) for target in config['target']))
+        }
+        for pool in config['manager']['pool']:
+            poolName = '{}/{}'.format(pool['domain'], pool['variant'])
+            targets = [target for target in config['target'] if target['group'].endswith('-{}'.format(pool['domain']))]
+            targetsByRegion = {}
+            for target in targets:
+                targetsByRegion.setdefault(normaliseRegion(target['region']), []).append(target)
+            keyIndex['pools'][poolName] = {
+                'pool': pool,
+                'targets': targets,
+                'targetsByRegion': targetsByRegion
+            }
+            index['pools'][poolName] = key
+        index['keys'][key] = keyIndex
+    index['regions'] = sorted(set(region for keyIndex in index['keys'].values() for region in keyIndex['regions']))
+    return index
+
+
+# maps key -> pools -> targets (by domain and region) for every config/win*.yaml in the working tree.
+# the index is parsed once and cached on disk, keyed by a hash of the contents of every key config.
+@cached(cache, lock=cacheLock)
+def getConfigIndex():
+    contents = {}
+    for configPath in sorted(glob.glob(os.path.join(repositoryPath, 'config', 'win*.yaml'))):
+        with open(configPath, 'rb') as stream:
+            contents[os.path.splitext(os.path.basename(configPath))[0]] = stream.read()
+    indexHash = hashlib.sha256('v{}'.format(configIndexVersion).encode())
+    for key, keyContents in contents.items():
+        indexHash.update(key.encode() + b'\0' + hashlib.sha256(keyContents).digest())
+    indexFile = '{}.pickle'.format(indexHash.hexdigest())
+    cachedIndex = readCacheFile('config-index', indexFile)
+    if cachedIndex is not None:
+        try:
+            return pickle.loads(cachedIndex)
+        except Exception:
+            print('warn: discarding unreadable cached config index: {}'.format(indexFile))
+    index = buildConfigIndex({ key: loadYaml(keyContents) for key, keyContents in contents.items() })
+    writeCacheFile(pickle.dumps(index), 'config-index', indexFile)
+    return index
+
+
+azureClientClasses = {
+    'compute': ('azure.mgmt.compute', 'ComputeManagementClient'),
+    'network': ('azure.mgmt.network', 'NetworkManagementClient'),
+    'resource': ('azure.mgmt.resource', 'ResourceManagementClient')
+}
+
+
+@functools.lru_cache()
+def getAzureCredential(tenantId, clientId, clientSecret):
+    from azure.identity import ClientSecretCredential
+    return ClientSecretCredential(tenant_id=tenantId, client_id=clientId, client_secret=clientSecret)
+
+
+# the azure sdk is slow to import, so it is only imported when a client is created
+def createAzureClient(clientType, azureSecret):
+    moduleName, className = azureClientClasses[clientType]
+    clientClass = getattr(importlib.import_module(moduleName), className)
+    return clientClass(getAzureCredential(azureSecret['account'], azureSecret['id'], azureSecret['key']), azureSecret['subscription'])
+
+
+# defers construction of a client (and any secret fetch or sdk import it needs) until the first attribute access
+class LazyClient:
+    def __init__(self, factory):
+        self.factory = factory
+        self.client = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.client is None:
+                self.client = self.factory()
+        return self.client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+# a github api client shared by every caller in a process. connections are pooled and kept alive, responses are cached
+# on disk (under CIB_CACHE_DIR, so the cache survives across tasks on the same worker) and revalidated with
+# If-None-Match, since conditional requests answered with 304 do not count against the rate limit. responses for full
+# commit shas are immutable and are served from the cache without revalidation. GITHUB_TOKEN is used when set.
+class GitHubClient:
+    def __init__(self, token=None, maxRateLimitWaitSeconds=900, retries=3, poolSize=8):
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({ 'Accept': 'application/vnd.github.v3+json', 'User-Agent': 'mozilla-platform-ops/cloud-image-builder' })
+        if token:
+            self.session.headers['Authorization'] = 'token {}'.format(token)
+        self.maxRateLimitWaitSeconds = maxRateLimitWaitSeconds
+        self.retries = retries
+
+    def getCacheParts(self, url):
+        urlHash = hashlib.sha256(url.encode()).hexdigest()
+        return ('github', urlHash[0:2], '{}.json'.format(urlHash))
+
+    def getRateLimitWait(self, response):
+        if 'Retry-After' in response.headers:
+            return int(response.headers['Retry-After'])
+        if response.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset' in response.headers:
+            return max(0, int(response.headers['X-RateLimit-Reset']) - int(time.time())) + 1
+        return None
+
+    # returns the decoded body and the url of the next page (or None) for a url, raising requests.HTTPError on failure
+    def getPage(self, url, operation, immutable=False):
+        cacheParts = self.getCacheParts(url)
+        cachedResponse = readCacheFile(*cacheParts)
+        try:
+            cachedResponse = json.loads(cachedResponse) if cachedResponse is not None else None
+        except ValueError:
+            cachedResponse = None
+        if cachedResponse is not None and immutable:
+            return cachedResponse['body'], cachedResponse['next']
+        headers = { 'If-None-Match': cachedResponse['etag'] } if cachedResponse is not None and cachedResponse.get('etag') else {}
+        for attempt in range(1, self.retries + 1):
+            with outboundCall('github-api', operation):
+                response = self.session.get(url, headers=headers)
+            if response.status_code == 304:
+                return cachedResponse['body'], cachedResponse['next']
+            wait = self.getRateLimitWait(response) if response.status_code in [403, 429] else None
+            if wait is None or wait > self.maxRateLimitWaitSeconds or attempt == self.retries:
+                break
+            print('info: github api rate limit reached on: {}, retrying in {} seconds (attempt {}/{})'.format(url, wait, attempt, self.retries))
+            time.sleep(wait)
+        response.raise_for_status()
+        body = response.json()
+        nextUrl = response.links.get('next', {}).get('url')
+        writeCacheFile(json.dumps({ 'etag': response.headers.get('ETag'), 'next': nextUrl, 'body': body }).encode(), *cacheParts)
+        return body, nextUrl
+
+    # lazily yields the items of a paginated collection, fetching each page only when the previous one is exhausted
+    def paginate(self, path, operation, perPage=100):
+        url = 'https://api.github.com/{}?per_page={}'.format(path, perPage)
+        while url is not None:
+            items, url = self.getPage(url, operation)
+            yield from items
+
+    def getCommits(self, org, repo):
+        return self.paginate('repos/{}/{}/commits'.format(org, repo), 'commits')
+
+    def getCommit(self, org, repo, revision):
+        body, _ = self.getPage('https://api.github.com/repos/{}/{}/commits/{}'.format(org, repo, revision), 'commit', immutable=(len(revision) == 40))
+        return body
+
+
+@functools.lru_cache(maxsize=None)
+def getGitHubClient():
+    return GitHubClient(token=os.getenv('GITHUB_TOKEN'))
+
+
+metricsLock = threading.Lock()
+metrics = { 'phases': {}, 'calls': {} }
+
+
+def updateTimingEntry(entry, started, finished, failed):
+    entry['count'] += 1
+    entry['failures'] += 1 if failed else 0
+    entry['seconds'] += finished - started
+    entry['maxSeconds'] = max(entry['maxSeconds'], finished - started)
+    entry['started'] = min(entry['started'], started) if 'started' in entry else started
+    entry['finished'] = max(entry['finished'], finished) if 'finished' in entry else finished
+
+
+def newTimingEntry():
+    return { 'count': 0, 'failures': 0, 'seconds': 0.0, 'maxSeconds': 0.0 }
+
+
+# phases may run concurrently on several threads, so each entry records both the summed duration and the wall clock window
+@contextlib.contextmanager
+def phase(name):
+    started = time.time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        with metricsLock:
+            updateTimingEntry(metrics['phases'].setdefault(name, newTimingEntry()), started, time.time(), failed)
+
+
+# a stdout that writes to the calling thread's buffer, when it has one, and to the underlying stream otherwise. installed
+# on first use of bufferedOutput.
+class ThreadBufferedOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+threadBufferedOutputLock = threading.Lock()
+
+
+# holds back what the calling thread prints until the block completes, so that work running concurrently on a thread
+# pool does not interleave its log lines. other threads print as usual.
+@contextlib.contextmanager
+def bufferedOutput():
+    with threadBufferedOutputLock:
+        if not isinstance(sys.stdout, ThreadBufferedOutput):
+            sys.stdout = ThreadBufferedOutput(sys.stdout)
+        output = sys.stdout
+    previous = getattr(output.local, 'buffer', None)
+    output.local.buffer = io.StringIO()
+    try:
+        yield output.local.buffer
+    finally:
+        output.local.buffer = previous
+
+
+BufferedResult = collections.namedtuple('BufferedResult', ['value', 'exception', 'output'])
+
+
+# calls a function (typically on a pool thread) with its printed output buffered. getBufferedResult then prints the
+# output and returns the value (or raises the exception) on the thread that collects the results, in the order it
+# collects them.
+def callWithBufferedOutput(function, *args, **kwargs):
+    with bufferedOutput() as output:
+        try:
+            value, exception = function(*args, **kwargs), None
+        except Exception as e:
+            value, exception = None, e
+    return BufferedResult(value, exception, output.getvalue())
+
+
+def getBufferedResult(future):
+    result = future.result()
+    sys.stdout.write(result.output)
+    if result.exception is not None:
+        raise result.exception
+    return result.value
+
+
+@contextlib.contextmanager
+def outboundCall(service, operation):
+    started = time.time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        finished = time.time()
+        with metricsLock:
+            serviceEntry = metrics['calls'].setdefault(service, dict(newTimingEntry(), operations={}))
+            updateTimingEntry(serviceEntry, started, finished, failed)
+            updateTimingEntry(serviceEntry['operations'].setdefault(operation, newTimingEntry()), started, finished, failed)
+
+
+# wraps a taskcluster or azure client so that every method call is counted and timed as an outbound call to the given service
+class InstrumentedClient:
+    def __init__(self, client, service, path=None):
+        self.client = client
+        self.service = service
+        self.path = path
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        operation = name if self.path is None else '{}.{}'.format(self.path, name)
+        if callable(attribute):
+            def call(*args, **kwargs):
+                with outboundCall(self.service, operation):
+                    result = attribute(*args, **kwargs)
+                    # azure list operations page lazily, so pages are fetched inside the timed call
+                    return list(result) if hasattr(result, 'by_page') else result
+            return call
+        if attribute is None or isinstance(attribute, (str, bytes, int, float, bool, dict, list, tuple)):
+            return attribute
+        return InstrumentedClient(attribute, self.service, operation)
+
+
+def getMetrics():
+    with metricsLock:
+        return json.loads(json.dumps(metrics))
+
+
+def writeMetrics(path):
+    snapshot = getMetrics()
+    for entry in list(snapshot['phases'].values()) + list(snapshot['calls'].values()):
+        entry['wallSeconds'] = entry['finished'] - entry['started']
+    with open(path, 'w') as file:
+        json.dump(snapshot, file, indent=2, sort_keys=True)
+    print('info: metrics written to: {}'.format(path))
+    for name, entry in snapshot['phases'].items():
+        print('info: phase: {}, wall time: {:.2f}s, total time: {:.2f}s, count: {}'.format(name, entry['wallSeconds'], entry['seconds'], entry['count']))
+    for service, entry in sorted(snapshot['calls'].items()):
+        print('info: outbound calls to: {}, count: {}, failures: {}, total time: {:.2f}s'.format(service, entry['count'], entry['failures'], entry['seconds']))
+
+
+def writeMetricsOnExit(path):
+    atexit.register(writeMetrics, path)
+
+
+# the description is regenerated (with a timestamp) on every run and has no effect on workers, so only these fields are
+# compared when deciding whether a worker pool definition has changed
+workerPoolFunctionalKeys = ['providerId', 'owner', 'emailOnError', 'config']
+
+
+def getFunctionalWorkerPoolDefinition(definition):
+    def canonicalise(value):
+        if isinstance(value, dict):
+            return { k: canonicalise(v) for k, v in value.items() if v is not None }
+        if isinstance(value, list):
+            return [canonicalise(v) for v in value]
+        return value
+    functionalDefinition = canonicalise({ key: definition.get(key) for key in workerPoolFunctionalKeys })
+    # the generic-worker deploymentId is the cib revision that generated the config. it is only significant (it recycles
+    # running workers) when it accompanies another change, so it is ignored here and updated along with that change.
+    for launchConfig in (functionalDefinition.get('config') or {}).get('launchConfigs', []):
+        launchConfig.get('workerConfig', {}).get('genericWorker', {}).get('config', {}).pop('deploymentId', None)
+    return functionalDefinition
+
+
+def getDefinitionChanges(previous, current, path=''):
+    if isinstance(previous, dict) and isinstance(current, dict):
+        return [change for key in sorted(set(previous) | set(current)) for change in getDefinitionChanges(previous.get(key), current.get(key), '{}.{}'.format(path, key) if path else key)]
+    if isinstance(previous, list) and isinstance(current, list) and len(previous) == len(current):
+        return [change for i, (p, c) in enumerate(zip(previous, current)) for change in getDefinitionChanges(p, c, '{}[{}]'.format(path, i))]
+    return [] if previous == current else [path]
 
 
 def updateWorkerPool(workerManager, configPath, workerPoolId):
     with open(configPath, 'r') as stream:
-        payload = yaml.safe_load(stream)
+        payload = loadYaml(stream)
         try:
-            workerManager.workerPool(workerPoolId=workerPoolId)
+            workerPool = workerManager.workerPool(workerPoolId=workerPoolId)
             print('info: worker pool {} existence detected'.format(
                 workerPoolId))
-            workerManager.updateWorkerPool(workerPoolId, payload)
-            print('info: worker pool {} updated'.format(workerPoolId))
         except taskcluster.exceptions.TaskclusterRestFailure as tcRestFailure:
             if tcRestFailure.status_code == 404:
                 print('info: worker pool {} absence detected'.format(
                     workerPoolId))
                 workerManager.createWorkerPool(workerPoolId, payload)
                 print('info: worker pool {} created'.format(workerPoolId))
+                return None
+            else:
+                raise
+        # every update makes worker-manager treat the pool as changed, so updates that would only change cosmetic fields are skipped
+        previousDefinition = getFunctionalWorkerPoolDefinition(workerPool)
+        currentDefinition = getFunctionalWorkerPoolDefinition(payload)
+        if getDigest(previousDefinition) == getDigest(currentDefinition):
+            print('info: worker pool {} functional config is unchanged (digest: {}). update skipped'.format(workerPoolId, getDigest(currentDefinition)[0:12]))
+            return []
+        changes = getDefinitionChanges(previousDefinition, currentDefinition)
+        print('info: worker pool {} functional config changes detected in: {}'.format(workerPoolId, ', '.join(changes)))
+        workerManager.updateWorkerPool(workerPoolId, payload)
+        print('info: worker pool {} updated'.format(workerPoolId))
+        return changes
+
+
+# the role granted to decision tasks on the main branch, and the role granted to the workers of each pool
+branchRoleIds = {
+    'branch-main': 'repo:github.com/mozilla-platform-ops/cloud-image-builder:branch:main'
+}
+
+
+# paths that differ between a declared definition and a live one. only the keys that are declared are compared, so
+# fields that taskcluster adds (created, lastModified, expandedScopes, default values) are not reported. scope lists
+# are compared as sets, since taskcluster normalises their order.
+def getDesiredStateChanges(desired, live, path=''):
+    if isinstance(desired, dict) and isinstance(live, dict):
+        return [change for key in sorted(desired) for change in getDesiredStateChanges(desired[key], live.get(key), '{}.{}'.format(path, key) if path else key)]
+    if path.split('.')[-1] == 'scopes' and isinstance(desired, list) and isinstance(live, list):
+        return [] if set(desired) == set(live) else [path]
+    if isinstance(desired, list) and isinstance(live, list) and len(desired) == len(live):
+        return [change for i, (d, l) in enumerate(zip(desired, live)) for change in getDesiredStateChanges(d, l, '{}[{}]'.format(path, i))]
+    return [] if desired == live else [path or '(definition)']
+
+
+# reconciles the roles, hooks and clients declared under ci/config/{role,hook,client} with taskcluster.
+# definitions that apply to all environments live directly under the kind directory, others under an environment
+# directory (production or staging). live state is fetched concurrently, compared with the declarations and only the
+# resources that differ are written, also concurrently. clients are never created, since their access token would be lost.
+#
+# the credentials that run the reconciler may not hold the scopes to read or write every hook and client (eg:
+# auth:update-client). a hook or client that taskcluster refuses (403) is skipped with a warning, so that its drift is
+# still reported without failing the roles that can be applied. a refused role is a failure, as it always was.
+class ConfigReconciler:
+    def __init__(self, auth, hooks, environment, configPath=os.path.join(repositoryPath, 'ci', 'config'), maxWorkers=8):
+        self.auth = auth
+        self.hooks = hooks
+        self.environment = environment
+        self.configPath = configPath
+        self.maxWorkers = maxWorkers
+        self.lock = threading.Lock()
+        self.hookGroupIds = None
+        self.clientIds = {}
+
+    def getResourceName(self, kind, path):
+        name = os.path.relpath(path, os.path.join(self.configPath, kind))[:-len('.yaml')]
+        environmentPrefix = '{}/'.format(self.environment)
+        if name.startswith(environmentPrefix):
+            return name[len(environmentPrefix):]
+        return None if name.startswith('production/') or name.startswith('staging/') else name
+
+    def loadResources(self):
+        resources = []
+        for kind in ['role', 'hook', 'client']:
+            for path in sorted(glob.glob(os.path.join(self.configPath, kind, '**', '*.yaml'), recursive=True)):
+                name = self.getResourceName(kind, path)
+                if name is not None:
+                    with open(path, 'r') as stream:
+                        resources.append({ 'kind': kind, 'name': name, 'path': os.path.relpath(path, repositoryPath), 'definition': loadYaml(stream) })
+        return resources
+
+    def resolveRoleId(self, name):
+        return branchRoleIds.get(name, 'worker-pool:{}'.format(name))
+
+    # hook files are named {hookGroupId}-{hookId}; the existing hook groups disambiguate where the group id ends
+    def resolveHookId(self, name):
+        with self.lock:
+            if self.hookGroupIds is None:
+                self.hookGroupIds = sorted(self.hooks.listHookGroups()['groups'], key=len, reverse=True)
+        hookGroupId = next((g for g in self.hookGroupIds if name.startswith('{}-'.format(g))), '-'.join(name.split('-')[0:2]))
+        return hookGroupId, name[len(hookGroupId) + 1:]
+
+    # client files are named after the client id with slashes replaced by dashes (eg: project-relops-image-builder-dev)
+    def resolveClientId(self, name):
+        prefix = '{}/'.format('/'.join(name.split('-')[0:2]))
+        with self.lock:
+            if prefix not in self.clientIds:
+                clientIds = []
+                query = { 'prefix': prefix }
+                while True:
+                    response = self.auth.listClients(query=query)
+                    clientIds += [client['clientId'] for client in response['clients']]
+                    if not response.get('continuationToken'):
+                        break
+                    query['continuationToken'] = response['continuationToken']
+                self.clientIds[prefix] = clientIds
+        return next((clientId for clientId in self.clientIds[prefix] if clientId.replace('/', '-') == name), None)
+
+    def fetch(self, resource):
+        kind = resource['kind']
+        resource['id'] = None
+        try:
+            if kind == 'role':
+                resource['id'] = self.resolveRoleId(resource['name'])
+                resource['live'] = self.auth.role(resource['id'])
+            elif kind == 'hook':
+                resource['id'] = self.resolveHookId(resource['name'])
+                resource['live'] = self.hooks.hook(*resource['id'])
             else:
+                resource['id'] = self.resolveClientId(resource['name'])
+                resource['live'] = { 'scopes': self.auth.client(resource['id'])['scopes'] } if resource['id'] is not None else None
+        except taskcluster.exceptions.TaskclusterRestFailure as tcRestFailure:
+            if tcRestFailure.status_code == 403 and kind != 'role':
+                print('warn: {} {} could not be read and will be skipped. {}'.format(kind, self.getDisplayId(resource), tcRestFailure))
+                resource['forbidden'] = True
+            elif tcRestFailure.status_code != 404:
                 raise
+            resource['live'] = None
+        return resource
 
+    def getDesiredState(self, resource):
+        # client files declare only the scope list
+        return { 'scopes': resource['definition'] } if resource['kind'] == 'client' else resource['definition']
+
+    def plan(self):
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            resources = list(executor.map(self.fetch, self.loadResources()))
+        for resource in resources:
+            if resource.get('forbidden'):
+                resource['action'] = 'skip'
+                resource['changes'] = []
+            elif resource['live'] is None:
+                resource['action'] = 'error' if resource['kind'] == 'client' else 'create'
+                resource['changes'] = []
+            else:
+                resource['changes'] = getDesiredStateChanges(self.getDesiredState(resource), resource['live'])
+                resource['action'] = 'update' if resource['changes'] else 'none'
+        return resources
 
-def createTask(
-        queue,
-        taskId,
+    def getDisplayId(self, resource):
+        return '/'.join(resource['id']) if isinstance(resource['id'], tuple) else resource['id'] or resource['name']
+
+    def applyResource(self, resource):
+        kind, action, resourceId = resource['kind'], resource['action'], resource['id']
+        if kind == 'role':
+            (self.auth.createRole if action == 'create' else self.auth.updateRole)(resourceId, resource['definition'])
+        elif kind == 'hook':
+            (self.hooks.createHook if action == 'create' else self.hooks.updateHook)(*resourceId, resource['definition'])
+        else:
+            client = self.auth.client(resourceId)
+            self.auth.updateClient(resourceId, {
+                'description': client['description'],
+                'expires': client['expires'],
+                'deleteOnExpiration': client.get('deleteOnExpiration', False),
+                'scopes': resource['definition']
+            })
+
+    # returns the planned resources, each with the outcome of its change (or None when no change was needed)
+    def reconcile(self):
+        resources = self.plan()
+        for resource in resources:
+            resourceId = self.getDisplayId(resource)
+            if resource['action'] == 'none':
+                print('info: {} {} is up to date ({})'.format(resource['kind'], resourceId, resource['path']))
+            elif resource['action'] == 'error':
+                print('error: {} {} does not exist and will not be created ({})'.format(resource['kind'], resourceId, resource['path']))
+            elif resource['action'] != 'skip':
+                print('info: {} {} will be {}d ({}){}'.format(resource['kind'], resourceId, resource['action'], resource['path'], '. changes in: {}'.format(', '.join(resource['changes'])) if resource['changes'] else ''))
+        changedResources = [resource for resource in resources if resource['action'] in ['create', 'update']]
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = { executor.submit(self.applyResource, resource): resource for resource in changedResources }
+        for future, resource in futures.items():
+            exception = future.exception()
+            if exception is None:
+                resource['outcome'] = '{}d'.format(resource['action'])
+                print('info: {} {} {}'.format(resource['kind'], self.getDisplayId(resource), resource['outcome']))
+            elif resource['kind'] != 'role' and isinstance(exception, taskcluster.exceptions.TaskclusterRestFailure) and exception.status_code == 403:
+                resource['outcome'] = 'skipped'
+                print('warn: {} {} was not {}d, the reconciler lacks the scopes to write it. {}'.format(resource['kind'], self.getDisplayId(resource), resource['action'], exception))
+            else:
+                resource['outcome'] = 'failed'
+                print('error: failed to {} {} {}. {}'.format(resource['action'], resource['kind'], self.getDisplayId(resource), exception))
+        for resource in resources:
+            resource.setdefault('outcome', { 'error': 'failed', 'skip': 'skipped' }.get(resource['action']))
+        return resources
+
+
+def getTaskDefinition(
         taskName,
         taskDescription,
         provisioner,
@@ -122,23 +822,350 @@ def createTask(
         payload['payload']['onExitStatus'] = {
             'retry': retriggerOnExitCodes
         }
+    return payload
 
+
+def createTask(queue, taskId, **kwargs):
+    payload = getTaskDefinition(**kwargs)
     queue.createTask(taskId, payload)
     print('info: task {} ({}: {}), created with priority: {}'.format(
-        taskId, taskName, taskDescription, priority))
+        taskId, payload['metadata']['name'], payload['metadata']['description'], payload['priority']))
+
 
+def isTransientFailure(exception):
+    if isinstance(exception, taskcluster.exceptions.TaskclusterConnectionError):
+        return True
+    if isinstance(exception, taskcluster.exceptions.TaskclusterRestFailure):
+        return exception.status_code is None or exception.status_code == 429 or exception.status_code >= 500
+    return False
+
+
+# collects task definitions, validates the dependency graph and submits it in topological waves.
+# createTask is idempotent for an identical definition, so retrying a submission with an ambiguous outcome is safe.
+class TaskGraph:
+    def __init__(self, queue, maxWorkers=8, retries=5, retryDelaySeconds=2, externalDependencies=[], cancelOnFailure=True):
+        self.queue = queue
+        self.maxWorkers = maxWorkers
+        self.retries = retries
+        self.retryDelaySeconds = retryDelaySeconds
+        self.externalDependencies = set(externalDependencies)
+        self.cancelOnFailure = cancelOnFailure
+        self.tasks = {}
+
+    def addTask(self, taskId, **kwargs):
+        if taskId in self.tasks:
+            raise ValueError('task {} is already in the task graph'.format(taskId))
+        self.tasks[taskId] = getTaskDefinition(**kwargs)
+        return taskId
+
+    def getWaves(self):
+        missingDependencies = sorted({
+            dependency for payload in self.tasks.values() for dependency in payload['dependencies']
+            if dependency not in self.tasks and dependency not in self.externalDependencies
+        })
+        if missingDependencies:
+            raise ValueError('task graph has dependencies on unknown tasks: {}'.format(', '.join(missingDependencies)))
+        pendingDependencies = { taskId: set(d for d in payload['dependencies'] if d in self.tasks) for taskId, payload in self.tasks.items() }
+        waves = []
+        while pendingDependencies:
+            wave = [taskId for taskId, dependencies in pendingDependencies.items() if not dependencies]
+            if not wave:
+                raise ValueError('task graph has a dependency cycle between tasks: {}'.format(', '.join(sorted(pendingDependencies))))
+            waves.append(wave)
+            for taskId in wave:
+                del pendingDependencies[taskId]
+            for dependencies in pendingDependencies.values():
+                dependencies.difference_update(wave)
+        return waves
+
+    def submitTask(self, taskId):
+        payload = self.tasks[taskId]
+        for attempt in range(1, self.retries + 1):
+            try:
+                self.queue.createTask(taskId, payload)
+                print('info: task {} ({}: {}), created with priority: {}'.format(
+                    taskId, payload['metadata']['name'], payload['metadata']['description'], payload['priority']))
+                return taskId
+            except Exception as e:
+                if attempt == self.retries or not isTransientFailure(e):
+                    raise
+                retryDelay = self.retryDelaySeconds * (2 ** (attempt - 1))
+                print('warn: task {} creation attempt {} of {} failed, retrying in {} seconds. {}'.format(taskId, attempt, self.retries, retryDelay, e))
+                time.sleep(retryDelay)
+
+    def cancelTasks(self, taskIds):
+        def cancelTask(taskId):
+            try:
+                self.queue.cancelTask(taskId)
+                print('info: task {} cancelled'.format(taskId))
+            except Exception as e:
+                print('warn: failed to cancel task {}. {}'.format(taskId, e))
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            list(executor.map(cancelTask, taskIds))
+
+    def submit(self):
+        # validate the whole graph before anything is submitted
+        waves = self.getWaves()
+        createdTaskIds = []
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            for waveIndex, wave in enumerate(waves):
+                print('info: submitting task graph wave {} of {} ({} tasks)'.format(waveIndex + 1, len(waves), len(wave)))
+                futures = { taskId: executor.submit(self.submitTask, taskId) for taskId in wave }
+                failures = {}
+                for taskId, future in futures.items():
+                    try:
+                        createdTaskIds.append(future.result())
+                    except Exception as e:
+                        failures[taskId] = e
+                if failures:
+                    for taskId, e in failures.items():
+                        print('error: task {} ({}) creation failed. {}'.format(taskId, self.tasks[taskId]['metadata']['name'], e))
+                    if self.cancelOnFailure and createdTaskIds:
+                        print('info: cancelling {} tasks created before the failure'.format(len(createdTaskIds)))
+                        self.cancelTasks(createdTaskIds)
+                    raise RuntimeError('task graph submission failed in wave {} of {}, for {} of {} tasks'.format(waveIndex + 1, len(waves), len(failures), len(wave)))
+        return createdTaskIds
+
+
+def sharedConfigEntryApplies(sharedKey, entry, platform, image):
+    # entries without a (complete) target block are treated as applicable, so that a malformed entry can only cause a
+    # rebuild, never hide a change
+    target = entry.get('target') if isinstance(entry, dict) else None
+    if not isinstance(target, dict):
+        return True
+    values = {
+        'cloud': platform,
+        'os': image.get('os'),
+        'architecture': image.get('architecture'),
+        'gpu': image.get('gpu')
+    }
+    return all(not isinstance(target.get(targetKey), list) or values[targetKey] in target[targetKey] for targetKey in sharedConfigTargetKeys[sharedKey])
+
+
+def getEffectiveSharedConfig(revision, sharedKey, platform, image):
+    return [entry for entry in (getConfig(revision, sharedKey) or []) if sharedConfigEntryApplies(sharedKey, entry, platform, image)]
+
+
+def getDigest(inputs):
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, separators=(',', ':'), default=str).encode()).hexdigest()
+
+
+def getDiskImageInputs(revision, key, platform):
+    config = getConfig(revision, key)
+    return {
+        'platform': platform,
+        'image': config['image'],
+        'iso': config['iso'],
+        'shared': { sharedKey: getDigest(getEffectiveSharedConfig(revision, sharedKey, platform, config['image'])) for sharedKey in sharedConfigKeys }
+    }
+
+
+def getMachineImageInputs(revision, key, group):
+    targetGroupConfig = next((t for t in getConfig(revision, key)['target'] if t['group'] == group), None)
+    if targetGroupConfig is None:
+        return None
+    return {
+        'bootstrap': targetGroupConfig['bootstrap'] if 'bootstrap' in targetGroupConfig else None,
+        'tag': { tagKey: next((tag for tag in targetGroupConfig['tag'] if tag['name'] == tagKey), { 'value': '' })['value'] for tagKey in machineImageTagKeys }
+    }
+
+
+def getDiskImageDigest(revision, key, platform):
+    return getDigest(getDiskImageInputs(revision, key, platform))
+
+
+def getMachineImageDigest(revision, key, group):
+    return getDigest(getMachineImageInputs(revision, key, group))
+
+
+def getImageIndexNamespace(platform, key, group=None):
+    return 'project.relops.cloud-image-builder.{}.{}latest'.format(platform, '{}.{}.'.format(group, key) if group is not None else '{}.'.format(key))
+
+
+def getImageArtifactDescriptorUrl(platform, key, group=None):
+    return '{}/api/index/v1/task/{}/artifacts/public/image-bucket-resource.json'.format(
+        os.environ['TASKCLUSTER_ROOT_URL'], getImageIndexNamespace(platform, key, group))
+
+
+def getImageArtifactDescriptor(platform, key, group=None):
+    if fixtures is not None:
+        # a namespace without a fixture is not indexed, as the index would answer
+        if getImageIndexNamespace(platform, key, group) not in fixtures.get('artifacts', {}):
+            raise urllib.error.HTTPError(getImageArtifactDescriptorUrl(platform, key, group), 404, 'no fixture for index path: {}'.format(getImageIndexNamespace(platform, key, group)), None, None)
+        return copy.deepcopy(fixtures['artifacts'][getImageIndexNamespace(platform, key, group)])
+    with outboundCall('taskcluster-index', 'findArtifactFromTask'):
+        contents = urllib.request.urlopen(getImageArtifactDescriptorUrl(platform, key, group)).read()
+    return json.loads(gzip.decompress(contents).decode('utf-8-sig'))
+
+
+# an include or exclude directive from a commit message (eg: "exclude regions: westus, westus2")
+DirectiveFilter = collections.namedtuple('DirectiveFilter', ['mode', 'values'])
+
+
+# the ci directives of a commit message, parsed once by the decision task and passed to the tasks it creates.
+# noCI lists the ci systems (taskcluster, travis) that the commit disables. environments, keys, pools and regions are each
+# a DirectiveFilter or None when the commit does not narrow that dimension.
+class CommitDirectives(collections.namedtuple('CommitDirectives', [
+        'sha', 'message', 'noCI', 'poolDeploy', 'overwriteDiskImage', 'overwriteMachineImage', 'disableCleanup',
+        'enableSnapshotCopy', 'purgeTaskclusterResources', 'skipImageVerification', 'environments', 'keys', 'pools', 'regions'])):
+
+    def skips(self, ciSystem):
+        return ciSystem in self.noCI
+
+    def filter(self, dimension, values):
+        directiveFilter = getattr(self, dimension)
+        if directiveFilter is None:
+            return list(values)
+        if directiveFilter.mode == 'include':
+            return list(directiveFilter.values)
+        return [value for value in values if value not in directiveFilter.values]
+
+    def describe(self, dimension):
+        directiveFilter = getattr(self, dimension)
+        return None if directiveFilter is None else '**{} {}** commit syntax detected'.format(directiveFilter.mode, dimension)
+
+    def asDict(self):
+        return { field: (value._asdict() if isinstance(value, DirectiveFilter) else value) for field, value in self._asdict().items() }
+
+    @classmethod
+    def fromDict(cls, document):
+        commitDirectives = cls(**{ field: document.get(field) for field in cls._fields })
+        return commitDirectives._replace(noCI=tuple(commitDirectives.noCI or []), **{
+            dimension: DirectiveFilter(document[dimension]['mode'], tuple(document[dimension]['values'])) for dimension in directiveFilterDimensions if document.get(dimension) is not None
+        })
+
+
+directiveFilterDimensions = ['environments', 'keys', 'pools', 'regions']
+noCIDirectives = {
+    'no-ci': ['taskcluster', 'travis'],
+    'no-taskcluster-ci': ['taskcluster'],
+    'no-travis-ci': ['travis']
+}
+
+
+def parseDirectiveFilter(lines, dimension):
+    for mode in ['include', 'exclude']:
+        prefix = '{} {}:'.format(mode, dimension)
+        line = next((line for line in lines if line.lower().startswith(prefix)), None)
+        if line is not None:
+            return DirectiveFilter(mode, tuple(value.lower().strip() for value in line[len(prefix):].split(',')))
+    return None
+
+
+def parseCommitDirectives(sha, message):
+    lines = message.splitlines()
+    directives = set(line.lower().strip() for line in lines)
+    keys = parseDirectiveFilter(lines, 'keys')
+    return CommitDirectives(
+        sha=sha,
+        message=message,
+        noCI=tuple(sorted({ ciSystem for directive, ciSystems in noCIDirectives.items() if directive in directives for ciSystem in ciSystems })),
+        poolDeploy='pool-deploy' in directives,
+        overwriteDiskImage='overwrite-disk-image' in directives,
+        overwriteMachineImage='overwrite-machine-image' in directives,
+        disableCleanup='disable-cleanup' in directives,
+        enableSnapshotCopy='enable-snapshot-copy' in directives,
+        purgeTaskclusterResources='purge-taskcluster-resources' in directives,
+        skipImageVerification='no-verify' in directives,
+        environments=parseDirectiveFilter(lines, 'environments'),
+        keys=keys,
+        # key and pool directives are alternatives; a key directive takes precedence
+        pools=parseDirectiveFilter(lines, 'pools') if keys is None else None,
+        regions=parseDirectiveFilter(lines, 'regions'))
+
+
+def getCommitMessage(sha):
+    return getGitHubClient().getCommit('mozilla-platform-ops', 'cloud-image-builder', sha)['commit']['message']
+
+
+def writeCommitDirectives(commitDirectives, path):
+    with open(path, 'w') as file:
+        json.dump(commitDirectives.asDict(), file, indent=2)
+
+
+# tasks created by the decision task receive the directives it parsed in their environment (COMMIT_DIRECTIVES, see
+# getCommitDirectivesEnvironmentValue) rather than querying github themselves. tasks created elsewhere (eg: by
+# pool-deploy) fall back to parsing the commit message.
+def getCommitDirectives(sha):
+    document = os.getenv('COMMIT_DIRECTIVES')
+    if document:
+        try:
+            commitDirectives = CommitDirectives.fromDict(json.loads(document))
+            if commitDirectives.sha == sha:
+                print('info: commit directives for sha: {} read from the task environment'.format(sha[0:7]))
+                return commitDirectives
+            print('warn: commit directives in the task environment describe sha: {}, not: {}'.format(commitDirectives.sha, sha))
+        except Exception as e:
+            print('warn: failed to read commit directives from the task environment. {}'.format(e))
+    return parseCommitDirectives(sha, getCommitMessage(sha))
+
+
+def getCommitDirectivesEnvironmentValue(commitDirectives):
+    return json.dumps(commitDirectives.asDict(), sort_keys=True, separators=(',', ':'))
+
+
+DecisionContext = collections.namedtuple('DecisionContext', ['scopes', 'imageArtifactDescriptors', 'machineImageArtifactDescriptors'])
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return types.MappingProxyType({ k: freeze(v) for k, v in value.items() })
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+# fetches the remote state shared by every target group of a key (and the scopes shared by every pool) exactly once per
+# decision run, along with the group specific artifact descriptor of each (platform, key, group) machine image target.
+# a target whose group has no indexed machine image build has a descriptor of None. a target whose descriptor could not
+# be fetched is left unfetched, so that machineImageManifestHasChanged retries it (and treats it as changed if it fails).
+def getDecisionContext(auth, platforms, keys, machineImageTargets=(), maxWorkers=8):
+    def fetchImageArtifactDescriptor(platform, key):
+        try:
+            imageArtifactDescriptor = freeze(getImageArtifactDescriptor(platform, key))
+            print('debug: image artifact descriptor for {} {} fetched from: {}'.format(platform, key, getImageArtifactDescriptorUrl(platform, key)))
+            return imageArtifactDescriptor
+        except Exception as e:
+            print('warn: failed to fetch image artifact descriptor for {} {}. {}'.format(platform, key, e))
+            return None
+
+    def fetchMachineImageArtifactDescriptor(platform, key, group):
+        try:
+            return getMachineImageArtifactDescriptor(platform, key, group)
+        except Exception as e:
+            print('warn: failed to fetch machine image artifact descriptor for {} {}, in target group {}. {}'.format(platform, key, group, e))
+            return unfetched
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        scopesFuture = executor.submit(auth.currentScopes)
+        imageArtifactDescriptorFutures = { (platform, key): executor.submit(callWithBufferedOutput, fetchImageArtifactDescriptor, platform, key) for platform in platforms for key in keys }
+        machineImageArtifactDescriptorFutures = { target: executor.submit(callWithBufferedOutput, fetchMachineImageArtifactDescriptor, *target) for target in set(machineImageTargets) }
+        return DecisionContext(
+            scopes=frozenset(scopesFuture.result()['scopes']),
+            imageArtifactDescriptors=types.MappingProxyType({ combination: getBufferedResult(future) for combination, future in imageArtifactDescriptorFutures.items() }),
+            machineImageArtifactDescriptors=types.MappingProxyType({ target: getBufferedResult(future) for target, future in machineImageArtifactDescriptorFutures.items() }))
 
-def diskImageManifestHasChanged(platform, key, currentRevision):
+
+def diskImageManifestHasChanged(platform, key, currentRevision, previousImageArtifactDescriptor=unfetched):
     try:
-        previousRevisionUrl = '{}/api/index/v1/task/project.relops.cloud-image-builder.{}.{}.latest/artifacts/public/image-bucket-resource.json'.format(  # noqa: E501
-            os.environ['TASKCLUSTER_ROOT_URL'], platform, key)
-        previousRevision = json.loads(
-            gzip.decompress(
-                urllib.request.urlopen(previousRevisionUrl).read()
-            ).decode('utf-8-sig'))['build']['revision']
+        previousRevisionUrl = getImageArtifactDescriptorUrl(platform, key)
+        if previousImageArtifactDescriptor is unfetched:
+            previousImageArtifactDescriptor = getImageArtifactDescriptor(platform, key)
+        previousRevision = previousImageArtifactDescriptor['build']['revision']
         print('debug: previous rev determined as: {}, using: {}'.format(
             previousRevision, previousRevisionUrl))
 
+        # artifacts from builds that recorded an input digest can be compared without loading the previous config. a
+        # digest mismatch may only mean that the previous digest was computed differently (eg: over whole shared files),
+        # so mismatches fall through to the comparison of effective configs below.
+        previousDigest = previousImageArtifactDescriptor['build'].get('digest', {}).get('disk')
+        if previousDigest:
+            currentDigest = getDiskImageDigest(currentRevision, key, platform)
+            if currentDigest == previousDigest:
+                print('info: no change detected for disk image inputs of {} between last image build in revision: {} (digest: {}) and current revision: {} (digest: {})'.format(
+                    key, previousRevision[0:7], previousDigest[0:12], currentRevision[0:7], currentDigest[0:12]))
+                return False
+
         currentConfig = getConfig(currentRevision, key)
         print('debug: current config for: {}, loaded from rev: {}'.format(
             key, currentRevision[0:7]))
@@ -167,23 +1194,61 @@ def diskImageManifestHasChanged(platform, key, currentRevision):
         isoConfigUnchanged = False
         print('info: change detected for iso definition in {}.yaml between last image build in revision: {} and current revision: {}'.format(key, previousRevision[0:7], currentRevision[0:7]))
 
-    # todo: parse shared config files for change specific to platform/key
-    for sharedFile in ['disable-windows-service', 'drivers', 'packages', 'unattend-commands']:
-        currentContents = urllib.request.urlopen('https://raw.githubusercontent.com/mozilla-platform-ops/cloud-image-builder/{}/config/{}.yaml'.format(currentRevision, sharedFile)).read().decode()
-        previousContents = urllib.request.urlopen('https://raw.githubusercontent.com/mozilla-platform-ops/cloud-image-builder/{}/config/{}.yaml'.format(previousRevision, sharedFile)).read().decode()
-        if currentContents == previousContents:
-            print('info: no change detected in {}.yaml between last image build in revision: {} and current revision: {}'.format(sharedFile, previousRevision[0:7], currentRevision[0:7]))
+    # shared config files are compared on the entries whose target (cloud, os, architecture, gpu) matches the image
+    # built from each revision, so changes to entries for other platforms or keys do not trigger a rebuild
+    for sharedFile in sharedConfigKeys:
+        try:
+            if getBlobId(currentRevision, 'config/{}.yaml'.format(sharedFile)) == getBlobId(previousRevision, 'config/{}.yaml'.format(sharedFile)) and currentConfig['image'] == previousConfig['image']:
+                currentEntries = previousEntries = None
+            else:
+                currentEntries = getEffectiveSharedConfig(currentRevision, sharedFile, platform, currentConfig['image'])
+                previousEntries = getEffectiveSharedConfig(previousRevision, sharedFile, platform, previousConfig['image'])
+        except:
+            print('error: failed to load comparable shared config: {}.yaml'.format(sharedFile))
+            return True
+        if currentEntries == previousEntries:
+            print('info: no change detected for {} entries in {}.yaml between last image build in revision: {} and current revision: {}'.format(key, sharedFile, previousRevision[0:7], currentRevision[0:7]))
         else:
             sharedFilesUnchanged = False
-            print('info: change detected for {}.yaml between last image build in revision: {} and current revision: {}'.format(sharedFile, previousRevision[0:7], currentRevision[0:7]))
+            print('info: change detected for {} entries in {}.yaml between last image build in revision: {} and current revision: {} ({} entries before, {} after)'.format(key, sharedFile, previousRevision[0:7], currentRevision[0:7], len(previousEntries), len(currentEntries)))
 
     return not (imageConfigUnchanged and isoConfigUnchanged and sharedFilesUnchanged)
 
 
-def machineImageManifestHasChanged(platform, key, currentRevision, group):
+# machine image builds publish their input digest under a group specific index path. a group without an indexed build
+# (the index answers 404) has no descriptor; any other failure is raised.
+def getMachineImageArtifactDescriptor(platform, key, group):
     try:
-        previousRevisionUrl = '{}/api/index/v1/task/project.relops.cloud-image-builder.{}.{}.latest/artifacts/public/image-bucket-resource.json'.format(os.environ['TASKCLUSTER_ROOT_URL'], platform, key)
-        previousRevision = json.loads(gzip.decompress(urllib.request.urlopen(previousRevisionUrl).read()).decode('utf-8-sig'))['build']['revision']
+        return freeze(getImageArtifactDescriptor(platform, key, group))
+    except urllib.error.HTTPError as httpError:
+        if httpError.code != 404:
+            raise
+        return None
+
+
+def machineImageManifestHasChanged(platform, key, currentRevision, group, previousImageArtifactDescriptor=unfetched, previousMachineImageArtifactDescriptor=unfetched):
+    if previousMachineImageArtifactDescriptor is unfetched:
+        try:
+            previousMachineImageArtifactDescriptor = getMachineImageArtifactDescriptor(platform, key, group)
+        except Exception as e:
+            print('error: failed to fetch machine image artifact descriptor for: {}, in target group {}. {}'.format(key, group, e))
+            return True
+    previousDigest = ((previousMachineImageArtifactDescriptor or {}).get('build') or {}).get('digest', {}).get('machine')
+    if previousDigest:
+        try:
+            currentDigest = getMachineImageDigest(currentRevision, key, group)
+        except:
+            print('error: failed to compute machine image digest for: {}, in target group {}'.format(key, group))
+            return True
+        print('info: {} detected for machine image inputs of target group {}, in {}.yaml between last machine image build (digest: {}) and current revision: {} (digest: {})'.format(
+            'no change' if currentDigest == previousDigest else 'change', group, key, previousDigest[0:12], currentRevision[0:7], currentDigest[0:12]))
+        return currentDigest != previousDigest
+
+    try:
+        previousRevisionUrl = getImageArtifactDescriptorUrl(platform, key)
+        if previousImageArtifactDescriptor is unfetched:
+            previousImageArtifactDescriptor = getImageArtifactDescriptor(platform, key)
+        previousRevision = previousImageArtifactDescriptor['build']['revision']
         print('debug: previous revision determined as: {}, using: {}'.format(previousRevision, previousRevisionUrl))
 
         currentConfig = getConfig(currentRevision, key)
@@ -216,7 +1281,7 @@ def machineImageManifestHasChanged(platform, key, currentRevision, group):
     else:
         print('info: no change detected in target group {}, for bootstrap execution commands definition in {}.yaml between last image build in revision: {} and current revision: {}'.format(group, key, previousRevision[0:7], currentRevision[0:7]))
 
-    for tagKey in ['workerType', 'sourceOrganisation', 'sourceRepository', 'sourceRevision', 'sourceScript', 'deploymentId']:
+    for tagKey in machineImageTagKeys:
         currentTagValue = next((tag for tag in currentTargetGroupConfig['tag'] if tag['name'] == tagKey), { 'value': '' })['value']
         previousTagValue = next((tag for tag in previousTargetGroupConfig['tag'] if tag['name'] == tagKey), { 'value': '' })['value']
         if currentTagValue == previousTagValue:
@@ -228,22 +1293,365 @@ def machineImageManifestHasChanged(platform, key, currentRevision, group):
     return not (targetBootstrapUnchanged and targetTagsUnchanged)
 
 
-def machineImageExists(taskclusterIndex, platformClient, platform, group, key):
-    artifact = taskclusterIndex.findArtifactFromTask(
-        'project.relops.cloud-image-builder.{}.{}.latest'.format(platform, key.replace('-{}'.format(platform), '')),
-        'public/image-bucket-resource.json')
-    image = None
+MachineImageName = collections.namedtuple('MachineImageName', ['group', 'key', 'diskSha', 'deploymentId'])
+machineImageNamePattern = re.compile(r'^(?P<key>.+)-(?P<diskSha>[a-f0-9]{7})-(?P<deploymentId>[a-z0-9]+)$')
+
+
+# machine images are named {group}-{key}-{diskSha}-{deploymentId}, where group omits the rg- prefix
+def parseMachineImageName(group, name):
+    prefix = '{}-'.format(group.replace('rg-', ''))
+    match = machineImageNamePattern.match(name[len(prefix):]) if name.startswith(prefix) else None
+    return MachineImageName(group, match.group('key'), match.group('diskSha'), match.group('deploymentId')) if match is not None else None
+
+
+# lists the machine images of each resource group once and answers existence and latest image queries from memory.
+# a group that could not be listed is recorded with its error, so that callers can tell an unknown answer (None) from
+# an image that does not exist (False).
+class ImageInventory:
+    def __init__(self, computeClient, retries=3, retryDelaySeconds=2):
+        self.computeClient = computeClient
+        self.retries = retries
+        self.retryDelaySeconds = retryDelaySeconds
+        self.groups = {}
+        self.lock = threading.Lock()
+        self.groupLocks = collections.defaultdict(threading.Lock)
+
+    def listGroup(self, group):
+        for attempt in range(1, self.retries + 1):
+            try:
+                return list(self.computeClient.images.list_by_resource_group(group)), None
+            except Exception as e:
+                print('warn: attempt {}/{} to list machine images in {} failed. {}'.format(attempt, self.retries, group, e))
+                error = e
+                if attempt < self.retries:
+                    time.sleep(self.retryDelaySeconds * attempt)
+        return [], error
+
+    def getGroup(self, group):
+        with self.lock:
+            groupLock = self.groupLocks[group]
+        with groupLock:
+            if group not in self.groups:
+                images, error = self.listGroup(group)
+                byKey = collections.defaultdict(list)
+                for image in images:
+                    imageName = parseMachineImageName(group, image.name)
+                    if imageName is not None:
+                        byKey[imageName.key].append((imageName, image))
+                # newest first, by the commit time of the cib revision that built the image
+                for keyImages in byKey.values():
+                    keyImages.sort(key=lambda i: (i[1].tags or {}).get('machineImageCommitTime', ''), reverse=True)
+                self.groups[group] = {
+                    'error': error,
+                    'byName': { image.name: image for image in images },
+                    'byKey': dict(byKey),
+                    'latestByKey': {
+                        key: next((image for _, image in keyImages if 'machineImageCommitTime' in (image.tags or {})), None)
+                        for key, keyImages in byKey.items()
+                    }
+                }
+            return self.groups[group]
+
+    def getError(self, group):
+        return self.getGroup(group)['error']
+
+    def getImage(self, group, name):
+        return self.getGroup(group)['byName'].get(name)
+
+    def findImages(self, group, key, diskSha=None, deploymentId=None):
+        return [image for imageName, image in self.getGroup(group)['byKey'].get(key, [])
+                if (diskSha is None or imageName.diskSha == diskSha) and (deploymentId is None or imageName.deploymentId == deploymentId)]
+
+    def exists(self, group, key, diskSha, deploymentId):
+        inventory = self.getGroup(group)
+        if inventory['error'] is not None:
+            return None
+        return len(self.findImages(group, key, diskSha, deploymentId)) > 0
+
+    # the newest image of a key that carries a machineImageCommitTime tag
+    def getLatestImage(self, group, key):
+        return self.getGroup(group)['latestByKey'].get(key)
+
+
+# whether a machine image built from the latest disk image (and, when given, the deploymentId) exists in the group: True
+# or False, or None when the group's images could not be listed. build-machine-image.ps1 names images with the first
+# seven characters of the deploymentId, so only those are compared.
+def machineImageExists(taskclusterIndex, platformClient, platform, group, key, artifact=unfetched, deploymentId=None, imageInventory=None):
+    if artifact is unfetched:
+        artifact = taskclusterIndex.findArtifactFromTask(
+            'project.relops.cloud-image-builder.{}.{}.latest'.format(platform, key.replace('-{}'.format(platform), '')),
+            'public/image-bucket-resource.json')
+    exists = False
     if platform == 'azure':
+        imageKey = key.replace('-{}'.format(platform), '')
         try:
-            imageName = '{}-{}-{}'.format(group.replace('rg-', ''), key.replace('-{}'.format(platform), ''), artifact['build']['revision'][0:7])
-            try:
-                image = platformClient.images.get(group, imageName)
-                print('info: {} machine image - {} found with id: {}'.format(platform, imageName, image.id))
-            except:
-                image = None
-                print('info: {} machine image - {} not found'.format(platform, imageName))
+            diskSha = artifact['build']['revision'][0:7]
         except:
-            image = None
-            print('debug: {} machine image - failed to determine latest image revision for {}-{}'.format(platform, group.replace('rg-', ''), key.replace('-{}'.format(platform), '')))
+            print('debug: {} machine image - failed to determine latest image revision for {}-{}'.format(platform, group.replace('rg-', ''), imageKey))
+            return False
+        imageInventory = imageInventory if imageInventory is not None else ImageInventory(platformClient)
+        deploymentId = deploymentId[0:7] if deploymentId is not None else None
+        imageName = '{}-{}-{}-{}'.format(group.replace('rg-', ''), imageKey, diskSha, deploymentId if deploymentId is not None else '*')
+        exists = imageInventory.exists(group, imageKey, diskSha, deploymentId)
+        if exists is None:
+            print('warn: {} machine image - {} could not be checked, listing images in {} failed. {}'.format(platform, imageName, group, imageInventory.getError(group)))
+        elif exists:
+            image = imageInventory.findImages(group, imageKey, diskSha, deploymentId)[0]
+            print('info: {} machine image - {} found with id: {}'.format(platform, imageName, image.id))
+        else:
+            print('info: {} machine image - {} not found'.format(platform, imageName))
     #elif platform == 'amazon':
-    return image is not None
+    return exists
+
+
+# the taskcluster deployments whose worker pools launch machine images from the shared azure subscription
+taskclusterRootUrls = {
+    'production': 'https://firefox-ci-tc.services.mozilla.com',
+    'staging': 'https://stage.taskcluster.nonprod.cloudops.mozgcp.net'
+}
+machineImageSnapshotNamePattern = re.compile(r'^(?P<key>.+)-(?P<diskSha>[a-f0-9]{7})$')
+ImageRetentionDecision = collections.namedtuple('ImageRetentionDecision', ['kind', 'group', 'name', 'imageName', 'resource', 'retain', 'reason'])
+
+
+# snapshots made by the machine image build are named {group}-{key}-{diskSha}; those named like images also carry a deploymentId
+def parseMachineImageSnapshotName(group, name):
+    imageName = parseMachineImageName(group, name)
+    if imageName is not None:
+        return imageName
+    prefix = '{}-'.format(group.replace('rg-', ''))
+    match = machineImageSnapshotNamePattern.match(name[len(prefix):]) if name.startswith(prefix) else None
+    return MachineImageName(group, match.group('key'), match.group('diskSha'), None) if match is not None else None
+
+
+# the machineImageCommitTime tag or, for snapshots (which the machine image build does not tag), the creation time
+def getImageRetentionTime(kind, resource):
+    commitTime = (resource.tags or {}).get('machineImageCommitTime')
+    if commitTime is not None:
+        try:
+            return datetime.fromisoformat(commitTime.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    return getattr(resource, 'time_created', None) if kind == 'snapshot' else None
+
+
+# the ids of the machine images referenced by the launch configs of every worker pool in each taskcluster deployment
+def getLiveWorkerPoolImageIds(rootUrls=taskclusterRootUrls.values()):
+    imageIds = set()
+    for rootUrl in rootUrls:
+        workerManager = taskcluster.WorkerManager({ 'rootUrl': rootUrl })
+        query = {}
+        while True:
+            response = workerManager.listWorkerPools(query=query)
+            for workerPool in response['workerPools']:
+                for launchConfig in (workerPool.get('config') or {}).get('launchConfigs', []):
+                    imageId = ((launchConfig.get('storageProfile') or {}).get('imageReference') or {}).get('id')
+                    if imageId:
+                        imageIds.add(normaliseAzureResourceId(imageId))
+            if not response.get('continuationToken'):
+                break
+            query['continuationToken'] = response['continuationToken']
+    return imageIds
+
+
+# whether a task run (`{taskId}/{runId}`, as in the machineImageTask tag) is pending or running in any taskcluster
+# deployment. a run whose state cannot be determined is treated as active
+def isTaskRunActive(taskRun, rootUrls=taskclusterRootUrls.values()):
+    taskId, _, runId = taskRun.partition('/')
+    for rootUrl in rootUrls:
+        try:
+            status = taskcluster.Queue({ 'rootUrl': rootUrl }).status(taskId)['status']
+        except taskcluster.exceptions.TaskclusterRestFailure as tcRestFailure:
+            if tcRestFailure.status_code == 404:
+                continue
+            print('warn: failed to determine the state of task run: {}. {}'.format(taskRun, tcRestFailure))
+            return True
+        except BaseException as e:
+            print('warn: failed to determine the state of task run: {}. {}'.format(taskRun, e))
+            return True
+        runs = status.get('runs', [])
+        run = runs[int(runId)] if runId.isdigit() and int(runId) < len(runs) else None
+        return status['state'] in ['unscheduled', 'pending', 'running'] if run is None else run['state'] in ['pending', 'running']
+    return False
+
+
+# decides which of a group's machine images and snapshots to keep. for each configured key, the newest retainCount
+# images (by machineImageCommitTime) and snapshots are kept, as are images referenced by a live worker pool and the
+# snapshots that retained images were made from. resources that cannot be attributed to a configured key, or dated,
+# are never deleted.
+def getImageRetention(group, images, snapshots, keys, retainCount, liveImageIds):
+    decisions = []
+    retainedDiskShas = collections.defaultdict(set)
+    for kind, resources, parse in [('image', images, parseMachineImageName), ('snapshot', snapshots, parseMachineImageSnapshotName)]:
+        byKey = collections.defaultdict(list)
+        for resource in resources:
+            imageName = parse(group, resource.name)
+            if imageName is None or imageName.key not in keys:
+                decisions.append(ImageRetentionDecision(kind, group, resource.name, imageName, resource, True, 'not a machine image of a configured key'))
+            elif getImageRetentionTime(kind, resource) is None:
+                decisions.append(ImageRetentionDecision(kind, group, resource.name, imageName, resource, True, 'no machineImageCommitTime'))
+            else:
+                byKey[imageName.key].append((imageName, resource))
+        for key, keyResources in byKey.items():
+            keyResources.sort(key=lambda r: getImageRetentionTime(kind, r[1]), reverse=True)
+            for i, (imageName, resource) in enumerate(keyResources):
+                if i < retainCount:
+                    reason = 'one of the {} newest {} {}s'.format(retainCount, key, kind)
+                elif kind == 'image' and normaliseAzureResourceId(resource.id) in liveImageIds:
+                    reason = 'referenced by a worker pool launch config'
+                elif kind == 'snapshot' and imageName.diskSha in retainedDiskShas[key]:
+                    reason = 'source of a retained {} image'.format(key)
+                else:
+                    reason = None
+                if reason is not None and kind == 'image':
+                    retainedDiskShas[key].add(imageName.diskSha)
+                decisions.append(ImageRetentionDecision(kind, group, resource.name, imageName, resource, reason is not None, reason or 'superseded by newer {} {}s'.format(key, kind)))
+    return decisions
+
+
+AzureResource = collections.namedtuple('AzureResource', ['id', 'kind', 'group', 'name', 'resource'])
+# the resource kinds held in an AzureResourceGraph, mapped to the client, operation group and operation that lists every
+# resource of the kind in the subscription (one paged call per kind)
+azureResourceKinds = collections.OrderedDict([
+    ('virtual machine', ('compute', 'virtual_machines', 'list_all')),
+    ('network interface', ('network', 'network_interfaces', 'list_all')),
+    ('public ip address', ('network', 'public_ip_addresses', 'list_all')),
+    ('network security group', ('network', 'network_security_groups', 'list_all')),
+    ('virtual network', ('network', 'virtual_networks', 'list_all')),
+    ('disk', ('compute', 'disks', 'list'))
+])
+
+
+# azure resource ids are case insensitive and references to a resource do not always use the casing of its own id
+def normaliseAzureResourceId(resourceId):
+    return resourceId.lower() if resourceId else None
+
+
+# the id of the top level resource that a sub resource id (eg: an ip configuration or a subnet) belongs to
+def getAzureParentResourceId(resourceId):
+    return normaliseAzureResourceId('/'.join(resourceId.split('/')[0:9])) if resourceId else None
+
+
+def getAzureResourceGroup(resourceId):
+    return resourceId.split('/')[4]
+
+
+def getAzureReferenceId(value, *path):
+    for attribute in path:
+        value = getattr(value, attribute, None)
+        if value is None:
+            return None
+    return value
+
+
+# an in memory graph of the virtual machines, network resources and disks in a subscription, built from one paged list
+# call per resource kind. an edge points from a resource to a resource it keeps alive: a virtual machine keeps its
+# network interfaces and disks, a network interface keeps its public ip addresses, network security group and virtual
+# network, and a virtual network keeps the network security groups of its subnets. a resource is an orphan when no
+# root reaches it. resources owned by something outside the graph (eg: a public ip address on a load balancer, or a
+# disk managed by a scale set) are always roots, as are the resources selected by the caller's isRoot predicate.
+#
+# when powerStates is set, the power state of every virtual machine is also collected, from one more paged call that
+# lists the instance views of the subscription's virtual machines (rather than an instance_view call per machine).
+class AzureResourceGraph:
+    def __init__(self, clients, retries=3, retryDelaySeconds=2, powerStates=False):
+        self.clients = clients
+        self.retries = retries
+        self.retryDelaySeconds = retryDelaySeconds
+        self.resources = {}
+        self.references = collections.defaultdict(set)
+        self.referrers = collections.defaultdict(set)
+        self.externallyOwned = set()
+        self.powerStates = {} if powerStates else None
+
+    def listWithRetries(self, description, lister):
+        for attempt in range(1, self.retries + 1):
+            try:
+                return list(lister())
+            except Exception as e:
+                print('warn: attempt {}/{} to list {} failed. {}'.format(attempt, self.retries, description, e))
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.retryDelaySeconds * attempt)
+
+    def listKind(self, kind):
+        clientType, operationGroup, operation = azureResourceKinds[kind]
+        # an incomplete graph would report every resource referenced from the missing kind as an orphan, so failures are raised
+        return self.listWithRetries('{} resources'.format(kind), getattr(getattr(self.clients[clientType], operationGroup), operation))
+
+    # maps each virtual machine id to the code of its PowerState/* instance view status (eg: running, deallocated)
+    def listPowerStates(self):
+        try:
+            virtualMachines = self.listWithRetries('virtual machine power states', lambda: self.clients['compute'].virtual_machines.list_all(status_only='true'))
+        except Exception as e:
+            # without power states every virtual machine is treated as running
+            print('warn: virtual machine power states are unavailable. {}'.format(e))
+            return {}
+        return {
+            normaliseAzureResourceId(virtualMachine.id): next((status.code.split('/')[1] for status in (getAzureReferenceId(virtualMachine, 'instance_view', 'statuses') or []) if (status.code or '').startswith('PowerState/')), None)
+            for virtualMachine in virtualMachines
+        }
+
+    def getPowerState(self, resourceId):
+        return (self.powerStates or {}).get(normaliseAzureResourceId(resourceId))
+
+    # the ids a resource keeps alive, and the id of the resource that owns it (if it records one)
+    def getReferences(self, kind, resource):
+        if kind == 'virtual machine':
+            references = [getAzureReferenceId(nic, 'id') for nic in (getAzureReferenceId(resource, 'network_profile', 'network_interfaces') or [])]
+            references.append(getAzureReferenceId(resource, 'storage_profile', 'os_disk', 'managed_disk', 'id'))
+            references += [getAzureReferenceId(disk, 'managed_disk', 'id') for disk in (getAzureReferenceId(resource, 'storage_profile', 'data_disks') or [])]
+            return references, None
+        if kind == 'network interface':
+            references = [getAzureReferenceId(resource, 'network_security_group', 'id')]
+            for ipConfiguration in resource.ip_configurations or []:
+                references.append(getAzureReferenceId(ipConfiguration, 'public_ip_address', 'id'))
+                references.append(getAzureParentResourceId(getAzureReferenceId(ipConfiguration, 'subnet', 'id')))
+            owner = getAzureReferenceId(resource, 'virtual_machine', 'id') or getAzureReferenceId(resource, 'private_endpoint', 'id')
+            return references, owner
+        if kind == 'public ip address':
+            return [], getAzureParentResourceId(getAzureReferenceId(resource, 'ip_configuration', 'id'))
+        if kind == 'virtual network':
+            return [getAzureReferenceId(subnet, 'network_security_group', 'id') for subnet in resource.subnets or []], None
+        if kind == 'disk':
+            return [], resource.managed_by
+        return [], None
+
+    def load(self, maxWorkers=len(azureResourceKinds)):
+        with ThreadPoolExecutor(max_workers=maxWorkers + 1) as executor:
+            powerStatesFuture = executor.submit(self.listPowerStates) if self.powerStates is not None else None
+            listings = dict(zip(azureResourceKinds, executor.map(self.listKind, azureResourceKinds)))
+            if powerStatesFuture is not None:
+                self.powerStates = powerStatesFuture.result()
+        for kind, resources in listings.items():
+            for resource in resources:
+                resourceId = normaliseAzureResourceId(resource.id)
+                self.resources[resourceId] = AzureResource(resourceId, kind, getAzureResourceGroup(resource.id), resource.name, resource)
+        for resourceId, azureResource in self.resources.items():
+            references, owner = self.getReferences(azureResource.kind, azureResource.resource)
+            self.references[resourceId].update(normaliseAzureResourceId(reference) for reference in references if reference)
+            owner = normaliseAzureResourceId(owner)
+            if owner in self.resources:
+                self.references[owner].add(resourceId)
+            elif owner is not None:
+                self.externallyOwned.add(resourceId)
+        for resourceId, references in self.references.items():
+            for reference in references:
+                self.referrers[reference].add(resourceId)
+        return self
+
+    def getReachable(self, isRoot):
+        reachable = set()
+        pending = [resourceId for resourceId, azureResource in self.resources.items() if resourceId in self.externallyOwned or isRoot(azureResource)]
+        while pending:
+            resourceId = pending.pop()
+            if resourceId not in reachable:
+                reachable.add(resourceId)
+                pending += [reference for reference in self.references.get(resourceId, []) if reference in self.resources]
+        return reachable
+
+    # the resources in the given groups (all groups when None) that no root reaches. by default every virtual machine is a root.
+    def getOrphans(self, groups=None, isRoot=lambda azureResource: azureResource.kind == 'virtual machine'):
+        groups = None if groups is None else set(group.lower() for group in groups)
+        reachable = self.getReachable(isRoot)
+        return [azureResource for resourceId, azureResource in self.resources.items()
+                if resourceId not in reachable and (groups is None or azureResource.group.lower() in groups)]
@@ -1,49 +1,62 @@
-import glob
+import argparse
 import json
 import os
-import pathlib
 import slugid
 import taskcluster
-import urllib.request
+import threading
 import yaml
-from cib import createTask, diskImageManifestHasChanged, machineImageManifestHasChanged, machineImageExists
-#from azure.common.credentials import ServicePrincipalCredentials
-from azure.identity import ClientSecretCredential
-from azure.mgmt.compute import ComputeManagementClient
+from concurrent.futures import ThreadPoolExecutor
+from cib import TaskGraph, callWithBufferedOutput, getBufferedResult, diskImageManifestHasChanged, machineImageManifestHasChanged, machineImageExists, getDecisionContext, createAzureClient, getConfigIndex, getDiskImageDigest, getMachineImageDigest, getMachineImageInputs, ImageInventory, git, normaliseRegion, getCommitMessage, getCommitDirectivesEnvironmentValue, parseCommitDirectives, writeCommitDirectives, InstrumentedClient, LazyClient, phase, writeMetricsOnExit
+from dryrun import FixtureAuth, FixtureComputeClient, FixtureIndex, diffTaskGraphs, exportTaskGraph, loadFixtures
 
 
-def extract_pools(config_path):
-    return map(lambda p: '{}/{}'.format(p['domain'], p['variant']), yaml.safe_load(open(config_path, 'r'))['manager']['pool'])
+parser = argparse.ArgumentParser(description = 'determine which cloud images should be built and create the maintenance and image build tasks for the same')
+parser.add_argument('--dry-run', metavar = 'FIXTURES', dest = 'fixtures', help = 'evaluate the decision offline against recorded fixtures (yaml or json) and write the task graph instead of creating tasks')
+parser.add_argument('--output', metavar = 'PATH', default = 'task-graph.json', help = 'where a dry run writes the task graph (default: task-graph.json)')
+parser.add_argument('--compare', metavar = 'PATH', help = 'a task graph written by a previous dry run, to diff the new task graph against')
+args = parser.parse_args()
 
+# per-phase timings and outbound call counts are published as a decision task artifact, including on early exits
+writeMetricsOnExit(os.getenv('CIB_METRICS_PATH', 'decision-metrics.json'))
 
-taskclusterOptions = { 'rootUrl': os.environ['TASKCLUSTER_PROXY_URL'] }
+if args.fixtures:
+    fixtures = loadFixtures(args.fixtures)
+    os.environ['TASKCLUSTER_ROOT_URL'] = fixtures.get('rootUrl', 'https://stage.taskcluster.nonprod.cloudops.mozgcp.net')
+    os.environ['GITHUB_HEAD_SHA'] = fixtures.get('commitSha', os.getenv('GITHUB_HEAD_SHA', git('rev-parse', 'HEAD').decode().strip()))
+    os.environ['TASK_ID'] = fixtures.get('taskGroupId', os.getenv('TASK_ID', slugid.nice()))
+    auth = InstrumentedClient(FixtureAuth(), 'taskcluster-auth')
+    queue = None
+    index = InstrumentedClient(FixtureIndex(), 'taskcluster-index')
+    platformClient = {
+        'azure': InstrumentedClient(FixtureComputeClient(), 'azure-compute')
+    }
+    print('info: dry run using fixtures from: {}'.format(args.fixtures))
+else:
+    taskclusterOptions = { 'rootUrl': os.environ['TASKCLUSTER_PROXY_URL'] }
 
-auth = taskcluster.Auth(taskclusterOptions)
-queue = taskcluster.Queue(taskclusterOptions)
-index = taskcluster.Index(taskcluster.optionsFromEnvironment())
-secrets = taskcluster.Secrets(taskclusterOptions)
+    # clients, secrets and the azure sdk are only loaded on first use, so runs that skip ci exit without paying for them
+    auth = InstrumentedClient(LazyClient(lambda: taskcluster.Auth(taskclusterOptions)), 'taskcluster-auth')
+    queue = InstrumentedClient(LazyClient(lambda: taskcluster.Queue(taskclusterOptions)), 'taskcluster-queue')
+    index = InstrumentedClient(LazyClient(lambda: taskcluster.Index(taskcluster.optionsFromEnvironment())), 'taskcluster-index')
+    secrets = InstrumentedClient(LazyClient(lambda: taskcluster.Secrets(taskclusterOptions)), 'taskcluster-secrets')
+    platformClient = {
+        'azure': InstrumentedClient(LazyClient(lambda: createAzureClient('compute', secrets.get('project/relops/image-builder/dev')['secret']['azure'])), 'azure-compute')
+    }
 
-secret = secrets.get('project/relops/image-builder/dev')['secret']
-
-
-platformClient = {
-    'azure': ComputeManagementClient(
-        #ServicePrincipalCredentials(
-        #    client_id = secret['azure']['id'],
-        #    secret = secret['azure']['key'],
-        #    tenant = secret['azure']['account']),
-        ClientSecretCredential(
-            tenant_id=secret['azure']['account'],
-            client_id=secret['azure']['id'],
-            client_secret=secret['azure']['key']),
-        secret['azure']['subscription'])
-}
+currentEnvironment = 'staging' if 'stage.taskcluster.nonprod' in os.environ['TASKCLUSTER_ROOT_URL'] else 'production'
+if currentEnvironment == 'production':
+    print('info: skipping production environment builds')
+    quit()
+#if currentEnvironment == 'staging':
+#    print('info: skipping staging environment builds')
+#    quit()
 
 commitSha = os.getenv('GITHUB_HEAD_SHA')
-allKeyConfigPaths = glob.glob('{}/../config/win*.yaml'.format(os.path.dirname(__file__)))
-includeKeys = list(map(lambda x: pathlib.Path(x).stem, allKeyConfigPaths))
-includePools = []#[poolName for poolNames in map(lambda configPath: map(lambda pool: '{}/{}'.format(pool['domain'], pool['variant']), yaml.safe_load(open(configPath, 'r'))['manager']['pool']), allKeyConfigPaths) for poolName in poolNames]
-includeRegions = sorted(list(set([region for regions in map(lambda configPath: map(lambda target: target['region'].replace(' ', '').lower(), yaml.safe_load(open(configPath, 'r'))['target']), allKeyConfigPaths) for region in regions])))
+decisionConcurrency = int(os.getenv('CIB_DECISION_CONCURRENCY', '8'))
+configIndex = getConfigIndex()
+includeKeys = list(configIndex['keys'])
+includePools = []#list(configIndex['pools'])
+includeRegions = list(configIndex['regions'])
 includeEnvironments = [
     'production',
     'staging'
@@ -52,71 +65,50 @@ includePlatforms = [
     #'amazon',
     'azure'
 ]
-currentEnvironment = 'staging' if 'stage.taskcluster.nonprod' in os.environ['TASKCLUSTER_ROOT_URL'] else 'production'
-if currentEnvironment == 'production':
-    print('info: skipping production environment builds')
-    quit()
-#if currentEnvironment == 'staging':
-#    print('info: skipping staging environment builds')
-#    quit()
-
-overwriteDiskImage = False
-overwriteMachineImage = False
 
 try:
-    commit = json.loads(urllib.request.urlopen(urllib.request.Request('https://api.github.com/repos/mozilla-platform-ops/cloud-image-builder/commits/{}'.format(commitSha), None, { 'User-Agent' : 'Mozilla/5.0' })).read().decode())['commit']
-    lines = commit['message'].splitlines()
-    overwriteDiskImage = any(line.lower().strip() == 'overwrite-disk-image' for line in lines)
-    overwriteMachineImage = any(line.lower().strip() == 'overwrite-machine-image' for line in lines)
-    disableCleanup = any(line.lower().strip() == 'disable-cleanup' for line in lines)
-    enableSnapshotCopy = any(line.lower().strip() == 'enable-snapshot-copy' for line in lines)
+    with phase('commit parsing'):
+        commitDirectives = parseCommitDirectives(commitSha, fixtures['commitMessage'] if args.fixtures else getCommitMessage(commitSha))
+    # the directives are published as an artifact of the decision task, for reference. the tasks it creates receive them
+    # in their environment instead of querying github and parsing them again
+    writeCommitDirectives(commitDirectives, os.getenv('CIB_COMMIT_DIRECTIVES_PATH', 'commit-directives.json'))
+    overwriteDiskImage = commitDirectives.overwriteDiskImage
+    overwriteMachineImage = commitDirectives.overwriteMachineImage
+    disableCleanup = commitDirectives.disableCleanup
+    enableSnapshotCopy = commitDirectives.enableSnapshotCopy
     purgeRelopsResources = True
-    purgeTaskclusterResources = any(line.lower().strip() == 'purge-taskcluster-resources' for line in lines)
-    skipImageVerification = any(line.lower().strip() == 'no-verify' for line in lines)
-    noCI = any(line.lower().strip() == 'no-ci' or line.lower().strip() == 'no-taskcluster-ci' for line in lines)
+    purgeTaskclusterResources = commitDirectives.purgeTaskclusterResources
+    skipImageVerification = commitDirectives.skipImageVerification
+    noCI = commitDirectives.skips('taskcluster')
     if noCI:
         print('info: **no ci** commit syntax detected. skipping ci task creation')
-    elif any(line.lower().startswith('include environments:') for line in lines):
-        includeEnvironments = list(map(lambda x: x.lower().strip(), next(line for line in lines if line.startswith('include environments:')).replace('include environments:', '').split(',')))
-        print('info: **include environments** commit syntax detected. ci will process environments: {}'.format(', '.join(includeEnvironments)))
-    elif any(line.lower().startswith('exclude environments:') for line in lines):
-        includeEnvironments = list(filter(lambda x: x not in map(lambda x: x.lower().strip(), next(line for line in lines if line.lower().startswith('exclude environments:')).replace('exclude environments:', '').split(',')), includeEnvironments))
-        print('info: **exclude environments** commit syntax detected. ci will process environments: {}'.format(', '.join(includeEnvironments)))
+    elif commitDirectives.environments is not None:
+        includeEnvironments = commitDirectives.filter('environments', includeEnvironments)
+        print('info: {}. ci will process environments: {}'.format(commitDirectives.describe('environments'), ', '.join(includeEnvironments)))
     if currentEnvironment not in includeEnvironments:
         noCI = True
         print('info: current environment ({}) is excluded. skipping ci task creation'.format(currentEnvironment))
 
-    poolDeploy = (not noCI) and any(line.lower().strip() == 'pool-deploy' for line in lines)
+    poolDeploy = (not noCI) and commitDirectives.poolDeploy
     if poolDeploy:
         print('info: **pool deploy** commit syntax detected. disk/machine image builds will be skipped')
 
     if not noCI:
+        if commitDirectives.keys is not None:
+            includeKeys = commitDirectives.filter('keys', includeKeys)
+            print('info: {}. ci will process keys: {}'.format(commitDirectives.describe('keys'), ', '.join(includeKeys)))
+        elif commitDirectives.pools is not None:
+            includePools = commitDirectives.filter('pools', includePools)
+            print('info: {}. ci will process pools: {}'.format(commitDirectives.describe('pools'), ', '.join(includePools)))
 
-        if any(line.lower().startswith('include keys:') for line in lines):
-            includeKeys = list(map(lambda x: x.lower().strip(), next(line for line in lines if line.startswith('include keys:')).replace('include keys:', '').split(',')))
-            print('info: **include keys** commit syntax detected. ci will process keys: {}'.format(', '.join(includeKeys)))
-        elif any(line.lower().startswith('exclude keys:') for line in lines):
-            includeKeys = list(filter(lambda x: x not in map(lambda x: x.lower().strip(), next(line for line in lines if line.lower().startswith('exclude keys:')).replace('exclude keys:', '').split(',')), includeKeys))
-            print('info: **exclude keys** commit syntax detected. ci will process keys: {}'.format(', '.join(includeKeys)))
-
-        elif any(line.lower().startswith('include pools:') for line in lines):
-            includePools = list(map(lambda x: x.lower().strip(), next(line for line in lines if line.startswith('include pools:')).replace('include pools:', '').split(',')))
-            print('info: **include pools** commit syntax detected. ci will process pools: {}'.format(', '.join(includePools)))
-        elif any(line.lower().startswith('exclude pools:') for line in lines):
-            includePools = list(filter(lambda x: x not in map(lambda x: x.lower().strip(), next(line for line in lines if line.lower().startswith('exclude pools:')).replace('exclude pools:', '').split(',')), includePools))
-            print('info: **exclude pools** commit syntax detected. ci will process pools: {}'.format(', '.join(includePools)))
-
-        if any(line.lower().startswith('include regions:') for line in lines):
-            includeRegions = list(map(lambda x: x.lower().strip(), next(line for line in lines if line.startswith('include regions:')).replace('include regions:', '').split(',')))
-            print('info: **include regions** commit syntax detected. ci will process regions: {}'.format(', '.join(includeRegions)))
-        elif any(line.lower().startswith('exclude regions:') for line in lines):
-            includeRegions = list(filter(lambda x: x not in map(lambda x: x.lower().strip(), next(line for line in lines if line.lower().startswith('exclude regions:')).replace('exclude regions:', '').split(',')), includeRegions))
-            print('info: **exclude regions** commit syntax detected. ci will process regions: {}'.format(', '.join(includeRegions)))
+        if commitDirectives.regions is not None:
+            includeRegions = commitDirectives.filter('regions', includeRegions)
+            print('info: {}. ci will process regions: {}'.format(commitDirectives.describe('regions'), ', '.join(includeRegions)))
 
     print('info: commit message reads:')
-    print(commit['message'])
+    print(commitDirectives.message)
 except:
-    noCI == True
+    noCI = True
     poolDeploy = False
     print('warn: error reading commit message for sha: {}, ci disabled'.format(commitSha))
 if noCI:
@@ -124,13 +116,26 @@ if noCI:
 
 taskGroupId = os.getenv('TASK_ID')
 
+# the machine image targets of every included key, pool and region, as evaluated below
+machineImageTargets = [
+    (platform, key, target['group'])
+    for platform in includePlatforms
+    for key in includeKeys
+    for poolName, poolIndex in configIndex['keys'][key]['pools'].items() if poolIndex['pool']['platform'] == platform and poolName in includePools
+    for region in includeRegions for target in poolIndex['targetsByRegion'].get(region, [])
+] if not poolDeploy else []
+
+with phase('decision context prefetch'):
+    decisionContext = getDecisionContext(auth, includePlatforms, includeKeys, machineImageTargets = machineImageTargets, maxWorkers = decisionConcurrency)
+
 print('[debug] auth.currentScopes:')
-for scope in auth.currentScopes()['scopes']:
+for scope in sorted(decisionContext.scopes):
     print(' - {}'.format(scope))
 
+taskGraph = TaskGraph(queue, maxWorkers = decisionConcurrency)
+
 yamlLintTaskId = slugid.nice()
-createTask(
-    queue = queue,
+taskGraph.addTask(
     image = 'python',
     taskId = yamlLintTaskId,
     taskName = '00 :: validate all yaml files in repo',
@@ -150,14 +155,15 @@ createTask(
     taskGroupId = taskGroupId
 )
 
-azurePurgeTaskIds = { 'default': slugid.nice() }
+# all resource groups are purged by a single task, which scans the groups concurrently
+azurePurgeTaskId = slugid.nice()
+azurePurgeGroups = [ 'default' ]
 if purgeRelopsResources:
-    azurePurgeTaskIds['relops'] = slugid.nice()
+    azurePurgeGroups.append('relops')
 if purgeTaskclusterResources:
-    azurePurgeTaskIds['taskcluster-staging-workers-us-central'] = slugid.nice()
-    azurePurgeTaskIds['taskcluster-production-workers-us-central'] = slugid.nice()
-createTask(
-    queue = queue,
+    azurePurgeGroups.append('taskcluster-staging-workers-us-central')
+    azurePurgeGroups.append('taskcluster-production-workers-us-central')
+taskGraph.addTask(
     taskId = slugid.nice(),
     taskName = '00 :: purge deprecated azure resources - powershell (slow)',
     taskDescription = 'delete orphaned, deprecated, deallocated and unused azure resources',
@@ -182,201 +188,122 @@ createTask(
     taskGroupId = taskGroupId
 )
 
-for resourceGroup in azurePurgeTaskIds:
-    createTask(
-        queue = queue,
-        image = 'python',
-        taskId = azurePurgeTaskIds[resourceGroup],
-        taskName = '00 :: purge deprecated azure resources in {} resource group{}'.format(resourceGroup, 's' if resourceGroup == 'default' else ''),
-        taskDescription = 'delete orphaned, deprecated, deallocated and unused azure resources',
-        #dependencies = [ yamlLintTaskId ],
-        maxRunMinutes = 60,
-        retries = 5,
-        retriggerOnExitCodes = [ 123 ],
-        provisioner = 'relops-3',
-        workerType = 'decision',
-        priority = 'high',
-        features = {
-            'taskclusterProxy': True
-        },
-        commands = [
-            '/bin/bash',
-            '--login',
-            '-c',
-            'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git && cd cloud-image-builder && git reset --hard {} && pip install -r ci/requirements.txt | grep -v "^[[:space:]]*$" && python ci/purge-azure-resources.py{}'.format(commitSha, '' if resourceGroup == 'default' else ' {}'.format(resourceGroup))
-        ],
-        scopes = [
-            'secrets:get:project/relops/image-builder/dev'
-        ],
-        taskGroupId = taskGroupId
-    )
+taskGraph.addTask(
+    image = 'python',
+    taskId = azurePurgeTaskId,
+    taskName = '00 :: purge deprecated azure resources in {} resource groups'.format(', '.join(azurePurgeGroups)),
+    taskDescription = 'delete orphaned, deprecated, deallocated and unused azure resources',
+    #dependencies = [ yamlLintTaskId ],
+    maxRunMinutes = 60,
+    retries = 5,
+    retriggerOnExitCodes = [ 123 ],
+    provisioner = 'relops-3',
+    workerType = 'decision',
+    priority = 'high',
+    features = {
+        'taskclusterProxy': True
+    },
+    commands = [
+        '/bin/bash',
+        '--login',
+        '-c',
+        'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git && cd cloud-image-builder && git reset --hard {} && pip install -r ci/requirements.txt | grep -v "^[[:space:]]*$" && python ci/purge-azure-resources.py {}'.format(commitSha, ' '.join(azurePurgeGroups))
+    ],
+    scopes = [
+        'secrets:get:project/relops/image-builder/dev'
+    ],
+    taskGroupId = taskGroupId
+)
+
+packerKeys = ['win10-64', 'win10-64-gpu']
+keyConfigs = { key: configIndex['keys'][key]['config'] for key in includeKeys }
+# each resource group's machine images are listed once, on first use, and shared by every key and target in the group
+imageInventories = { platform: ImageInventory(client) for platform, client in platformClient.items() }
+uncheckedMachineImages = []
+uncheckedMachineImagesLock = threading.Lock()
+
+
+def evaluateDiskImageBuild(platform, key):
+    with phase('disk image change detection'):
+        return overwriteDiskImage or diskImageManifestHasChanged(platform, key, commitSha, decisionContext.imageArtifactDescriptors[(platform, key)])
+
+
+def evaluateMachineImageBuild(platform, key, group):
+    with phase('machine image change detection'):
+        if machineImageManifestHasChanged(platform, key, commitSha, group, decisionContext.imageArtifactDescriptors[(platform, key)], decisionContext.machineImageArtifactDescriptors[(platform, key, group)]):
+            return True
+    with phase('machine image existence checks'):
+        exists = machineImageExists(
+            taskclusterIndex = index,
+            platformClient = platformClient[platform],
+            platform = platform,
+            group = group,
+            key = key,
+            artifact = decisionContext.imageArtifactDescriptors[(platform, key)],
+            deploymentId = getMachineImageInputs(commitSha, key, group)['tag']['deploymentId'],
+            imageInventory = imageInventories[platform])
+    # an image whose existence could not be checked (its group's images could not be listed) is not rebuilt. it is
+    # reported once evaluation completes, so that a listing failure does not queue a rebuild of every image in the group.
+    if exists is None:
+        with uncheckedMachineImagesLock:
+            uncheckedMachineImages.append((platform, key, group))
+        return False
+    return not exists
+
+
+# evaluate rebuild decisions for the whole platform/key/target matrix, with bounded parallelism, before any build tasks are created.
+# machine image evaluations are only needed where no disk image build is queued (a disk image build always triggers machine image builds).
+# each evaluation's log lines are buffered and printed whole, in submission order, as its result is collected.
+with ThreadPoolExecutor(max_workers = decisionConcurrency) as executor:
+    diskImageBuildFutures = {
+        (platform, key): executor.submit(callWithBufferedOutput, evaluateDiskImageBuild, platform, key)
+        for platform in includePlatforms for key in includeKeys
+        if (not poolDeploy) and any(poolName in includePools for poolName in configIndex['keys'][key]['pools'])
+    }
+    queueDiskImageBuilds = { combination: getBufferedResult(future) for combination, future in diskImageBuildFutures.items() }
+    machineImageBuildFutures = {
+        (platform, key, target['group']): executor.submit(callWithBufferedOutput, evaluateMachineImageBuild, platform, key, target['group'])
+        for platform in includePlatforms if platform in platformClient
+        for key in includeKeys if key not in packerKeys and not queueDiskImageBuilds.get((platform, key), False)
+        for poolName, poolIndex in configIndex['keys'][key]['pools'].items() if poolIndex['pool']['platform'] == platform and poolName in includePools
+        for region in includeRegions for target in poolIndex['targetsByRegion'].get(region, [])
+    } if not poolDeploy else {}
+    queueMachineImageBuilds = { combination: getBufferedResult(future) for combination, future in machineImageBuildFutures.items() }
+for platform, key, group in sorted(uncheckedMachineImages):
+    print('warn: {} {} machine image build in {} skipped, image existence could not be checked'.format(platform, key, group))
 
 for platform in includePlatforms:
     for key in includeKeys:
-        configPath = '{}/../config/{}.yaml'.format(os.path.dirname(__file__), key)
-        with open(configPath, 'r') as stream:
-            config = yaml.safe_load(stream)
-            isDiskImageForIncludedPool = any('{}/{}'.format(pool['domain'], pool['variant']) in includePools for pool in config['manager']['pool'])
-            queueDiskImageBuild = (not poolDeploy) and isDiskImageForIncludedPool and (overwriteDiskImage or diskImageManifestHasChanged(platform, key, commitSha))
-            if queueDiskImageBuild:
-                if key in ['win10-64', 'win10-64-gpu']:
-                    packerConfigPath = '{}/../WIP_packer/{}_packer.yaml'.format(os.path.dirname(__file__), key)
-                    with open(packerConfigPath, 'r') as packerConfigStream:
-                        packerConfig = yaml.safe_load(packerConfigStream)
-                        for location in packerConfig['azure']['locations']:
-                            buildTaskId = slugid.nice()
-                            createTask(
-                                queue = queue,
-                                taskId = buildTaskId,
-                                taskName = '01 :: build {} {} packer image for {}'.format(platform, key, location),
-                                taskDescription = 'build a customised {} packer image file for {} {}'.format(key, platform, location),
-                                dependencies = [ yamlLintTaskId ],
-                                maxRunMinutes = 180,
-                                retries = 1,
-                                retriggerOnExitCodes = [ 123 ],
-                                provisioner = 'relops-3',
-                                workerType = 'win2019',
-                                priority = 'high',
-                                artifacts = [
-                                    {
-                                        'type': 'file',
-                                        'name': 'public/unattend.xml',
-                                        'path': 'unattend.xml'
-                                    },
-                                    {
-                                        'type': 'file',
-                                        'name': 'public/image-bucket-resource.json',
-                                        'path': 'image-bucket-resource.json'
-                                    }
-                                ],
-                                osGroups = [
-                                    'Administrators'
-                                ],
-                                features = {
-                                    'taskclusterProxy': True,
-                                    'runAsAdministrator': True
-                                },
-                                commands = [
-                                    'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git',
-                                    'cd cloud-image-builder',
-                                    'git reset --hard {}'.format(commitSha),
-                                    'powershell -File WIP_packer\\build-packer-image.ps1 {}'.format(location)
-                                ],
-                                scopes = [
-                                    'generic-worker:os-group:relops-3/win2019/Administrators',
-                                    'generic-worker:run-as-administrator:relops-3/win2019',
-                                    'secrets:get:project/relops/image-builder/dev'
-                                ],
-                                routes = [
-                                    'index.project.relops.cloud-image-builder.{}.{}.revision.{}'.format(platform, key, commitSha),
-                                    'index.project.relops.cloud-image-builder.{}.{}.latest'.format(platform, key)
-                                ],
-                                taskGroupId = taskGroupId
-                            )
-                else:
-                    buildTaskId = slugid.nice()
-                    createTask(
-                        queue = queue,
-                        taskId = buildTaskId,
-                        taskName = '01 :: build {} {} disk image from {} {} iso'.format(platform, key, config['image']['os'], config['image']['edition']),
-                        taskDescription = 'build a customised {} disk image file for {}, from iso file {} and upload to cloud storage'.format(key, platform, os.path.basename(config['iso']['source']['key'])),
-                        dependencies = [ yamlLintTaskId ],
-                        maxRunMinutes = 180,
-                        retries = 1,
-                        retriggerOnExitCodes = [ 123 ],
-                        provisioner = 'relops-3',
-                        workerType = 'win2019',
-                        priority = 'high',
-                        artifacts = [
-                            {
-                                'type': 'file',
-                                'name': 'public/unattend.xml',
-                                'path': 'unattend.xml'
-                            },
-                            {
-                                'type': 'file',
-                                'name': 'public/image-bucket-resource.json',
-                                'path': 'image-bucket-resource.json'
-                            }
-                        ],
-                        osGroups = [
-                            'Administrators'
-                        ],
-                        features = {
-                            'taskclusterProxy': True,
-                            'runAsAdministrator': True
-                        },
-                        commands = [
-                            'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git',
-                            'cd cloud-image-builder',
-                            'git reset --hard {}'.format(commitSha),
-                            'powershell -File build-disk-image.ps1 {} {}'.format(platform, key)
-                        ],
-                        scopes = [
-                            'generic-worker:os-group:relops-3/win2019/Administrators',
-                            'generic-worker:run-as-administrator:relops-3/win2019',
-                            'secrets:get:project/relops/image-builder/dev'
-                        ],
-                        routes = [
-                            'index.project.relops.cloud-image-builder.{}.{}.revision.{}'.format(platform, key, commitSha),
-                            'index.project.relops.cloud-image-builder.{}.{}.latest'.format(platform, key)
-                        ],
-                        taskGroupId = taskGroupId
-                    )
-            else:
-                buildTaskId = None
-                print('info: skipped disk image build task for {} {} {}'.format(platform, key, commitSha))
-
-            for pool in [p for p in config['manager']['pool'] if p['platform'] == platform and '{}/{}'.format(p['domain'], p['variant']) in includePools]:
-                machineImageBuildTaskIdsForPool = []
-                #taggingTaskIdsForPool = []
-                for target in [t for t in config['target'] if t['group'].endswith('-{}'.format(pool['domain'])) and t['region'].lower().replace(' ', '') in includeRegions]:
-                    queueMachineImageBuild = (key not in ['win10-64', 'win10-64-gpu']) and (not poolDeploy) and (platform in platformClient) and (queueDiskImageBuild or machineImageManifestHasChanged(platform, key, commitSha, target['group']) or not machineImageExists(
-                        taskclusterIndex = index,
-                        platformClient = platformClient[platform],
-                        platform = platform,
-                        group = target['group'],
-                        key = key))
-
-                    machineImageBuildTaskId = slugid.nice()
-                    if queueMachineImageBuild:
-                        machineImageBuildTaskIdsForPool.append(machineImageBuildTaskId)
-                        bootstrapRevision = next(x for x in target['tag'] if x['name'] == 'sourceRevision')['value']
-                        bootstrapRepository = next(x for x in target['tag'] if x['name'] == 'sourceRepository')['value']
-                        bootstrapOrganisation = next(x for x in target['tag'] if x['name'] == 'sourceOrganisation')['value']
-                        machineImageBuildDependencies = [ yamlLintTaskId ]
-                        if platform == 'azure':
-                            for resourceGroup in azurePurgeTaskIds:
-                                machineImageBuildDependencies.append(azurePurgeTaskIds[resourceGroup])
-                        if buildTaskId is not None:
-                            machineImageBuildDependencies.append(buildTaskId)
-                        createTask(
-                            queue = queue,
-                            taskId = machineImageBuildTaskId,
-                            taskName = '02 :: build {} {}/{} machine image from {} {} disk image using {}/{} revision {} and deploy to {} {}'.format(platform, pool['domain'], pool['variant'], platform, key, bootstrapOrganisation, bootstrapRepository, bootstrapRevision, platform, target['group']),
-                            taskDescription = 'build {} {}/{} machine image from {} {} disk image using {}/{} revision {} and deploy to {} {}'.format(platform, pool['domain'], pool['variant'], platform, key, bootstrapOrganisation, bootstrapRepository, bootstrapRevision, platform, target['group']),
-                            maxRunMinutes = 240 if key in ['win2012'] else 180,
-                            retries = 5,
+        config = keyConfigs[key]
+        queueDiskImageBuild = queueDiskImageBuilds.get((platform, key), False)
+        if queueDiskImageBuild:
+            if key in packerKeys:
+                packerConfigPath = '{}/../WIP_packer/{}_packer.yaml'.format(os.path.dirname(__file__), key)
+                with open(packerConfigPath, 'r') as packerConfigStream:
+                    packerConfig = yaml.safe_load(packerConfigStream)
+                    for location in packerConfig['azure']['locations']:
+                        buildTaskId = slugid.nice()
+                        taskGraph.addTask(
+                            taskId = buildTaskId,
+                            taskName = '01 :: build {} {} packer image for {}'.format(platform, key, location),
+                            taskDescription = 'build a customised {} packer image file for {} {}'.format(key, platform, location),
+                            dependencies = [ yamlLintTaskId ],
+                            maxRunMinutes = 180,
+                            retries = 1,
                             retriggerOnExitCodes = [ 123 ],
-                            dependencies = machineImageBuildDependencies,
                             provisioner = 'relops-3',
                             workerType = 'win2019',
-                            priority = 'low',
+                            priority = 'high',
                             artifacts = [
                                 {
-                                    'type': 'directory',
-                                    'name': 'public/instance-logs',
-                                    'path': 'instance-logs'
-                                },
-                                {
-                                    'type': 'directory',
-                                    'name': 'public/screenshot/full',
-                                    'path': 'screenshot/full'
+                                    'type': 'file',
+                                    'name': 'public/unattend.xml',
+                                    'path': 'unattend.xml'
                                 },
                                 {
-                                    'type': 'directory',
-                                    'name': 'public/screenshot/thumbnail',
-                                    'path': 'screenshot/thumbnail'
+                                    'type': 'file',
+                                    'name': 'public/image-bucket-resource.json',
+                                    'path': 'image-bucket-resource.json'
                                 }
                             ],
                             osGroups = [
@@ -390,14 +317,7 @@ for platform in includePlatforms:
                                 'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git',
                                 'cd cloud-image-builder',
                                 'git reset --hard {}'.format(commitSha),
-                                'powershell .\\build-machine-image.ps1 -platform {} -imageKey {} -group {}{}{}{}'.format(
-                                    platform,
-                                    key,
-                                    target['group'],
-                                    (' -enableSnapshotCopy' if enableSnapshotCopy else ''),
-                                    (' -overwrite' if overwriteMachineImage else ''),
-                                    (' -disableCleanup' if disableCleanup else '')
-                                )
+                                'powershell -File WIP_packer\\build-packer-image.ps1 {}'.format(location)
                             ],
                             scopes = [
                                 'generic-worker:os-group:relops-3/win2019/Administrators',
@@ -405,79 +325,236 @@ for platform in includePlatforms:
                                 'secrets:get:project/relops/image-builder/dev'
                             ],
                             routes = [
-                                'index.project.relops.cloud-image-builder.{}.{}.{}.revision.{}'.format(platform, target['group'], key, commitSha),
-                                'index.project.relops.cloud-image-builder.{}.{}.{}.latest'.format(platform, target['group'], key)
+                                'index.project.relops.cloud-image-builder.{}.{}.revision.{}'.format(platform, key, commitSha),
+                                'index.project.relops.cloud-image-builder.{}.{}.latest'.format(platform, key)
                             ],
-                            taskGroupId = taskGroupId)
-                    else:
-                        print('info: skipped machine image build task for {} {} {}'.format(platform, target['group'], key))
-
-                queueWorkerPoolConfigurationTask = platform in platformClient
-                if queueWorkerPoolConfigurationTask:
-                    workerPoolConfigurationTaskId = slugid.nice()
-                    createTask(
-                        queue = queue,
-                        image = 'python',
-                        taskId = workerPoolConfigurationTaskId,
-                        taskName = '03 :: generate {} {}/{} worker pool configuration'.format(platform, pool['domain'], pool['variant']),
-                        taskDescription = 'create worker pool configuration for {} {}/{} which can be added to worker manager'.format(platform, pool['domain'], pool['variant']),
-                        maxRunMinutes = 180,
-                        retries = 1,
+                            taskGroupId = taskGroupId
+                        )
+            else:
+                buildTaskId = slugid.nice()
+                taskGraph.addTask(
+                    taskId = buildTaskId,
+                    taskName = '01 :: build {} {} disk image from {} {} iso'.format(platform, key, config['image']['os'], config['image']['edition']),
+                    taskDescription = 'build a customised {} disk image file for {}, from iso file {} and upload to cloud storage'.format(key, platform, os.path.basename(config['iso']['source']['key'])),
+                    dependencies = [ yamlLintTaskId ],
+                    maxRunMinutes = 180,
+                    retries = 1,
+                    retriggerOnExitCodes = [ 123 ],
+                    provisioner = 'relops-3',
+                    workerType = 'win2019',
+                    priority = 'high',
+                    artifacts = [
+                        {
+                            'type': 'file',
+                            'name': 'public/unattend.xml',
+                            'path': 'unattend.xml'
+                        },
+                        {
+                            'type': 'file',
+                            'name': 'public/image-bucket-resource.json',
+                            'path': 'image-bucket-resource.json'
+                        }
+                    ],
+                    osGroups = [
+                        'Administrators'
+                    ],
+                    env = {
+                        'DISK_IMAGE_DIGEST': getDiskImageDigest(commitSha, key, platform)
+                    },
+                    features = {
+                        'taskclusterProxy': True,
+                        'runAsAdministrator': True
+                    },
+                    commands = [
+                        'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git',
+                        'cd cloud-image-builder',
+                        'git reset --hard {}'.format(commitSha),
+                        'powershell -File build-disk-image.ps1 {} {}'.format(platform, key)
+                    ],
+                    scopes = [
+                        'generic-worker:os-group:relops-3/win2019/Administrators',
+                        'generic-worker:run-as-administrator:relops-3/win2019',
+                        'secrets:get:project/relops/image-builder/dev'
+                    ],
+                    routes = [
+                        'index.project.relops.cloud-image-builder.{}.{}.revision.{}'.format(platform, key, commitSha),
+                        'index.project.relops.cloud-image-builder.{}.{}.latest'.format(platform, key)
+                    ],
+                    taskGroupId = taskGroupId
+                )
+        else:
+            buildTaskId = None
+            print('info: skipped disk image build task for {} {} {}'.format(platform, key, commitSha))
+
+        # worker pools of a key that wait on the same machine image builds (eg: pools with no builds queued) are generated and
+        # deployed by a single task. pools with builds of their own keep a task of their own, so that a failed or slow build
+        # only holds back the configuration of the pool it was built for.
+        workerPoolBatchesForKey = {}
+        for pool in [p for p in config['manager']['pool'] if p['platform'] == platform and '{}/{}'.format(p['domain'], p['variant']) in includePools]:
+            machineImageBuildTaskIdsForPool = []
+            #taggingTaskIdsForPool = []
+            for target in [t for t in configIndex['keys'][key]['pools']['{}/{}'.format(pool['domain'], pool['variant'])]['targets'] if normaliseRegion(t['region']) in includeRegions]:
+                queueMachineImageBuild = (key not in packerKeys) and (not poolDeploy) and (platform in platformClient) and (queueDiskImageBuild or queueMachineImageBuilds[(platform, key, target['group'])])
+
+                machineImageBuildTaskId = slugid.nice()
+                if queueMachineImageBuild:
+                    machineImageBuildTaskIdsForPool.append(machineImageBuildTaskId)
+                    bootstrapRevision = next(x for x in target['tag'] if x['name'] == 'sourceRevision')['value']
+                    bootstrapRepository = next(x for x in target['tag'] if x['name'] == 'sourceRepository')['value']
+                    bootstrapOrganisation = next(x for x in target['tag'] if x['name'] == 'sourceOrganisation')['value']
+                    machineImageBuildDependencies = [ yamlLintTaskId ]
+                    if platform == 'azure':
+                        machineImageBuildDependencies.append(azurePurgeTaskId)
+                    if buildTaskId is not None:
+                        machineImageBuildDependencies.append(buildTaskId)
+                    taskGraph.addTask(
+                        taskId = machineImageBuildTaskId,
+                        taskName = '02 :: build {} {}/{} machine image from {} {} disk image using {}/{} revision {} and deploy to {} {}'.format(platform, pool['domain'], pool['variant'], platform, key, bootstrapOrganisation, bootstrapRepository, bootstrapRevision, platform, target['group']),
+                        taskDescription = 'build {} {}/{} machine image from {} {} disk image using {}/{} revision {} and deploy to {} {}'.format(platform, pool['domain'], pool['variant'], platform, key, bootstrapOrganisation, bootstrapRepository, bootstrapRevision, platform, target['group']),
+                        maxRunMinutes = 240 if key in ['win2012'] else 180,
+                        retries = 5,
                         retriggerOnExitCodes = [ 123 ],
+                        dependencies = machineImageBuildDependencies,
+                        provisioner = 'relops-3',
+                        workerType = 'win2019',
+                        priority = 'low',
                         artifacts = [
                             {
-                                'type': 'file',
-                                'name': 'public/{}-{}.json'.format(pool['domain'], pool['variant']),
-                                'path': '{}-{}.json'.format(pool['domain'], pool['variant']),
+                                'type': 'directory',
+                                'name': 'public/instance-logs',
+                                'path': 'instance-logs'
+                            },
+                            {
+                                'type': 'directory',
+                                'name': 'public/screenshot/full',
+                                'path': 'screenshot/full'
+                            },
+                            {
+                                'type': 'directory',
+                                'name': 'public/screenshot/thumbnail',
+                                'path': 'screenshot/thumbnail'
                             },
                             {
                                 'type': 'file',
-                                'name': 'public/{}-{}.yaml'.format(pool['domain'], pool['variant']),
-                                'path': '{}-{}.yaml'.format(pool['domain'], pool['variant']),
+                                'name': 'public/image-bucket-resource.json',
+                                'path': 'image-bucket-resource.json'
                             }
                         ],
-                        dependencies = machineImageBuildTaskIdsForPool,
-                        provisioner = 'relops-3',
-                        workerType = 'decision',
-                        priority = 'low',
-                        features = {
-                            'taskclusterProxy': True
-                        },
+                        osGroups = [
+                            'Administrators'
+                        ],
                         env = {
-                            'GITHUB_HEAD_SHA': commitSha,
-                            'platform': platform,
-                            'key': key,
-                            'pool': '{}/{}'.format(pool['domain'], pool['variant'])
+                            'MACHINE_IMAGE_DIGEST': getMachineImageDigest(commitSha, key, target['group'])
+                        },
+                        features = {
+                            'taskclusterProxy': True,
+                            'runAsAdministrator': True
                         },
                         commands = [
-                            '/bin/bash',
-                            '--login',
-                            '-c',
-                            'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git && cd cloud-image-builder && git reset --hard {} && pip install -r ci/requirements.txt | grep -v "^[[:space:]]*$" && python ci/generate-worker-pool-config.py'.format(commitSha)
+                            'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git',
+                            'cd cloud-image-builder',
+                            'git reset --hard {}'.format(commitSha),
+                            'powershell .\\build-machine-image.ps1 -platform {} -imageKey {} -group {}{}{}{}'.format(
+                                platform,
+                                key,
+                                target['group'],
+                                (' -enableSnapshotCopy' if enableSnapshotCopy else ''),
+                                (' -overwrite' if overwriteMachineImage else ''),
+                                (' -disableCleanup' if disableCleanup else '')
+                            )
                         ],
                         scopes = [
-                            'secrets:get:project/relops/image-builder/dev',
-                            'worker-manager:manage-worker-pool:{}/{}'.format(pool['domain'], pool['variant']),
-                            'worker-manager:provider:{}'.format(pool['provider'])
+                            'generic-worker:os-group:relops-3/win2019/Administrators',
+                            'generic-worker:run-as-administrator:relops-3/win2019',
+                            'secrets:get:project/relops/image-builder/dev'
+                        ],
+                        routes = [
+                            'index.project.relops.cloud-image-builder.{}.{}.{}.revision.{}'.format(platform, target['group'], key, commitSha),
+                            'index.project.relops.cloud-image-builder.{}.{}.{}.latest'.format(platform, target['group'], key)
                         ],
                         taskGroupId = taskGroupId)
+                else:
+                    print('info: skipped machine image build task for {} {} {}'.format(platform, target['group'], key))
 
-                    queueWorkerPoolVerificationTask = (not skipImageVerification) and ('queue:create-task:highest:{}/win*'.format(pool['domain']) in auth.currentScopes()['scopes'])
-                    if queueWorkerPoolVerificationTask:
-                        createTask(
-                            queue = queue,
-                            taskId = slugid.nice(),
-                            taskName = '04 :: verify task claimability on {} {}/{}'.format(platform, pool['domain'], pool['variant']),
-                            taskDescription = 'verify that worker pool instance instantiations and task claims succeed using newly deployed machine images',
-                            maxRunMinutes = 60,
-                            retries = 5,
-                            retriggerOnExitCodes = [ 123 ],
-                            dependencies = [ workerPoolConfigurationTaskId ],
-                            provisioner = pool['domain'],
-                            workerType = pool['variant'],
-                            priority = 'high',
-                            commands = [
-                                'echo "hello world, from {}/{} on {}"'.format(pool['domain'], pool['variant'], platform)
-                            ],
-                            scopes = [],
-                            taskGroupId = taskGroupId)
+            queueWorkerPoolConfigurationTask = platform in platformClient
+            if queueWorkerPoolConfigurationTask:
+                workerPoolBatchesForKey.setdefault(tuple(machineImageBuildTaskIdsForPool), []).append(pool)
+
+        for machineImageBuildTaskIdsForBatch, workerPoolsForBatch in workerPoolBatchesForKey.items():
+            workerPoolConfigurationTaskId = slugid.nice()
+            workerPoolNames = ['{}/{}'.format(pool['domain'], pool['variant']) for pool in workerPoolsForBatch]
+            taskGraph.addTask(
+                image = 'python',
+                taskId = workerPoolConfigurationTaskId,
+                taskName = '03 :: generate {} {} worker pool configuration for {}'.format(platform, key, ', '.join(workerPoolNames)),
+                taskDescription = 'create worker pool configuration for {} {} which can be added to worker manager'.format(platform, ', '.join(workerPoolNames)),
+                maxRunMinutes = 180,
+                retries = 1,
+                retriggerOnExitCodes = [ 123 ],
+                artifacts = [
+                    {
+                        'type': 'file',
+                        'name': 'public/{}-{}.{}'.format(pool['domain'], pool['variant'], extension),
+                        'path': '{}-{}.{}'.format(pool['domain'], pool['variant'], extension),
+                    } for pool in workerPoolsForBatch for extension in ['json', 'yaml']
+                ],
+                dependencies = list(machineImageBuildTaskIdsForBatch),
+                provisioner = 'relops-3',
+                workerType = 'decision',
+                priority = 'low',
+                features = {
+                    'taskclusterProxy': True
+                },
+                env = {
+                    'GITHUB_HEAD_SHA': commitSha,
+                    'COMMIT_DIRECTIVES': getCommitDirectivesEnvironmentValue(commitDirectives)
+                },
+                commands = [
+                    '/bin/bash',
+                    '--login',
+                    '-c',
+                    'git clone https://github.com/mozilla-platform-ops/cloud-image-builder.git && cd cloud-image-builder && git reset --hard {} && pip install -r ci/requirements.txt | grep -v "^[[:space:]]*$" && python ci/generate-worker-pool-config.py {}'.format(commitSha, ' '.join('--pool {}'.format(workerPoolName) for workerPoolName in workerPoolNames))
+                ],
+                scopes = [
+                    'secrets:get:project/relops/image-builder/dev'
+                ] + [
+                    'worker-manager:manage-worker-pool:{}'.format(workerPoolName) for workerPoolName in workerPoolNames
+                ] + sorted(set(
+                    'worker-manager:provider:{}'.format(pool['provider']) for pool in workerPoolsForBatch
+                )),
+                taskGroupId = taskGroupId)
+
+            for pool in workerPoolsForBatch:
+                queueWorkerPoolVerificationTask = (not skipImageVerification) and ('queue:create-task:highest:{}/win*'.format(pool['domain']) in decisionContext.scopes)
+                if queueWorkerPoolVerificationTask:
+                    taskGraph.addTask(
+                        taskId = slugid.nice(),
+                        taskName = '04 :: verify task claimability on {} {}/{}'.format(platform, pool['domain'], pool['variant']),
+                        taskDescription = 'verify that worker pool instance instantiations and task claims succeed using newly deployed machine images',
+                        maxRunMinutes = 60,
+                        retries = 5,
+                        retriggerOnExitCodes = [ 123 ],
+                        dependencies = [ workerPoolConfigurationTaskId ],
+                        provisioner = pool['domain'],
+                        workerType = pool['variant'],
+                        priority = 'high',
+                        commands = [
+                            'echo "hello world, from {}/{} on {}"'.format(pool['domain'], pool['variant'], platform)
+                        ],
+                        scopes = [],
+                        taskGroupId = taskGroupId)
+
+if args.fixtures:
+    exportedTaskGraph = exportTaskGraph(taskGraph)
+    with open(args.output, 'w') as file:
+        json.dump(exportedTaskGraph, file, indent = 2, sort_keys = True)
+    print('info: dry run task graph with {} tasks in {} waves written to: {}'.format(len(exportedTaskGraph['tasks']), len(exportedTaskGraph['waves']), args.output))
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            taskGraphDiff = diffTaskGraphs(json.load(file), exportedTaskGraph)
+        print('info: task graph differences from: {} ({})'.format(args.compare, len([line for line in taskGraphDiff if not line.startswith(' ')]) or 'none'))
+        for line in taskGraphDiff:
+            print(line)
+else:
+    with phase('task submission'):
+        taskGraph.submit()
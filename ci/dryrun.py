@@ -0,0 +1,160 @@
+import cib
+import copy
+import difflib
+import json
+import threading
+import types
+import taskcluster.exceptions
+from cib import getAzureResourceGroup, loadYaml
+from datetime import datetime
+
+
+# offline stand-ins for the taskcluster and azure clients, driven by a fixtures file, and the export and comparison of
+# task graphs, for dry runs of the decision task (create-image-build-tasks.py --dry-run) and of the purge
+# (purge-azure-resources.py --fixtures). the loaded fixtures are held only by cib.fixtures, which also switches the
+# network calls in cib that have a fixture fallback, so the clients below and cib can never disagree about fixture mode.
+
+
+# loads the fixtures used by the clients below, and by the network calls in cib that have a fixture fallback
+def loadFixtures(path):
+    with open(path, 'r') as stream:
+        # large (eg: synthetic) fixtures are written as json, which parses much faster than yaml
+        fixtures = json.load(stream) if path.endswith('.json') else loadYaml(stream)
+    fixtures.setdefault('artifacts', {})
+    fixtures.setdefault('images', {})
+    fixtures.setdefault('scopes', [])
+    cib.fixtures = fixtures
+    return fixtures
+
+
+class FixtureAuth:
+    def currentScopes(self):
+        return { 'scopes': list(cib.fixtures['scopes']) }
+
+
+class FixtureIndex:
+    def findArtifactFromTask(self, indexPath, name):
+        if indexPath not in cib.fixtures['artifacts']:
+            raise taskcluster.exceptions.TaskclusterRestFailure('no fixture for index path: {}'.format(indexPath), None, status_code=404)
+        return copy.deepcopy(cib.fixtures['artifacts'][indexPath])
+
+
+class FixtureImages:
+    def list_by_resource_group(self, resource_group_name):
+        return [
+            types.SimpleNamespace(
+                name=image if isinstance(image, str) else image['name'],
+                id='/subscriptions/fixture/resourceGroups/{}/providers/Microsoft.Compute/images/{}'.format(resource_group_name, image if isinstance(image, str) else image['name']),
+                tags={} if isinstance(image, str) else dict(image.get('tags', {})))
+            for image in cib.fixtures['images'].get(resource_group_name, [])
+        ]
+
+    def get(self, resource_group_name, image_name):
+        image = next((i for i in self.list_by_resource_group(resource_group_name) if i.name == image_name), None)
+        if image is None:
+            raise LookupError('no fixture for image: {} in resource group: {}'.format(image_name, resource_group_name))
+        return image
+
+
+class FixtureComputeClient:
+    def __init__(self):
+        self.images = FixtureImages()
+
+
+# the operation groups of the fixture azure clients, mapped to the section of fixtures['azure'] that holds their resources
+fixtureAzureSections = {
+    'compute': { 'virtual_machines': 'virtualMachines', 'disks': 'disks', 'images': 'images', 'snapshots': 'snapshots' },
+    'network': { 'network_interfaces': 'networkInterfaces', 'public_ip_addresses': 'publicIPAddresses', 'network_security_groups': 'networkSecurityGroups', 'virtual_networks': 'virtualNetworks' },
+    'resource': { 'resource_groups': 'resourceGroups' }
+}
+# named like the sdk model, since the purge matches resource groups on the class name
+FixtureResourceGroup = type('ResourceGroup', (types.SimpleNamespace,), {})
+
+
+# converts a fixture resource (as json) into an object with the attributes of an azure sdk model. as in the sdk, tags stay a dict.
+def toAzureModel(value):
+    if isinstance(value, dict):
+        return types.SimpleNamespace(**{ k: datetime.fromisoformat(v) if k == 'time_created' and isinstance(v, str) else v if k == 'tags' else toAzureModel(v) for k, v in value.items() })
+    if isinstance(value, list):
+        return [toAzureModel(v) for v in value]
+    return value
+
+
+class FixturePoller:
+    def result(self, timeout=None):
+        return None
+
+    def done(self):
+        return True
+
+
+# resources are held by (group, name) and deletions remove them, so that a purge can run end to end against fixtures
+class FixtureAzureOperations:
+    def __init__(self, section):
+        self.lock = threading.Lock()
+        if section == 'resourceGroups':
+            self.resources = { (name.lower(), name): FixtureResourceGroup(name=name) for name in cib.fixtures.get('azure', {}).get(section, []) }
+        else:
+            self.resources = { (getAzureResourceGroup(r['id']).lower(), r['name']): toAzureModel(r) for r in cib.fixtures.get('azure', {}).get(section, []) }
+
+    def list(self, resource_group_name=None):
+        with self.lock:
+            return [r for (group, _), r in self.resources.items() if resource_group_name is None or group == resource_group_name.lower()]
+
+    def list_by_resource_group(self, resource_group_name):
+        return self.list(resource_group_name)
+
+    # the instance view of a fixture virtual machine holds a single PowerState status, from its power_state attribute
+    def list_all(self, status_only=None):
+        if status_only:
+            return [types.SimpleNamespace(id=r.id, instance_view=types.SimpleNamespace(statuses=[types.SimpleNamespace(code='PowerState/{}'.format(getattr(r, 'power_state', 'running')))])) for r in self.list()]
+        return self.list()
+
+    def begin_delete(self, resource_group_name, name):
+        with self.lock:
+            if self.resources.pop((resource_group_name.lower(), name), None) is None:
+                raise LookupError('no fixture for {} in resource group: {}'.format(name, resource_group_name))
+        return FixturePoller()
+
+
+def createFixtureAzureClient(clientType):
+    return types.SimpleNamespace(**{ operationGroup: FixtureAzureOperations(section) for operationGroup, section in fixtureAzureSections[clientType].items() })
+
+
+# task ids are random, so exported tasks are labelled by name to make graphs from different runs comparable
+def exportTaskGraph(taskGraph):
+    labels = {}
+    for taskId, payload in taskGraph.tasks.items():
+        label = payload['metadata']['name']
+        suffix = 2
+        while label in labels.values():
+            label = '{} ({})'.format(payload['metadata']['name'], suffix)
+            suffix += 1
+        labels[taskId] = label
+    tasks = {}
+    for taskId, payload in taskGraph.tasks.items():
+        definition = copy.deepcopy(payload)
+        for volatileField in ['created', 'deadline', 'taskGroupId']:
+            definition.pop(volatileField, None)
+        definition['dependencies'] = sorted(labels.get(dependency, dependency) for dependency in definition['dependencies'])
+        tasks[labels[taskId]] = definition
+    return {
+        'waves': [sorted(labels[taskId] for taskId in wave) for wave in taskGraph.getWaves()],
+        'tasks': tasks
+    }
+
+
+def diffTaskGraphs(previous, current):
+    lines = []
+    for label in sorted(set(previous['tasks']) | set(current['tasks'])):
+        if label not in previous['tasks']:
+            lines.append('+ added: {}'.format(label))
+        elif label not in current['tasks']:
+            lines.append('- removed: {}'.format(label))
+        elif previous['tasks'][label] != current['tasks'][label]:
+            lines.append('~ changed: {}'.format(label))
+            lines.extend('    {}'.format(line) for line in difflib.unified_diff(
+                json.dumps(previous['tasks'][label], indent=2, sort_keys=True).splitlines(),
+                json.dumps(current['tasks'][label], indent=2, sort_keys=True).splitlines(),
+                lineterm='', n=1))
+    return lines
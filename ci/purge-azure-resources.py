@@ -1,20 +1,14 @@
+import argparse
+import collections
+import json
 import os
-import sys
 import taskcluster
+import threading
 import yaml
-#from azure.common.credentials import ServicePrincipalCredentials
-from azure.identity import ClientSecretCredential
-from azure.mgmt.compute import ComputeManagementClient
-from azure.mgmt.network import NetworkManagementClient
-from azure.mgmt.resource import ResourceManagementClient
+from cib import AzureResourceGraph, InstrumentedClient, createAzureClient, getConfigIndex, getImageRetention, getLiveWorkerPoolImageIds, getMetrics, isTaskRunActive, writeMetricsOnExit
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from cachetools import cached, TTLCache
-cache = TTLCache(maxsize=100, ttl=300)
-
-
-@cached(cache)
-def get_instance(rg_name, vm_name):
-    return computeClient.virtual_machines.instance_view(rg_name, vm_name)
+from dryrun import createFixtureAzureClient, loadFixtures
 
 
 def purge_filter(resource, resource_group_name = None):
@@ -36,7 +30,25 @@ def purge_filter(resource, resource_group_name = None):
         return False
 
 
-if 'TASKCLUSTER_PROXY_URL' in os.environ:
+# group names given on the command line are purged in a single run. the name `default` stands for the groups selected by
+# purge_filter, which is also what is purged when no group is named.
+parser = argparse.ArgumentParser(description = 'delete orphaned and redundant azure resources')
+parser.add_argument('groups', nargs = '*', default = ['default'], help = 'resource groups to purge (default: the groups selected by purge_filter)')
+parser.add_argument('--max-workers', type = int, default = 16, help = 'maximum concurrent deletions, across all groups (default: 16)')
+parser.add_argument('--retain', type = int, default = 2, help = 'machine images and snapshots kept per key in each group, in addition to those in use (default: 2)')
+parser.add_argument('--poll-timeout', type = int, default = 900, help = 'seconds to wait for each deletion to complete (default: 900)')
+parser.add_argument('--plan', metavar = 'PATH', help = 'write the deletion plan as json to PATH instead of deleting anything')
+parser.add_argument('--fixtures', metavar = 'PATH', help = 'purge the subscription described by the `azure` section of a fixtures file (yaml or json) instead of azure')
+args = parser.parse_args()
+
+# outbound call counts and timings are written to CIB_METRICS_PATH, when set
+if 'CIB_METRICS_PATH' in os.environ:
+    writeMetricsOnExit(os.environ['CIB_METRICS_PATH'])
+
+if args.fixtures:
+    fixtures = loadFixtures(args.fixtures)
+    print('info: purging fixtures from: {}'.format(args.fixtures))
+elif 'TASKCLUSTER_PROXY_URL' in os.environ:
     secretsClient = taskcluster.Secrets({ 'rootUrl': os.environ['TASKCLUSTER_PROXY_URL'] })
     secret = secretsClient.get('project/relops/image-builder/dev')['secret']['azure']
     print('secrets fetched using taskcluster proxy')
@@ -51,74 +63,206 @@ else:
     print('failed to obtain taskcluster secrets')
     exit(1)
 
-#azureCredentials = ServicePrincipalCredentials(client_id = secret['id'], secret = secret['key'], tenant = secret['account'])
-azureCredentials = ClientSecretCredential(tenant_id=secret['account'], client_id=secret['id'], client_secret=secret['key'])
-computeClient = ComputeManagementClient(azureCredentials, secret['subscription'])
-networkClient = NetworkManagementClient(azureCredentials, secret['subscription'])
-resourceClient = ResourceManagementClient(azureCredentials, secret['subscription'])
+computeClient = InstrumentedClient(createFixtureAzureClient('compute') if args.fixtures else createAzureClient('compute', secret), 'azure-compute')
+networkClient = InstrumentedClient(createFixtureAzureClient('network') if args.fixtures else createAzureClient('network', secret), 'azure-network')
+resourceClient = InstrumentedClient(createFixtureAzureClient('resource') if args.fixtures else createAzureClient('resource', secret), 'azure-resource')
 
+configIndex = getConfigIndex()
 allGroups = list(resourceClient.resource_groups.list())
-targetGroups = sys.argv[1:] if len(sys.argv) > 1 else list(map(lambda x: x.name, filter(purge_filter, allGroups)))
+targetGroups = []
+for group in args.groups:
+    for name in (list(map(lambda x: x.name, filter(purge_filter, allGroups))) if group == 'default' else [group]):
+        if name not in targetGroups:
+            targetGroups.append(name)
+
+
+# build-machine-image.ps1 deallocates and generalizes its build instance while it captures the machine image and
+# snapshot, so a deallocated instance may belong to a build in progress. instances created less than six hours ago, and
+# instances tagged with the machineImageTask of a run that is still pending or running, are kept.
+def is_build_instance(virtual_machine):
+    time_created = getattr(virtual_machine, 'time_created', None)
+    if time_created is not None and time_created > (datetime.now(time_created.tzinfo) - timedelta(hours=6)):
+        return True
+    task_run = (getattr(virtual_machine, 'tags', None) or {}).get('machineImageTask')
+    return task_run is not None and isTaskRunActive(task_run)
+
+
 resource_descriptors = {
-    #'virtual machine': {
-    #    'filter-descriptor': 'deallocated',
-    #    'list': computeClient.virtual_machines.list,
-    #    'purge': computeClient.virtual_machines.delete,
-    #    'filter': lambda virtual_machine, resource_group_name: virtual_machine.provisioning_state == 'Succeeded' and any(status for status in get_instance(resource_group_name, virtual_machine.name).statuses if status.code == 'PowerState/deallocated')
-    #},
+    # power states come from the resource graph, which lists the instance views of all virtual machines in one paged call
+    'virtual machine': {
+        'filter-descriptor': 'deallocated',
+        'purge': computeClient.virtual_machines.begin_delete,
+        'retain': lambda virtual_machine: not (virtual_machine.provisioning_state == 'Succeeded' and resourceGraph.getPowerState(virtual_machine.id) == 'deallocated') or is_build_instance(virtual_machine)
+    },
+    # network resources and disks are purged when the subscription's resource graph shows that no virtual machine (or
+    # resource outside the graph) references them, directly or through another resource. `retain` keeps resources that
+    # are unreferenced by design.
     'network interface': {
         'filter-descriptor': 'orphaned',
-        'list': networkClient.network_interfaces.list,
-        'purge': networkClient.network_interfaces.begin_delete,
-        'filter': lambda network_interface, resource_group_name: network_interface.virtual_machine is None
+        'purge': networkClient.network_interfaces.begin_delete
     },
+    # an unreferenced public ip address that still holds an address is static or reserved, and is kept
     'public ip address': {
         'filter-descriptor': 'orphaned',
-        'list': networkClient.public_ip_addresses.list,
         'purge': networkClient.public_ip_addresses.begin_delete,
-        'filter': lambda public_ip_address, resource_group_name: public_ip_address.ip_address is None
+        'retain': lambda public_ip_address: public_ip_address.ip_address is not None
     },
     'network security group': {
-        'filter-descriptor': 'redundant',
-        'list': networkClient.network_security_groups.list,
+        'filter-descriptor': 'orphaned',
         'purge': networkClient.network_security_groups.begin_delete,
-        'filter': lambda network_security_group, resource_group_name: network_security_group.name[0:4] != 'nsg-'
+        'retain': lambda network_security_group: network_security_group.name[0:4] == 'nsg-'
     },
     'virtual network': {
-        'filter-descriptor': 'redundant',
-        'list': networkClient.virtual_networks.list,
+        'filter-descriptor': 'orphaned',
         'purge': networkClient.virtual_networks.begin_delete,
-        'filter': lambda virtual_network, resource_group_name: virtual_network.name[0:3] != 'vn-'
+        'retain': lambda virtual_network: virtual_network.name[0:3] == 'vn-'
     },
     'disk': {
         'filter-descriptor': 'orphaned',
-        'list': computeClient.disks.list_by_resource_group,
         'purge': computeClient.disks.begin_delete,
-        'filter': lambda disk, resource_group_name: ((disk.disk_state == 'Unattached') or ((disk.disk_state == 'ReadyToUpload') and (disk.time_created < (datetime.now(disk.time_created.tzinfo) - timedelta(hours=6)))))
+        # disks being uploaded or exported are unreferenced while in use. uploads abandoned for more than six hours are purged.
+        # disks of a purged virtual machine are released when the virtual machine tier completes.
+        'retain': lambda disk: disk.managed_by is None and not ((disk.disk_state == 'Unattached') or ((disk.disk_state == 'ReadyToUpload') and (disk.time_created < (datetime.now(disk.time_created.tzinfo) - timedelta(hours=6)))))
+    },
+    # machine images and snapshots are retained per worker type (key): the newest --retain of each, and any image that a
+    # worker pool launch config references, are kept. see getImageRetention.
+    'image': {
+        'filter-descriptor': 'superseded',
+        'purge': computeClient.images.begin_delete
+    },
+    'snapshot': {
+        'filter-descriptor': 'superseded',
+        'purge': computeClient.snapshots.begin_delete
     }
-    #,
-    # commented out because this filter does not work for resource groups that have multiple worker types (eg: gecko-t). need to also filter on worker type.
-    #'image': {
-    #    'filter-descriptor': 'orphaned',
-    #    'list': computeClient.images.list_by_resource_group,
-    #    'purge': computeClient.images.delete,
-    #    # filter below will delete all images that have deploymentId and machineImageCommitTime tags, except the two most recent images that have deploymentId and machineImageCommitTime tags
-    #    'filter': lambda image, resource_group_name: image.tags and 'deploymentId' in image.tags and 'machineImageCommitTime' in image.tags and image.name not in list(map(lambda ni: ni.name, list(sorted(filter(lambda i: i.tags and 'deploymentId' in i.tags and 'machineImageCommitTime' in i.tags, computeClient.images.list_by_resource_group(resource_group_name)), key = lambda x: x.tags['machineImageCommitTime'], reverse = True))[0:2]))
-    #}
 }
 
-print('scanning subscription (total resource groups: {}, target resource groups: {}): '.format(len(allGroups), len(targetGroups)))
+# deletions are made a tier at a time within each group, so that a resource is only deleted once the resources that
+# reference it are gone (a virtual network cannot be deleted while a network interface is attached to one of its
+# subnets). the graph already treats a resource that is only referenced by orphans as an orphan, so no tier needs to be
+# listed again.
+purge_tiers = [
+    'virtual machine',
+    'network interface',
+    'public ip address',
+    'network security group',
+    'virtual network',
+    'disk',
+    'image',
+    'snapshot'
+]
+outcomes = []
+outcomes_lock = threading.Lock()
+
+
+def purge_resource(group, resource_type, resource_name):
+    try:
+        poller = resource_descriptors[resource_type]['purge'](*[group, resource_name])
+        poller.result(timeout = args.poll_timeout)
+        outcome = 'deleted' if poller.done() else 'pending'
+    except BaseException as e:
+        outcome = 'failed: {}'.format(str(e).splitlines()[0] if str(e) else e.__class__.__name__)
+    print('info: {} {} in {}: {}'.format(resource_type, resource_name, group, outcome))
+    with outcomes_lock:
+        outcomes.append((group, resource_type, resource_name, outcome))
+    return outcome
+
+
+def is_root(azure_resource):
+    resource_descriptor = resource_descriptors.get(azure_resource.kind)
+    return resource_descriptor is None or resource_descriptor.get('retain', lambda resource: False)(azure_resource.resource)
+
+
+# each group's images and snapshots are listed once. a group that cannot be listed keeps all of its images and snapshots.
+def get_group_image_retention(group):
+    try:
+        images = list(computeClient.images.list_by_resource_group(group))
+        snapshots = list(computeClient.snapshots.list_by_resource_group(group))
+    except BaseException as e:
+        print('error: failed to list images and snapshots in {}. {}'.format(group, e))
+        with outcomes_lock:
+            outcomes.append((group, 'image', None, 'failed: list'))
+        return []
+    return getImageRetention(group, images, snapshots, configIndex['keys'], args.retain, liveImageIds)
+
+
+def purge_group(group, executor):
+    for resource_type in purge_tiers:
+        group_deletions = deletions[(group.lower(), resource_type)]
+        print('info: {} {}{} in {} (total: {}, {}: {})'.format(len(group_deletions), resource_type, 'es' if resource_type[-1] == 's' else 's', group, resource_counts[(group.lower(), resource_type)], resource_descriptors[resource_type]['filter-descriptor'], len(group_deletions)))
+        # deletions share one bounded pool across all groups. the tier completes before the next tier is deleted.
+        for future in [executor.submit(purge_resource, group, resource_type, entry['name']) for entry in group_deletions]:
+            future.result()
+
+
+# why the graph holds an orphan to be unused, and the planned deletions that must complete before it can be deleted
+def get_orphan_reason(azure_resource):
+    if azure_resource.kind == 'virtual machine':
+        return 'deallocated', []
+    referrers = [resourceGraph.resources[r] for r in sorted(resourceGraph.referrers.get(azure_resource.id, [])) if r in resourceGraph.resources]
+    if not referrers:
+        return 'not referenced by any virtual machine or other resource', []
+    return 'only referenced by unused resources: {}'.format(', '.join('{} {}'.format(r.kind, r.name) for r in referrers)), [r.id for r in referrers if r.id in planned_ids]
+
+
+print('scanning subscription (total resource groups: {}, target resource groups: {}): {}'.format(len(allGroups), len(targetGroups), ', '.join(targetGroups)))
+try:
+    resourceGraph = AzureResourceGraph({ 'compute': computeClient, 'network': networkClient }, powerStates = True).load()
+except BaseException as e:
+    print('error: failed to build the subscription resource graph. {}'.format(e))
+    exit(123)
+orphans = resourceGraph.getOrphans(targetGroups, isRoot = is_root)
+print('info: {} resources in subscription, {} orphaned in target resource groups'.format(len(resourceGraph.resources), len(orphans)))
+resource_counts = collections.Counter((r.group.lower(), r.kind) for r in resourceGraph.resources.values())
+planned_ids = set(azure_resource.id for azure_resource in orphans)
+# each deletion is estimated at two calls: the delete request and at least one poll of the operation status
+deletions = collections.defaultdict(list)
+for azure_resource in orphans:
+    reason, depends_on = get_orphan_reason(azure_resource)
+    deletions[(azure_resource.group.lower(), azure_resource.kind)].append({ 'id': azure_resource.id, 'kind': azure_resource.kind, 'group': azure_resource.group, 'name': azure_resource.name, 'reason': reason, 'dependsOn': depends_on, 'estimatedApiCalls': 2 })
+
+try:
+    liveImageIds = set(id.lower() for id in fixtures.get('azure', {}).get('workerPoolImageIds', [])) if args.fixtures else getLiveWorkerPoolImageIds()
+    print('info: {} machine images are referenced by worker pool launch configs'.format(len(liveImageIds)))
+except BaseException as e:
+    liveImageIds = None
+    print('error: failed to list worker pool launch configs, no machine images or snapshots will be purged. {}'.format(e))
+if liveImageIds is not None:
+    with ThreadPoolExecutor(max_workers = max(len(targetGroups), 1)) as groupExecutor:
+        for decision in [decision for decisions in groupExecutor.map(get_group_image_retention, targetGroups) for decision in decisions]:
+            resource_counts[(decision.group.lower(), decision.kind)] += 1
+            if not decision.retain:
+                deletions[(decision.group.lower(), decision.kind)].append({ 'id': decision.resource.id.lower(), 'kind': decision.kind, 'group': decision.group, 'name': decision.name, 'reason': decision.reason, 'dependsOn': [], 'estimatedApiCalls': 2 })
+
+if args.plan:
+    inventoryCalls = sum(service['count'] for service in getMetrics()['calls'].values())
+    plan = {
+        'groups': targetGroups,
+        'tiers': purge_tiers,
+        'deletions': [dict(entry, tier = tier) for tier, resource_type in enumerate(purge_tiers) for group in targetGroups for entry in deletions[(group.lower(), resource_type)]],
+        'retained': { resource_type: sum(resource_counts[(group.lower(), resource_type)] for group in targetGroups) - sum(len(deletions[(group.lower(), resource_type)]) for group in targetGroups) for resource_type in purge_tiers }
+    }
+    plan['estimatedApiCalls'] = {
+        'inventory': inventoryCalls,
+        'deletions': sum(entry['estimatedApiCalls'] for entry in plan['deletions'])
+    }
+    plan['estimatedApiCalls']['total'] = plan['estimatedApiCalls']['inventory'] + plan['estimatedApiCalls']['deletions']
+    with open(args.plan, 'w') as planFile:
+        json.dump(plan, planFile, indent = 2)
+    print('info: deletion plan for {} resources written to: {} (estimated api calls: {})'.format(len(plan['deletions']), args.plan, plan['estimatedApiCalls']['total']))
+    quit()
+
+with ThreadPoolExecutor(max_workers = args.max_workers) as purgeExecutor, ThreadPoolExecutor(max_workers = max(len(targetGroups), 1)) as groupExecutor:
+    for future in [groupExecutor.submit(purge_group, group, purgeExecutor) for group in targetGroups]:
+        future.result()
+
+print('purge outcomes:')
 for group in targetGroups:
-    print('- scanning resource group {}:'.format(group))
-    for resource_type, resource_descriptor in resource_descriptors.items():
-        all_resources = list(resource_descriptor['list'](**{'resource_group_name': group}))
-        filtered_resources = list(filter(lambda x: resource_descriptor['filter'](x, group), all_resources))
-        print('    - {}{}:'.format(resource_type, 'es' if resource_type[-1] == 's' else 's'))
-        print('        - total: {}'.format(len(all_resources)))
-        print('        - {}: {}'.format(resource_descriptor['filter-descriptor'], len(filtered_resources)))
-        for resource_item in filtered_resources:
-            try:
-                resource_descriptor['purge'](*[group, resource_item.name])
-                print('            - deleted: {}'.format(resource_item.name))
-            except BaseException as e:
-                print('            - failed to delete: {}. {}'.format(resource_item.name, str(e)))
+    groupOutcomes = [outcome for outcome in outcomes if outcome[0] == group]
+    print('- {}:'.format(group))
+    for resource_type in purge_tiers:
+        typeOutcomes = [outcome for outcome in groupOutcomes if outcome[1] == resource_type]
+        if typeOutcomes:
+            print('    - {}{}: {}'.format(resource_type, 'es' if resource_type[-1] == 's' else 's', ', '.join('{} {}'.format(len([o for o in typeOutcomes if o[3].split(':')[0] == status]), status) for status in ['deleted', 'pending', 'failed'] if any(o[3].split(':')[0] == status for o in typeOutcomes))))
+            for outcome in typeOutcomes:
+                if outcome[3] != 'deleted':
+                    print('        - {}: {}'.format(outcome[2], outcome[3]))
@@ -1,6 +1,6 @@
 import os
 import taskcluster
-from cib import updateRole
+from cib import ConfigReconciler, parseCommitDirectives
 
 
 currentEnvironment = 'staging' if 'stage.taskcluster.nonprod' in os.environ['TASKCLUSTER_ROOT_URL'] else 'production'
@@ -8,33 +8,29 @@ includeEnvironments = [
   'production',
   'staging'
 ]
-lines = os.getenv('TRAVIS_COMMIT_MESSAGE').splitlines()
+commitDirectives = parseCommitDirectives(os.getenv('TRAVIS_COMMIT'), os.getenv('TRAVIS_COMMIT_MESSAGE'))
 
-if any(line.lower().strip() == 'no-ci' or line.lower().strip() == 'no-travis-ci' for line in lines):
+if commitDirectives.skips('travis'):
   print('info: **no ci** commit syntax detected. skipping pool and role checks')
   quit()
 
-if any(line.lower().startswith('include environments:') for line in lines):
-  includeEnvironments = list(map(lambda x: x.lower().strip(), next(line for line in lines if line.startswith('include environments:')).replace('include environments:', '').split(',')))
-  print('info: **include environments** commit syntax detected. ci will process environments: {}'.format(', '.join(includeEnvironments)))
-elif any(line.lower().startswith('exclude environments:') for line in lines):
-  includeEnvironments = list(filter(lambda x: x not in map(lambda x: x.lower().strip(), next(line for line in lines if line.lower().startswith('exclude environments:')).replace('exclude environments:', '').split(',')), includeEnvironments))
-  print('info: **exclude environments** commit syntax detected. ci will process environments: {}'.format(', '.join(includeEnvironments)))
+if commitDirectives.environments is not None:
+  includeEnvironments = commitDirectives.filter('environments', includeEnvironments)
+  print('info: {}. ci will process environments: {}'.format(commitDirectives.describe('environments'), ', '.join(includeEnvironments)))
 if currentEnvironment not in includeEnvironments:
   print('info: current environment ({}) is excluded. skipping pool and role checks'.format(currentEnvironment))
   quit()
 
 
-taskclusterAuth = taskcluster.Auth(taskcluster.optionsFromEnvironment())
-taskclusterWorkerManager = taskcluster.WorkerManager(taskcluster.optionsFromEnvironment())
-
-updateRole(
-  auth = taskclusterAuth,
-  configPath = 'ci/config/role/branch-main.yaml',
-  roleId = 'repo:github.com/mozilla-platform-ops/cloud-image-builder:branch:main')
-
-for pool in ['gecko-t/win10-64-azure', 'gecko-t/win7-32-azure']:
-  updateRole(
-    auth = taskclusterAuth,
-    configPath = 'ci/config/role/{}/{}.yaml'.format(currentEnvironment, pool),
-    roleId = 'worker-pool:{}'.format(pool))
+# roles, hooks and clients declared under ci/config are reconciled together: live state is fetched concurrently and
+# only the definitions that differ from taskcluster are written. hooks and clients that these credentials may not read
+# or write are skipped with a warning.
+reconciler = ConfigReconciler(
+  auth = taskcluster.Auth(taskcluster.optionsFromEnvironment()),
+  hooks = taskcluster.Hooks(taskcluster.optionsFromEnvironment()),
+  environment = currentEnvironment)
+resources = reconciler.reconcile()
+failures = [resource for resource in resources if resource['outcome'] == 'failed']
+print('info: {} resources checked, {} changed, {} skipped, {} failed'.format(len(resources), len([resource for resource in resources if resource['outcome'] in ['created', 'updated']]), len([resource for resource in resources if resource['outcome'] == 'skipped']), len(failures)))
+if failures:
+  exit(1)
@@ -1,22 +1,16 @@
-import json
 import os
+import requests
 import taskcluster
-import urllib.error
-import urllib.request
+from cib import getGitHubClient
 
-from cachetools import cached, TTLCache
-cache = TTLCache(maxsize=100, ttl=300)
 
-
-@cached(cache)
 def get_commits(org, repo):
     try:
-        response = urllib.request.urlopen('https://api.github.com/repos/{}/{}/commits'.format(org, repo))
-    except urllib.error.HTTPError as e:
-        print('error code {} on commits lookup for {}/{}'.format(e.code, org, repo))
-        print(e.read())
-        exit(123 if e.code == 403 else 1)
-    return json.loads(response.read().decode())
+        yield from getGitHubClient().getCommits(org, repo)
+    except requests.HTTPError as e:
+        print('error code {} on commits lookup for {}/{}'.format(e.response.status_code, org, repo))
+        print(e.response.text)
+        exit(123 if e.response.status_code == 403 else 1)
 
 
 runEnvironment = 'travis' if os.getenv('TRAVIS_COMMIT') is not None else 'taskcluster' if os.getenv('TASK_ID') is not None else 'local'
@@ -28,13 +22,18 @@ tasks = index.listTasks('project.relops.cloud-image-builder.decision.revision')[
 task_shas = list(map(lambda task: task['namespace'].split('.')[-1], tasks))
 
 repo_shas = map(lambda commit: commit['sha'], get_commits('mozilla-platform-ops', 'cloud-image-builder'))
+unseen_task_shas = set(task_shas)
 print('- repo shas:')
 for repo_sha in repo_shas:
     if repo_sha in task_shas:
         task = next(task for task in tasks if task['namespace'].split('.')[-1] == repo_sha)
         print('    - {} (task: {})'.format(repo_sha, task['taskId']))
+        unseen_task_shas.discard(repo_sha)
     else:
         print('    - {}'.format(repo_sha))
+    # commit history is paged lazily, so stop once every revision with a decision task has been listed
+    if not unseen_task_shas:
+        break
 
 print('- task shas ({}):'.format(len(task_shas)))
 for task_sha in task_shas:
@@ -1,14 +1,13 @@
+import itertools
 import json
 import os
 import re
 import requests
 import taskcluster
-import urllib.error
 import urllib.request
 import yaml
-#from azure.common.credentials import ServicePrincipalCredentials
-from azure.identity import ClientSecretCredential
-from azure.mgmt.compute import ComputeManagementClient
+from concurrent.futures import ThreadPoolExecutor
+from cib import createAzureClient, getCommitTime, getConfigRevisionIndex, getDigest, getGitHubClient
 
 from cachetools import cached, TTLCache
 cache = TTLCache(maxsize=100, ttl=300)
@@ -16,40 +15,53 @@ cache = TTLCache(maxsize=100, ttl=300)
 
 @cached(cache)
 def get_commit(org, repo, revision):
-    commit = next((c for c in get_commits(org, repo) if c['sha'].startswith(revision)), None)
-    if commit is not None:
-        return commit
     try:
-        response = urllib.request.urlopen('https://api.github.com/repos/{}/{}/commits/{}'.format(org, repo, revision))
-    except urllib.error.HTTPError as e:
-        print('tag-machine-images/get_commits :: error code {} on commit lookup for {}/{}/{}'.format(e.code, org, repo, revision))
-        print(e.read())
-        exit(123 if e.code == 403 else 1)
-    return json.loads(response.read().decode())
+        return getGitHubClient().getCommit(org, repo, revision)
+    except requests.HTTPError as e:
+        print('tag-machine-images/get_commit :: error code {} on commit lookup for {}/{}/{}'.format(e.response.status_code, org, repo, revision))
+        print(e.response.text)
+        exit(123 if e.response.status_code == 403 else 1)
 
-@cached(cache)
 def get_commits(org, repo):
     try:
-        response = urllib.request.urlopen('https://api.github.com/repos/{}/{}/commits'.format(org, repo))
-    except urllib.error.HTTPError as e:
-        print('tag-machine-images/get_commits :: error code {} on commits lookup for {}/{}'.format(e.code, org, repo))
-        print(e.read())
-        exit(123 if e.code == 403 else 1)
-    return json.loads(response.read().decode())
+        yield from getGitHubClient().getCommits(org, repo)
+    except requests.HTTPError as e:
+        print('tag-machine-images/get_commits :: error code {} on commits lookup for {}/{}'.format(e.response.status_code, org, repo))
+        print(e.response.text)
+        exit(123 if e.response.status_code == 403 else 1)
 
 # we don't know the machineImageRevision
 # which is the cib revision responsible for having built the machine image
 # we only know that it is newer than diskImageRevision
 # and that the config we are interested in contains bootstrapRevision
-# this implementation returns the newest config meeting those conditions
-# obviously, this is less than ideal
+# this implementation returns the oldest commit meeting those conditions, from the newest range of config/{key}.yaml
+# versions that declared bootstrapRevision for the group. the range is looked up in an index built once per key from
+# local git history.
 @cached(cache)
 def guess_config(key, group, diskImageRevision, bootstrapRevision):
-    commits = get_commits('mozilla-platform-ops', 'cloud-image-builder')
-    cut_index = next((i for i, c in enumerate(commits) if c['sha'].startswith(diskImageRevision)), len(commits) - 1)
+    diskImageCommit = getCommitTime(diskImageRevision)
+    if diskImageCommit is None:
+        print('tag-machine-images/guess_config :: disk image revision: {} is not in the local git history. falling back to github'.format(diskImageRevision))
+        return guess_config_from_github(key, group, diskImageRevision, bootstrapRevision)
+    diskImageCommitSha, diskImageCommitTime = diskImageCommit
+    revisionRange = getConfigRevisionIndex(key).findRange(group, bootstrapRevision, notBefore = diskImageCommitTime)
+    if revisionRange is None:
+        print('tag-machine-images/guess_config :: no config/{}.yaml version newer than disk image revision: {} declares deployment id or source revision: {}, for group: {}'.format(key, diskImageRevision, bootstrapRevision, group))
+        return None, None
+    print('tag-machine-images/guess_config :: observed deployment id: {}, source revision: {}, for group: {}, in config/{}.yaml from revision: {}'.format(revisionRange.deploymentId, revisionRange.sourceRevision, group, key, revisionRange.versions[0].sha))
+    # a config version that predates the disk image was first built into a machine image at the disk image revision
+    if revisionRange.versions[0].time >= diskImageCommitTime:
+        return revisionRange.versions[0].sha, revisionRange.versions[0].config
+    return diskImageCommitSha, [version for version in revisionRange.versions if version.time <= diskImageCommitTime][-1].config
+
+
+# used when the local history is incomplete (eg: a shallow clone)
+def guess_config_from_github(key, group, diskImageRevision, bootstrapRevision):
+    # commits are fetched a page at a time, only as far back as the disk image revision
+    commits = itertools.takewhile(lambda c: not c['sha'].startswith(diskImageRevision), get_commits('mozilla-platform-ops', 'cloud-image-builder'))
     config = None
     sha = None
-    for commit in commits[0:cut_index]:
+    for commit in commits:
         configUrl = 'https://raw.githubusercontent.com/mozilla-platform-ops/cloud-image-builder/{}/config/{}.yaml'.format(commit['sha'], key)
         if requests.head(configUrl).status_code == requests.codes.ok:
             try:
@@ -77,139 +89,137 @@ secret = secretsClient.get('project/relops/image-builder/dev')['secret']
 platform = os.getenv('platform')
 group = os.getenv('group')
 key = os.getenv('key')
+# concurrent tag updates, across images and snapshots
+maxTagWorkers = int(os.getenv('maxTagWorkers', '8'))
 
 print('platform: {}'.format(platform))
 print('group: {}'.format(group))
 print('key: {}'.format(key))
 
+
+# a complete tag set carries a fingerprint of the resource name (which holds the group, key, disk image revision and
+# bootstrap revision) and of all its other tag values, including those written by the build. a resource whose
+# fingerprint still matches is skipped before any github or config lookup. values are fingerprinted as the strings
+# azure stores them as. bump the version to re-derive the tags of every image and snapshot.
+tagFingerprintName = 'tagFingerprint'
+tagFingerprintVersion = 1
+
+
+def get_tag_fingerprint(resourceName, tags):
+    return getDigest({ 'version': tagFingerprintVersion, 'name': resourceName, 'tags': { k: str(v) for k, v in tags.items() if k != tagFingerprintName } })
+
+
+def has_current_tags(resource):
+    return bool(resource.tags) and resource.tags.get(tagFingerprintName) == get_tag_fingerprint(resource.name, resource.tags)
+
+
+# merges derived tags over the existing tags of a resource (a tags-only update replaces the whole tag set, so the tags
+# written by the build must be carried over). only a complete tag set is fingerprinted, so that a resource with a disk
+# image tag subset is derived again on the next run
+def merge_tags(resource, derived, complete):
+    tags = { k: v for k, v in (resource.tags or {}).items() if k != tagFingerprintName }
+    tags.update(derived)
+    if complete:
+        tags[tagFingerprintName] = get_tag_fingerprint(resource.name, tags)
+    return tags
+
+
+# derives the provenance tags of a machine image or snapshot named {group}-{key}-{diskImageRevision}-{bootstrapRevision}
+def get_tags(kind, resource, diskImageRevision, bootstrapRevision):
+    print('tag-machine-images :: {}: {}, has disk image revision: {} (mozilla-platform-ops/cloud-image-builder)'.format(kind, resource.name, diskImageRevision))
+    diskImageCommit = get_commit('mozilla-platform-ops', 'cloud-image-builder', diskImageRevision)
+    if resource.tags:
+        print('tag-machine-images :: {} has tags: {}'.format(kind, ', '.join(['%s: %s' % (k, v) for (k, v) in resource.tags.items()])))
+        print('tag-machine-images :: updating tags...')
+    else:
+        print('tag-machine-images :: {} has no tags. creating tags...'.format(kind))
+    machineImageCommitSha, config = guess_config(key, group, diskImageRevision, bootstrapRevision)
+    if config is None:
+        print('tag-machine-images :: failed to guess machine image commit sha using params: key: {}, group: {}, disk image revision: {}, bootstrap revision: {}. using disk image tag subset only...'.format(key, group, diskImageRevision, bootstrapRevision))
+        return merge_tags(resource, {
+            'diskImageCommitDate': diskImageCommit['commit']['committer']['date'][0:10],
+            'diskImageCommitTime': diskImageCommit['commit']['committer']['date'],
+            'diskImageCommitSha': diskImageCommit['sha'],
+            'diskImageCommitMessage': diskImageCommit['commit']['message']
+        }, False)
+    print('tag-machine-images :: machine image commit sha guessed as {} using params: key: {}, group: {}, disk image revision: {}, bootstrap revision: {}'.format(machineImageCommitSha, key, group, diskImageRevision, bootstrapRevision))
+    configTargetGroup = next((t for t in config['target'] if t['group'] == group), None)
+    org = next((tag for tag in configTargetGroup['tag'] if tag['name'] == 'sourceOrganisation'), { 'value': '' })['value']
+    repo = next((tag for tag in configTargetGroup['tag'] if tag['name'] == 'sourceRepository'), { 'value': '' })['value']
+    print('tag-machine-images :: {}: {}, has bootstrap revision: {} ({}/{})'.format(kind, resource.name, bootstrapRevision, org, repo))
+    bootstrapCommit = get_commit(org, repo, bootstrapRevision)
+    return merge_tags(resource, {
+        'deploymentId': bootstrapRevision,
+        'diskImageCommitDate': diskImageCommit['commit']['committer']['date'][0:10],
+        'diskImageCommitTime': diskImageCommit['commit']['committer']['date'],
+        'diskImageCommitSha': diskImageCommit['sha'],
+        'diskImageCommitMessage': diskImageCommit['commit']['message'].split('\n')[0],
+
+        #'machineImageCommitDate': machineImageCommit['commit']['committer']['date'][0:10],
+        #'machineImageCommitTime': machineImageCommit['commit']['committer']['date'],
+        'machineImageCommitSha': machineImageCommitSha,
+        #'machineImageCommitSha': machineImageCommit['sha'],
+        #'machineImageCommitMessage': machineImageCommit['commit']['message'].split('\n')[0],
+
+        'bootstrapCommitDate': bootstrapCommit['commit']['committer']['date'][0:10],
+        'bootstrapCommitTime': bootstrapCommit['commit']['committer']['date'],
+        'bootstrapCommitSha': bootstrapCommit['sha'],
+        'bootstrapCommitMessage': bootstrapCommit['commit']['message'].split('\n')[0],
+        'bootstrapCommitOrg': org,
+        'bootstrapCommitRepo': repo,
+
+        'isoName': os.path.basename(config['iso']['source']['key']),
+        'isoIndex': config['iso']['wimindex'],
+        'os': config['image']['os'],
+        'edition': config['image']['edition'],
+        'language': config['image']['language'],
+        'architecture': config['image']['architecture']
+    }, True)
+
+
+# tags are written with a tags-only update (a PATCH of the tags property), rather than a PUT of the whole resource. the
+# patch replaces the whole tag set, so get_tags returns the derived tags merged into the existing ones, keeping the tags
+# written by the build (machineImageCommitTime, machineImageTask, imageKey, resourceId and the target tags), which image
+# lookups and retention depend on
+def update_tags(kind, resource, tags):
+    from azure.mgmt.compute.models import ImageUpdate, SnapshotUpdate
+    if kind == 'image':
+        poller = azureComputeManagementClient.images.begin_update(group, resource.name, ImageUpdate(tags = tags))
+    else:
+        poller = azureComputeManagementClient.snapshots.begin_update(group, resource.name, SnapshotUpdate(tags = tags))
+    poller.result()
+    print('tag-machine-images :: {} {} tags updated'.format(kind, resource.name))
+    print(', '.join(['%s:: %s' % (k, v) for (k, v) in tags.items()]))
+
+
 if platform == 'azure':
-    azureComputeManagementClient = ComputeManagementClient(
-        #ServicePrincipalCredentials(
-        #    client_id = secret['azure']['id'],
-        #    secret = secret['azure']['key'],
-        #    tenant = secret['azure']['account']),
-        ClientSecretCredential(
-            tenant_id=secret['azure']['account'],
-            client_id=secret['azure']['id'],
-            client_secret=secret['azure']['key']),
-        secret['azure']['subscription'])
+    azureComputeManagementClient = createAzureClient('compute', secret['azure'])
 
     pattern = re.compile('^{}-{}-([a-f0-9]{{7}})-([a-f0-9]{{7}})$'.format(group.replace('rg-', ''), key))
     images = list([x for x in azureComputeManagementClient.images.list_by_resource_group(group) if pattern.match(x.name)])
     print('tag-machine-images :: found: {} images matching pattern: {}-{}-(disk-sha)-(deployment-id)'.format(len(images), group.replace('rg-', ''), key))
-    for image in images:
-        diskImageRevision = pattern.search(image.name).group(1)
-        bootstrapRevision = pattern.search(image.name).group(2)
-        print('tag-machine-images :: image: {}, has disk image revision: {} (mozilla-platform-ops/cloud-image-builder)'.format(image.name, diskImageRevision))
-        diskImageCommit = get_commit('mozilla-platform-ops', 'cloud-image-builder', diskImageRevision)
-        if image.tags:
-            print('tag-machine-images :: image has tags: {}'.format(', '.join(['%s: %s' % (k, v) for (k, v) in image.tags.items()])))
-            print('tag-machine-images :: updating tags...')
-        else:
-            print('tag-machine-images :: image has no tags. creating tags...')
-        machineImageCommitSha, config = guess_config(key, group, diskImageRevision, bootstrapRevision)
-        if config is not None:
-            print('tag-machine-images :: machine image commit sha guessed as {} using params: key: {}, group: {}, disk image revision: {}, bootstrap revision: {}'.format(machineImageCommitSha, key, group, diskImageRevision, bootstrapRevision))
-            configTargetGroup = next((t for t in config['target'] if t['group'] == group), None)
-            org = next((tag for tag in configTargetGroup['tag'] if tag['name'] == 'sourceOrganisation'), { 'value': '' })['value']
-            repo = next((tag for tag in configTargetGroup['tag'] if tag['name'] == 'sourceRepository'), { 'value': '' })['value']
-            print('tag-machine-images :: image: {}, has bootstrap revision: {} ({}/{})'.format(image.name, bootstrapRevision, org, repo))
-            bootstrapCommit = get_commit(org, repo, bootstrapRevision)
-            image.tags = {
-                'deploymentId': bootstrapRevision,
-                'diskImageCommitDate': diskImageCommit['commit']['committer']['date'][0:10],
-                'diskImageCommitTime': diskImageCommit['commit']['committer']['date'],
-                'diskImageCommitSha': diskImageCommit['sha'],
-                'diskImageCommitMessage': diskImageCommit['commit']['message'].split('\n')[0],
-
-                #'machineImageCommitDate': machineImageCommit['commit']['committer']['date'][0:10],
-                #'machineImageCommitTime': machineImageCommit['commit']['committer']['date'],
-                'machineImageCommitSha': machineImageCommitSha,
-                #'machineImageCommitSha': machineImageCommit['sha'],
-                #'machineImageCommitMessage': machineImageCommit['commit']['message'].split('\n')[0],
-
-                'bootstrapCommitDate': bootstrapCommit['commit']['committer']['date'][0:10],
-                'bootstrapCommitTime': bootstrapCommit['commit']['committer']['date'],
-                'bootstrapCommitSha': bootstrapCommit['sha'],
-                'bootstrapCommitMessage': bootstrapCommit['commit']['message'].split('\n')[0],
-                'bootstrapCommitOrg': org,
-                'bootstrapCommitRepo': repo,
-
-                'isoName': os.path.basename(config['iso']['source']['key']),
-                'isoIndex': config['iso']['wimindex'],
-                'os': config['image']['os'],
-                'edition': config['image']['edition'],
-                'language': config['image']['language'],
-                'architecture': config['image']['architecture']
-            }
-        else:
-            print('tag-machine-images :: failed to guess machine image commit sha using params: key: {}, group: {}, disk image revision: {}, bootstrap revision: {}. using disk image tag subset only...'.format(key, group, diskImageRevision, bootstrapRevision))
-            image.tags = {
-                'diskImageCommitDate': diskImageCommit['commit']['committer']['date'][0:10],
-                'diskImageCommitTime': diskImageCommit['commit']['committer']['date'],
-                'diskImageCommitSha': diskImageCommit['sha'],
-                'diskImageCommitMessage': diskImageCommit['commit']['message']
-            }
-        azureComputeManagementClient.images.create_or_update(group, image.name, image)
-        print('tag-machine-images :: image tags updated')
-        print(', '.join(['%s:: %s' % (k, v) for (k, v) in image.tags.items()]))
-
     snapshots = [x for x in azureComputeManagementClient.snapshots.list_by_resource_group(group) if pattern.match(x.name)]
-    for snapshot in snapshots:
-        diskImageRevision = pattern.search(snapshot.name).group(1)
-        bootstrapRevision = pattern.search(snapshot.name).group(2)
-        print('tag-machine-images :: snapshot: {}, has disk image revision: {} (mozilla-platform-ops/cloud-image-builder)'.format(snapshot.name, diskImageRevision))
-        diskImageCommit = get_commit('mozilla-platform-ops', 'cloud-image-builder', diskImageRevision)
-        if snapshot.tags:
-            print('tag-machine-images :: snapshot has tags: {}'.format(', '.join(['%s:: %s' % (k, v) for (k, v) in snapshot.tags.items()])))
-            print('tag-machine-images :: updating tags...')
-        else:
-            print('tag-machine-images :: snapshot has no tags. creating tags...')
-        machineImageCommitSha, config = guess_config(key, group, diskImageRevision, bootstrapRevision)
-        if config is not None:
-            print('tag-machine-images :: machine image commit sha guessed as {} using params: key: {}, group: {}, disk image revision: {}, bootstrap revision: {}'.format(machineImageCommitSha, key, group, diskImageRevision, bootstrapRevision))
-            configTargetGroup = next((t for t in config['target'] if t['group'] == group), None)
-            org = next((tag for tag in configTargetGroup['tag'] if tag['name'] == 'sourceOrganisation'), { 'value': '' })['value']
-            repo = next((tag for tag in configTargetGroup['tag'] if tag['name'] == 'sourceRepository'), { 'value': '' })['value']
-            print('tag-machine-images :: snapshot: {}, has bootstrap revision: {} ({}/{})'.format(snapshot.name, bootstrapRevision, org, repo))
-            bootstrapCommit = get_commit(org, repo, bootstrapRevision)
-            snapshot.tags = {
-                'deploymentId': bootstrapRevision,
-                'diskImageCommitDate': diskImageCommit['commit']['committer']['date'][0:10],
-                'diskImageCommitTime': diskImageCommit['commit']['committer']['date'],
-                'diskImageCommitSha': diskImageCommit['sha'],
-                'diskImageCommitMessage': diskImageCommit['commit']['message'].split('\n')[0],
-
-                #'machineImageCommitDate': machineImageCommit['commit']['committer']['date'][0:10],
-                #'machineImageCommitTime': machineImageCommit['commit']['committer']['date'],
-                'machineImageCommitSha': machineImageCommitSha,
-                #'machineImageCommitSha': machineImageCommit['sha'],
-                #'machineImageCommitMessage': machineImageCommit['commit']['message'].split('\n')[0],
-
-                'bootstrapCommitDate': bootstrapCommit['commit']['committer']['date'][0:10],
-                'bootstrapCommitTime': bootstrapCommit['commit']['committer']['date'],
-                'bootstrapCommitSha': bootstrapCommit['sha'],
-                'bootstrapCommitMessage': bootstrapCommit['commit']['message'].split('\n')[0],
-                'bootstrapCommitOrg': org,
-                'bootstrapCommitRepo': repo,
-
-                'isoName': os.path.basename(config['iso']['source']['key']),
-                'isoIndex': config['iso']['wimindex'],
-                'os': config['image']['os'],
-                'edition': config['image']['edition'],
-                'language': config['image']['language'],
-                'architecture': config['image']['architecture']
-            }
-        else:
-            print('tag-machine-images :: failed to guess machine image commit sha using params: key: {}, group: {}, disk image revision: {}, bootstrap revision: {}. using disk image tag subset only...'.format(key, group, diskImageRevision, bootstrapRevision))
-            snapshot.tags = {
-                'diskImageCommitDate': diskImageCommit['commit']['committer']['date'][0:10],
-                'diskImageCommitTime': diskImageCommit['commit']['committer']['date'],
-                'diskImageCommitSha': diskImageCommit['sha'],
-                'diskImageCommitMessage': diskImageCommit['commit']['message']
-            }
-        azureComputeManagementClient.snapshots.create_or_update(group, snapshot.name, snapshot)
-        print('tag-machine-images :: snapshot tags updated')
-        print(', '.join(['%s:: %s' % (k, v) for (k, v) in snapshot.tags.items()]))
+    print('tag-machine-images :: found: {} snapshots matching pattern: {}-{}-(disk-sha)-(deployment-id)'.format(len(snapshots), group.replace('rg-', ''), key))
+
+    # images and snapshots share one pipeline: tags are derived in turn (github and config lookups are cached), then
+    # written concurrently
+    updates = []
+    skipped = 0
+    for kind, resource in [('image', x) for x in images] + [('snapshot', x) for x in snapshots]:
+        if has_current_tags(resource):
+            skipped += 1
+            continue
+        diskImageRevision, bootstrapRevision = pattern.search(resource.name).groups()
+        updates.append((kind, resource, get_tags(kind, resource, diskImageRevision, bootstrapRevision)))
+    failures = []
+    with ThreadPoolExecutor(max_workers = maxTagWorkers) as executor:
+        futures = [(kind, resource, executor.submit(update_tags, kind, resource, tags)) for kind, resource, tags in updates]
+    for kind, resource, future in futures:
+        if future.exception() is not None:
+            print('tag-machine-images :: failed to update tags on {}: {}. {}'.format(kind, resource.name, future.exception()))
+            failures.append(resource.name)
+    print('tag-machine-images :: updated tags on {} of {} images and snapshots. skipped {} whose tag fingerprint is current'.format(len(updates) - len(failures), len(updates), skipped))
+    if failures:
+        exit(1)
 else:
-    print('tag-machine-images :: skipped image and snapshot tagging. not implemented for platform: {}'.format(platform))
\ No newline at end of file
+    print('tag-machine-images :: skipped image and snapshot tagging. not implemented for platform: {}'.format(platform))
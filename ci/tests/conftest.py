@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# the ci scripts import cib (and dryrun) from the ci directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,107 @@
+import cib
+import dryrun
+import pytest
+from cib import AzureResourceGraph
+
+
+group = 'rg-east-us-gecko-t'
+
+
+def getId(provider, kind, name, resourceGroup=group):
+    return '/subscriptions/0/resourceGroups/{}/providers/{}/{}/{}'.format(resourceGroup, provider, kind, name)
+
+
+def getNetworkInterface(name, virtualMachine=None, publicIpAddress=None, networkSecurityGroup=None, virtualNetwork=None):
+    ipConfiguration = { 'id': '{}/ipConfigurations/ipconfig1'.format(getId('Microsoft.Network', 'networkInterfaces', name)) }
+    if publicIpAddress is not None:
+        ipConfiguration['public_ip_address'] = { 'id': getId('Microsoft.Network', 'publicIPAddresses', publicIpAddress) }
+    if virtualNetwork is not None:
+        ipConfiguration['subnet'] = { 'id': '{}/subnets/default'.format(getId('Microsoft.Network', 'virtualNetworks', virtualNetwork)) }
+    networkInterface = { 'id': getId('Microsoft.Network', 'networkInterfaces', name), 'name': name, 'ip_configurations': [ipConfiguration] }
+    if virtualMachine is not None:
+        networkInterface['virtual_machine'] = { 'id': getId('Microsoft.Compute', 'virtualMachines', virtualMachine) }
+    if networkSecurityGroup is not None:
+        networkInterface['network_security_group'] = { 'id': getId('Microsoft.Network', 'networkSecurityGroups', networkSecurityGroup) }
+    return networkInterface
+
+
+def getVirtualMachine(name, networkInterface, disk):
+    return {
+        'id': getId('Microsoft.Compute', 'virtualMachines', name),
+        'name': name,
+        'network_profile': { 'network_interfaces': [ { 'id': getId('Microsoft.Network', 'networkInterfaces', networkInterface) } ] },
+        'storage_profile': { 'os_disk': { 'managed_disk': { 'id': getId('Microsoft.Compute', 'disks', disk) } } }
+    }
+
+
+def getResource(provider, kind, name, **attributes):
+    return dict(id=getId(provider, kind, name), name=name, **attributes)
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    monkeypatch.setattr(cib, 'fixtures', { 'azure': {
+        'virtualMachines': [
+            getVirtualMachine('vm-a', 'ni-a', 'disk-a')
+        ],
+        'networkInterfaces': [
+            getNetworkInterface('ni-a', virtualMachine='vm-a', publicIpAddress='pip-a', networkSecurityGroup='nsg-a', virtualNetwork='vn-a'),
+            # left behind by a deleted virtual machine, it is the only thing keeping pip-b alive
+            getNetworkInterface('ni-b', publicIpAddress='pip-b', virtualNetwork='vn-a')
+        ],
+        'publicIPAddresses': [
+            getResource('Microsoft.Network', 'publicIPAddresses', 'pip-a'),
+            getResource('Microsoft.Network', 'publicIPAddresses', 'pip-b'),
+            # attached to a load balancer, which is not in the graph
+            getResource('Microsoft.Network', 'publicIPAddresses', 'pip-lb', ip_configuration={ 'id': '{}/frontendIPConfigurations/default'.format(getId('Microsoft.Network', 'loadBalancers', 'lb')) })
+        ],
+        'networkSecurityGroups': [
+            getResource('Microsoft.Network', 'networkSecurityGroups', 'nsg-a'),
+            getResource('Microsoft.Network', 'networkSecurityGroups', 'nsg-subnet'),
+            getResource('Microsoft.Network', 'networkSecurityGroups', 'nsg-unused')
+        ],
+        'virtualNetworks': [
+            getResource('Microsoft.Network', 'virtualNetworks', 'vn-a', subnets=[ { 'id': '{}/subnets/default'.format(getId('Microsoft.Network', 'virtualNetworks', 'vn-a')), 'network_security_group': { 'id': getId('Microsoft.Network', 'networkSecurityGroups', 'nsg-subnet') } } ]),
+            getResource('Microsoft.Network', 'virtualNetworks', 'vn-unused', subnets=[])
+        ],
+        'disks': [
+            getResource('Microsoft.Compute', 'disks', 'disk-a', managed_by=getId('Microsoft.Compute', 'virtualMachines', 'vm-a')),
+            getResource('Microsoft.Compute', 'disks', 'disk-b', managed_by=None),
+            # managed by a scale set, which is not in the graph
+            getResource('Microsoft.Compute', 'disks', 'disk-vmss', managed_by=getId('Microsoft.Compute', 'virtualMachineScaleSets', 'vmss'))
+        ]
+    } })
+    return AzureResourceGraph({ 'compute': dryrun.createFixtureAzureClient('compute'), 'network': dryrun.createFixtureAzureClient('network') }).load()
+
+
+def test_resources_unreachable_from_virtual_machines_are_orphans(graph):
+    assert sorted(azureResource.name for azureResource in graph.getOrphans([group])) == ['disk-b', 'ni-b', 'nsg-unused', 'pip-b', 'vn-unused']
+
+
+def test_externally_owned_resources_are_never_orphans(graph):
+    orphans = [azureResource.name for azureResource in graph.getOrphans()]
+    assert 'pip-lb' not in orphans
+    assert 'disk-vmss' not in orphans
+
+
+def test_orphans_are_limited_to_the_requested_groups(graph):
+    assert graph.getOrphans(['rg-west-us-gecko-t']) == []
+    assert len(graph.getOrphans([group.upper()])) == 5
+
+
+def test_resources_referenced_from_a_root_are_not_orphans(graph):
+    # with no virtual machine roots, everything but the externally owned resources is an orphan
+    orphans = sorted(azureResource.name for azureResource in graph.getOrphans(isRoot=lambda azureResource: False))
+    assert orphans == ['disk-a', 'disk-b', 'ni-a', 'ni-b', 'nsg-a', 'nsg-subnet', 'nsg-unused', 'pip-a', 'pip-b', 'vm-a', 'vn-a', 'vn-unused']
+    # a network interface root keeps its public ip address, network security group, virtual network and the subnet's nsg
+    orphans = sorted(azureResource.name for azureResource in graph.getOrphans(isRoot=lambda azureResource: azureResource.name == 'ni-b'))
+    assert orphans == ['disk-a', 'disk-b', 'ni-a', 'nsg-a', 'nsg-unused', 'pip-a', 'vm-a', 'vn-unused']
+
+
+def test_failed_listings_are_raised(monkeypatch, graph):
+    def fail():
+        raise RuntimeError('throttled')
+    monkeypatch.setattr(graph.clients['network'].virtual_networks, 'list_all', fail)
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    with pytest.raises(RuntimeError):
+        AzureResourceGraph(graph.clients).load()
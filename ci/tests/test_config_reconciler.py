@@ -0,0 +1,131 @@
+import pytest
+import yaml
+from cib import ConfigReconciler
+from taskcluster.exceptions import TaskclusterRestFailure
+
+
+def getRestFailure(statusCode):
+    return TaskclusterRestFailure('status {}'.format(statusCode), None, status_code=statusCode)
+
+
+# an in memory stand-in for the auth and hooks services. ids in `forbidden` answer 403 to writes
+class FakeTaskcluster:
+    def __init__(self, roles=None, hooks=None, clients=None, forbidden=()):
+        self.roles = dict(roles or {})
+        self.hookDefinitions = dict(hooks or {})
+        self.clients = dict(clients or {})
+        self.forbidden = set(forbidden)
+        self.writes = []
+
+    def write(self, resourceId, store, definition):
+        if resourceId in self.forbidden:
+            raise getRestFailure(403)
+        self.writes.append(resourceId)
+        store[resourceId] = definition
+
+    def role(self, roleId):
+        if roleId not in self.roles:
+            raise getRestFailure(404)
+        return self.roles[roleId]
+
+    def createRole(self, roleId, definition):
+        self.write(roleId, self.roles, definition)
+
+    def updateRole(self, roleId, definition):
+        self.write(roleId, self.roles, definition)
+
+    def listHookGroups(self):
+        return { 'groups': sorted(set(hookGroupId for hookGroupId, _ in self.hookDefinitions)) }
+
+    def hook(self, hookGroupId, hookId):
+        if (hookGroupId, hookId) not in self.hookDefinitions:
+            raise getRestFailure(404)
+        return self.hookDefinitions[(hookGroupId, hookId)]
+
+    def createHook(self, hookGroupId, hookId, definition):
+        self.write('{}/{}'.format(hookGroupId, hookId), self.hookDefinitions, definition)
+
+    def updateHook(self, hookGroupId, hookId, definition):
+        self.write('{}/{}'.format(hookGroupId, hookId), self.hookDefinitions, definition)
+
+    def listClients(self, query):
+        return { 'clients': [{ 'clientId': clientId } for clientId in self.clients if clientId.startswith(query['prefix'])] }
+
+    def client(self, clientId):
+        return dict(self.clients[clientId], description='', expires='2030-01-01T00:00:00.000Z')
+
+    def updateClient(self, clientId, definition):
+        self.write(clientId, self.clients, { 'scopes': definition['scopes'] })
+
+
+@pytest.fixture
+def configPath(tmp_path):
+    declarations = {
+        'role/branch-main.yaml': ['queue:create-task:low:relops-3/*'],
+        'role/staging/gecko-t/win10-64-azure.yaml': ['secrets:get:worker-pool:gecko-t/win10-64-azure'],
+        'role/production/gecko-t/win10-64-azure.yaml': ['secrets:get:production-only'],
+        'hook/staging/project-relops-cron-task-purge-azure-resources.yaml': { 'metadata': { 'name': 'purge' }, 'schedule': ['0 0 * * * *'] },
+        'client/staging/project-relops-image-builder-dev.yaml': ['queue:create-task:low:relops-3/*', 'queue:create-task:high:relops-3/*']
+    }
+    for path, definition in declarations.items():
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(yaml.safe_dump(definition))
+    return str(tmp_path)
+
+
+def reconcile(taskcluster, configPath):
+    resources = ConfigReconciler(taskcluster, taskcluster, 'staging', configPath=configPath).reconcile()
+    return { (resource['kind'], resource['name']): resource for resource in resources }
+
+
+def test_roles_hooks_and_clients_of_the_environment_are_reconciled(configPath):
+    taskcluster = FakeTaskcluster(
+        roles={ 'repo:github.com/mozilla-platform-ops/cloud-image-builder:branch:main': ['queue:create-task:low:relops-3/*'] },
+        hooks={ ('project-relops', 'cron-task-purge-azure-resources'): { 'metadata': { 'name': 'purge (old)' }, 'schedule': ['0 0 * * * *'], 'hookGroupId': 'project-relops' } },
+        clients={ 'project/relops/image-builder/dev': { 'scopes': ['queue:create-task:high:relops-3/*'] } })
+    resources = reconcile(taskcluster, configPath)
+    assert sorted(resources) == [
+        ('client', 'project-relops-image-builder-dev'),
+        ('hook', 'project-relops-cron-task-purge-azure-resources'),
+        ('role', 'branch-main'),
+        ('role', 'gecko-t/win10-64-azure')
+    ]
+    assert resources[('role', 'branch-main')]['outcome'] is None
+    assert resources[('role', 'gecko-t/win10-64-azure')]['outcome'] == 'created'
+    assert resources[('hook', 'project-relops-cron-task-purge-azure-resources')]['changes'] == ['metadata.name']
+    assert resources[('hook', 'project-relops-cron-task-purge-azure-resources')]['outcome'] == 'updated'
+    assert resources[('client', 'project-relops-image-builder-dev')]['outcome'] == 'updated'
+    assert sorted(taskcluster.writes) == ['project-relops/cron-task-purge-azure-resources', 'project/relops/image-builder/dev', 'worker-pool:gecko-t/win10-64-azure']
+
+
+def test_hooks_and_clients_that_cannot_be_written_are_skipped(configPath):
+    taskcluster = FakeTaskcluster(
+        clients={ 'project/relops/image-builder/dev': { 'scopes': [] } },
+        forbidden=['project-relops/cron-task-purge-azure-resources', 'project/relops/image-builder/dev'])
+    resources = reconcile(taskcluster, configPath)
+    assert resources[('hook', 'project-relops-cron-task-purge-azure-resources')]['action'] == 'create'
+    assert resources[('hook', 'project-relops-cron-task-purge-azure-resources')]['outcome'] == 'skipped'
+    assert resources[('client', 'project-relops-image-builder-dev')]['action'] == 'update'
+    assert resources[('client', 'project-relops-image-builder-dev')]['outcome'] == 'skipped'
+    assert resources[('role', 'branch-main')]['outcome'] == 'created'
+
+
+def test_hooks_and_clients_that_cannot_be_read_are_skipped(configPath):
+    taskcluster = FakeTaskcluster()
+    def forbidden(*args, **kwargs):
+        raise getRestFailure(403)
+    taskcluster.hook = forbidden
+    taskcluster.listClients = forbidden
+    resources = reconcile(taskcluster, configPath)
+    assert resources[('hook', 'project-relops-cron-task-purge-azure-resources')]['outcome'] == 'skipped'
+    assert resources[('client', 'project-relops-image-builder-dev')]['outcome'] == 'skipped'
+    assert resources[('role', 'gecko-t/win10-64-azure')]['outcome'] == 'created'
+
+
+def test_roles_that_cannot_be_written_and_missing_clients_fail(configPath):
+    taskcluster = FakeTaskcluster(forbidden=['worker-pool:gecko-t/win10-64-azure'])
+    resources = reconcile(taskcluster, configPath)
+    assert resources[('role', 'gecko-t/win10-64-azure')]['outcome'] == 'failed'
+    # clients are never created, since their access token would be lost
+    assert resources[('client', 'project-relops-image-builder-dev')]['action'] == 'error'
+    assert resources[('client', 'project-relops-image-builder-dev')]['outcome'] == 'failed'
@@ -0,0 +1,52 @@
+import cib
+import pytest
+import types
+import urllib.error
+from cib import getDecisionContext, machineImageManifestHasChanged, unfetched
+
+
+descriptors = {
+    ('azure', 'win10-64', None): { 'build': { 'revision': 'a' * 40 } },
+    ('azure', 'win10-64', 'rg-east-us-gecko-t'): { 'build': { 'revision': 'a' * 40, 'digest': { 'machine': 'b' * 64 } } }
+}
+failingTargets = { ('azure', 'win10-64', 'rg-west-us-gecko-t') }
+
+
+def getImageArtifactDescriptor(platform, key, group=None):
+    if (platform, key, group) in failingTargets:
+        raise urllib.error.HTTPError('https://index', 500, 'internal server error', None, None)
+    if (platform, key, group) not in descriptors:
+        raise urllib.error.HTTPError('https://index', 404, 'not found', None, None)
+    return descriptors[(platform, key, group)]
+
+
+@pytest.fixture
+def decisionContext(monkeypatch):
+    monkeypatch.setattr(cib, 'getImageArtifactDescriptor', getImageArtifactDescriptor)
+    monkeypatch.setenv('TASKCLUSTER_ROOT_URL', 'https://tc')
+    auth = types.SimpleNamespace(currentScopes=lambda: { 'scopes': ['queue:create-task:*'] })
+    return getDecisionContext(auth, ['azure'], ['win10-64'], machineImageTargets=[
+        ('azure', 'win10-64', 'rg-east-us-gecko-t'),
+        ('azure', 'win10-64', 'rg-central-us-gecko-t'),
+        ('azure', 'win10-64', 'rg-west-us-gecko-t')
+    ])
+
+
+def test_machine_image_descriptors_are_prefetched(decisionContext):
+    assert decisionContext.scopes == frozenset(['queue:create-task:*'])
+    assert decisionContext.imageArtifactDescriptors[('azure', 'win10-64')]['build']['revision'] == 'a' * 40
+    assert decisionContext.machineImageArtifactDescriptors[('azure', 'win10-64', 'rg-east-us-gecko-t')]['build']['digest']['machine'] == 'b' * 64
+    # a group without an indexed machine image build has no descriptor
+    assert decisionContext.machineImageArtifactDescriptors[('azure', 'win10-64', 'rg-central-us-gecko-t')] is None
+
+
+def test_failed_machine_image_descriptor_fetches_are_left_unfetched(capsys, decisionContext):
+    assert decisionContext.machineImageArtifactDescriptors[('azure', 'win10-64', 'rg-west-us-gecko-t')] is unfetched
+    assert 'warn: failed to fetch machine image artifact descriptor for azure win10-64, in target group rg-west-us-gecko-t' in capsys.readouterr().out
+
+
+def test_unfetched_machine_image_descriptors_that_fail_again_are_changed(decisionContext):
+    target = ('azure', 'win10-64', 'rg-west-us-gecko-t')
+    assert machineImageManifestHasChanged('azure', 'win10-64', 'c' * 40, 'rg-west-us-gecko-t',
+        decisionContext.imageArtifactDescriptors[('azure', 'win10-64')],
+        decisionContext.machineImageArtifactDescriptors[target]) is True
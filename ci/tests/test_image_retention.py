@@ -0,0 +1,98 @@
+import types
+from cib import getImageRetention
+from datetime import datetime, timedelta, timezone
+
+
+group = 'rg-east-us-gecko-t'
+keys = ['win10-64', 'win10-64-gpu']
+now = datetime(2021, 6, 1, tzinfo=timezone.utc)
+
+
+def getImage(name, daysOld=None, tags=None):
+    tags = dict(tags or {})
+    if daysOld is not None:
+        tags['machineImageCommitTime'] = (now - timedelta(days=daysOld)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return types.SimpleNamespace(
+        id='/subscriptions/0/resourceGroups/{}/providers/Microsoft.Compute/images/{}'.format(group, name),
+        name=name,
+        tags=tags)
+
+
+def getSnapshot(name, daysOld):
+    return types.SimpleNamespace(
+        id='/subscriptions/0/resourceGroups/{}/providers/Microsoft.Compute/snapshots/{}'.format(group, name),
+        name=name,
+        tags=None,
+        time_created=now - timedelta(days=daysOld))
+
+
+def getDecisions(images, snapshots=(), retainCount=2, liveImageIds=()):
+    return { (decision.kind, decision.name): decision for decision in getImageRetention(group, images, list(snapshots), keys, retainCount, set(liveImageIds)) }
+
+
+def test_newest_images_of_each_key_are_retained():
+    decisions = getDecisions([
+        getImage('east-us-gecko-t-win10-64-aaaaaa1-0000001', daysOld=3),
+        getImage('east-us-gecko-t-win10-64-aaaaaa2-0000001', daysOld=2),
+        getImage('east-us-gecko-t-win10-64-aaaaaa3-0000001', daysOld=1),
+        getImage('east-us-gecko-t-win10-64-gpu-bbbbbb1-0000001', daysOld=9)
+    ])
+    assert not decisions[('image', 'east-us-gecko-t-win10-64-aaaaaa1-0000001')].retain
+    assert decisions[('image', 'east-us-gecko-t-win10-64-aaaaaa2-0000001')].retain
+    assert decisions[('image', 'east-us-gecko-t-win10-64-aaaaaa3-0000001')].retain
+    # keys are counted separately, so an old gpu image is still one of the newest of its key
+    assert decisions[('image', 'east-us-gecko-t-win10-64-gpu-bbbbbb1-0000001')].retain
+    assert decisions[('image', 'east-us-gecko-t-win10-64-gpu-bbbbbb1-0000001')].imageName.key == 'win10-64-gpu'
+
+
+def test_images_referenced_by_worker_pools_are_retained():
+    live = getImage('east-us-gecko-t-win10-64-aaaaaa1-0000001', daysOld=30)
+    decisions = getDecisions([
+        live,
+        getImage('east-us-gecko-t-win10-64-aaaaaa2-0000001', daysOld=20),
+        getImage('east-us-gecko-t-win10-64-aaaaaa3-0000001', daysOld=2),
+        getImage('east-us-gecko-t-win10-64-aaaaaa4-0000001', daysOld=1)
+    ], liveImageIds=[live.id.lower()])
+    assert decisions[('image', live.name)].retain
+    assert decisions[('image', live.name)].reason == 'referenced by a worker pool launch config'
+    assert not decisions[('image', 'east-us-gecko-t-win10-64-aaaaaa2-0000001')].retain
+
+
+def test_images_without_commit_time_or_key_are_never_deleted():
+    decisions = getDecisions([
+        getImage('east-us-gecko-t-win10-64-aaaaaa1-0000001'),
+        getImage('east-us-gecko-t-win2019-aaaaaa1-0000001', daysOld=90),
+        getImage('unrelated-image', daysOld=90),
+        getImage('east-us-gecko-t-win10-64-aaaaaa2-0000001', daysOld=3),
+        getImage('east-us-gecko-t-win10-64-aaaaaa3-0000001', daysOld=2),
+        getImage('east-us-gecko-t-win10-64-aaaaaa4-0000001', daysOld=1)
+    ], retainCount=1)
+    assert decisions[('image', 'east-us-gecko-t-win10-64-aaaaaa1-0000001')].retain
+    assert decisions[('image', 'east-us-gecko-t-win10-64-aaaaaa1-0000001')].reason == 'no machineImageCommitTime'
+    assert decisions[('image', 'east-us-gecko-t-win2019-aaaaaa1-0000001')].retain
+    assert decisions[('image', 'unrelated-image')].retain
+    assert { name for (kind, name), decision in decisions.items() if not decision.retain } == {
+        'east-us-gecko-t-win10-64-aaaaaa2-0000001',
+        'east-us-gecko-t-win10-64-aaaaaa3-0000001'
+    }
+
+
+def test_snapshots_of_retained_images_are_retained():
+    live = getImage('east-us-gecko-t-win10-64-aaaaaa1-0000001', daysOld=30)
+    decisions = getDecisions(
+        images=[
+            live,
+            getImage('east-us-gecko-t-win10-64-aaaaaa2-0000001', daysOld=2),
+            getImage('east-us-gecko-t-win10-64-aaaaaa3-0000001', daysOld=1)
+        ],
+        snapshots=[
+            getSnapshot('east-us-gecko-t-win10-64-aaaaaa1', daysOld=30),
+            getSnapshot('east-us-gecko-t-win10-64-aaaaaa0', daysOld=40),
+            getSnapshot('east-us-gecko-t-win10-64-aaaaaa2', daysOld=2),
+            getSnapshot('east-us-gecko-t-win10-64-aaaaaa3', daysOld=1)
+        ],
+        liveImageIds=[live.id.lower()])
+    assert decisions[('snapshot', 'east-us-gecko-t-win10-64-aaaaaa1')].retain
+    assert decisions[('snapshot', 'east-us-gecko-t-win10-64-aaaaaa1')].reason == 'source of a retained win10-64 image'
+    assert not decisions[('snapshot', 'east-us-gecko-t-win10-64-aaaaaa0')].retain
+    assert decisions[('snapshot', 'east-us-gecko-t-win10-64-aaaaaa3')].retain
@@ -0,0 +1,68 @@
+import types
+from cib import ImageInventory, machineImageExists
+
+
+group = 'rg-east-us-gecko-t'
+revision = '0123456789abcdef0123456789abcdef01234567'
+artifact = { 'build': { 'revision': revision } }
+
+
+class FakeImages:
+    def __init__(self, names=(), error=None):
+        self.names = names
+        self.error = error
+        self.calls = 0
+
+    def list_by_resource_group(self, resource_group_name):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return [types.SimpleNamespace(id='/subscriptions/0/resourceGroups/{}/providers/Microsoft.Compute/images/{}'.format(resource_group_name, name), name=name, tags={}) for name in self.names]
+
+
+def getComputeClient(names=(), error=None):
+    return types.SimpleNamespace(images=FakeImages(names, error))
+
+
+def exists(computeClient, key='win10-64-azure', deploymentId=None, imageInventory=None):
+    return machineImageExists(None, computeClient, 'azure', group, key, artifact=artifact, deploymentId=deploymentId, imageInventory=imageInventory)
+
+
+def test_image_of_the_revision_and_deployment_exists():
+    computeClient = getComputeClient(['east-us-gecko-t-win10-64-0123456-abcdef0'])
+    assert exists(computeClient, deploymentId='abcdef0') is True
+    assert exists(computeClient, deploymentId='abcdef1') is False
+
+
+def test_deployment_ids_are_truncated_like_image_names():
+    computeClient = getComputeClient(['east-us-gecko-t-win10-64-0123456-abcdef0'])
+    assert exists(computeClient, deploymentId='abcdef0123456789abcdef0123456789abcdef01') is True
+
+
+def test_any_deployment_matches_without_a_deployment_id():
+    assert exists(getComputeClient(['east-us-gecko-t-win10-64-0123456-abcdef0'])) is True
+    assert exists(getComputeClient(['east-us-gecko-t-win10-64-7654321-abcdef0'])) is False
+
+
+def test_keys_that_prefix_other_keys_do_not_match():
+    computeClient = getComputeClient(['east-us-gecko-t-win10-64-gpu-0123456-abcdef0'])
+    assert exists(computeClient, key='win10-64-azure') is False
+    assert exists(computeClient, key='win10-64-gpu-azure') is True
+
+
+def test_failed_listings_are_unchecked(monkeypatch):
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    computeClient = getComputeClient(error=RuntimeError('throttled'))
+    assert exists(computeClient, deploymentId='abcdef0') is None
+
+
+def test_missing_artifact_revisions_do_not_exist():
+    assert machineImageExists(None, getComputeClient(), 'azure', group, 'win10-64-azure', artifact=None) is False
+
+
+def test_inventory_lists_each_group_once():
+    computeClient = getComputeClient(['east-us-gecko-t-win10-64-0123456-abcdef0', 'east-us-gecko-t-win10-64-gpu-0123456-abcdef0'])
+    imageInventory = ImageInventory(computeClient)
+    assert exists(computeClient, key='win10-64-azure', imageInventory=imageInventory) is True
+    assert exists(computeClient, key='win10-64-gpu-azure', imageInventory=imageInventory) is True
+    assert computeClient.images.calls == 1
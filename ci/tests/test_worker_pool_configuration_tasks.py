@@ -0,0 +1,48 @@
+import json
+import os
+import subprocess
+import sys
+import yaml
+
+
+ciPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+pools = ['gecko-1/win2012-azure', 'gecko-3/win2012-azure']
+
+
+# runs the decision task offline against the repository fixtures, with the given commit message, and returns its task graph
+def getDryRunTaskGraph(tmp_path, commitMessage):
+    with open(os.path.join(ciPath, 'fixtures', 'decision.yaml'), 'r') as file:
+        fixtures = yaml.safe_load(file)
+    fixtures['commitMessage'] = commitMessage
+    fixturesPath = tmp_path / 'fixtures.yaml'
+    fixturesPath.write_text(yaml.safe_dump(fixtures))
+    env = { k: v for k, v in os.environ.items() if k not in ['TASKCLUSTER_PROXY_URL', 'TASKCLUSTER_ROOT_URL', 'TASK_ID', 'GITHUB_HEAD_SHA'] }
+    env.update({ 'CIB_METRICS_PATH': os.devnull, 'CIB_COMMIT_DIRECTIVES_PATH': str(tmp_path / 'commit-directives.json') })
+    subprocess.run([sys.executable, os.path.join(ciPath, 'create-image-build-tasks.py'), '--dry-run', str(fixturesPath), '--output', str(tmp_path / 'graph.json')],
+        cwd = os.path.dirname(ciPath), env = env, check = True, stdout = subprocess.DEVNULL)
+    with open(tmp_path / 'graph.json', 'r') as file:
+        return json.load(file)['tasks']
+
+
+def getWorkerPoolConfigurationTasks(tasks):
+    return { name: task for name, task in tasks.items() if name.startswith('03 :: ') }
+
+
+def test_pools_with_machine_image_builds_depend_only_on_their_own_builds(tmp_path):
+    tasks = getDryRunTaskGraph(tmp_path, 'win2012\n\ninclude pools: {}\ninclude regions: centralus, eastus\n'.format(', '.join(pools)))
+    workerPoolConfigurationTasks = getWorkerPoolConfigurationTasks(tasks)
+    assert len(workerPoolConfigurationTasks) == len(pools)
+    for pool in pools:
+        name = '03 :: generate azure win2012 worker pool configuration for {}'.format(pool)
+        dependencies = workerPoolConfigurationTasks[name]['dependencies']
+        assert dependencies
+        assert all(dependency.startswith('02 :: build azure {} machine image'.format(pool)) for dependency in dependencies)
+
+
+def test_pools_without_machine_image_builds_share_one_task(tmp_path):
+    tasks = getDryRunTaskGraph(tmp_path, 'win2012\n\npool-deploy\ninclude pools: {}\n'.format(', '.join(pools)))
+    workerPoolConfigurationTasks = getWorkerPoolConfigurationTasks(tasks)
+    assert list(workerPoolConfigurationTasks) == ['03 :: generate azure win2012 worker pool configuration for {}'.format(', '.join(pools))]
+    task = workerPoolConfigurationTasks['03 :: generate azure win2012 worker pool configuration for {}'.format(', '.join(pools))]
+    assert task['dependencies'] == []
+    assert ' '.join('--pool {}'.format(pool) for pool in pools) in task['payload']['command'][-1]